@@ -0,0 +1,149 @@
+"""
+Native client for the adb server wire protocol (localhost:5037).
+
+Habla directamente con el servidor adb en lugar de lanzar un proceso `adb`
+por comando: cada petición es '<longitud hex de 4 dígitos><servicio>' y el
+servidor responde 'OKAY' o 'FAIL' + mensaje. Los servicios de transporte
+(host:transport:<serial> + shell:...) consumen la conexión, que el servidor
+cierra al terminar el comando, así que el "pool" limita cuántos sockets hay
+abiertos a la vez y permite lanzar comandos en paralelo en varios
+dispositivos.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import select
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = int(os.environ.get("ANDROID_ADB_SERVER_PORT", 5037))
+
+
+class AdbError(RuntimeError):
+    """El servidor adb respondió FAIL a una petición."""
+
+
+class AdbConnectionError(AdbError, OSError):
+    """No se pudo conectar con el servidor adb."""
+
+
+class AdbClient:
+    """Cliente del protocolo del servidor adb con concurrencia acotada."""
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                 timeout: float = 10.0, max_connections: int = 16) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def _connect(self) -> socket.socket:
+        try:
+            return socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            raise AdbConnectionError(f"No se pudo conectar con el servidor adb en {self.host}:{self.port}: {e}") from e
+
+    @staticmethod
+    def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise AdbError("El servidor adb cerró la conexión a mitad de respuesta.")
+            data += chunk
+        return bytes(data)
+
+    @classmethod
+    def _recv_prefixed(cls, sock: socket.socket) -> str:
+        length = int(cls._recv_exactly(sock, 4), 16)
+        return cls._recv_exactly(sock, length).decode("utf-8", errors="replace")
+
+    @staticmethod
+    def _recv_all(sock: socket.socket) -> str:
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks).decode("utf-8", errors="replace")
+
+    @classmethod
+    def _request(cls, sock: socket.socket, service: str) -> None:
+        """Envía una petición y comprueba el estado OKAY/FAIL."""
+        payload = service.encode("utf-8")
+        sock.sendall(f"{len(payload):04x}".encode("ascii") + payload)
+        status = cls._recv_exactly(sock, 4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            raise AdbError(f"adb rechazó '{service}': {cls._recv_prefixed(sock)}")
+        raise AdbError(f"Respuesta inesperada de adb a '{service}': {status!r}")
+
+    def host_command(self, service: str) -> str:
+        """Servicio host:* con respuesta de longitud prefijada (host:version, host:devices...)."""
+        with self._slots, self._connect() as sock:
+            self._request(sock, service)
+            return self._recv_prefixed(sock)
+
+    def version(self) -> int:
+        return int(self.host_command("host:version"), 16)
+
+    @staticmethod
+    def _parse_devices(payload: str) -> List[Tuple[str, str]]:
+        devices = []
+        for line in payload.splitlines():
+            parts = line.split("\t")
+            if len(parts) >= 2:
+                devices.append((parts[0], parts[1]))
+        return devices
+
+    def devices(self) -> List[Tuple[str, str]]:
+        """Lista (serial, estado) de los dispositivos que ve el servidor adb."""
+        return self._parse_devices(self.host_command("host:devices"))
+
+    def track_devices(self, stop: Optional[threading.Event] = None,
+                      poll: float = 1.0) -> Iterator[List[Tuple[str, str]]]:
+        """
+        Servicio host:track-devices: el servidor mantiene la conexión abierta y
+        envía la lista completa de dispositivos cada vez que cambia. Genera esas
+        listas hasta que se activa `stop` (comprobado cada `poll` segundos) o
+        adb cierra la conexión (AdbError). No ocupa hueco del pool.
+        """
+        with self._connect() as sock:
+            self._request(sock, "host:track-devices")
+            while not (stop and stop.is_set()):
+                readable, _, _ = select.select([sock], [], [], poll)
+                if readable:
+                    yield self._parse_devices(self._recv_prefixed(sock))
+
+    def shell(self, serial: str, command: str) -> str:
+        """Ejecuta `command` en el dispositivo y devuelve su salida (stdout y stderr juntos)."""
+        with self._slots, self._connect() as sock:
+            self._request(sock, f"host:transport:{serial}")
+            self._request(sock, f"shell:{command}")
+            output = self._recv_all(sock)
+        logger.debug(f"adb shell en {serial}: '{command}' -> {len(output)} bytes")
+        return output
+
+    def shell_many(self, commands: Dict[str, str]) -> Dict[str, Optional[str]]:
+        """Ejecuta un comando por dispositivo en paralelo; None para los que fallan."""
+        results: Dict[str, Optional[str]] = {}
+        if not commands:
+            return results
+        with ThreadPoolExecutor(max_workers=min(self.max_connections, len(commands))) as executor:
+            futures = {serial: executor.submit(self.shell, serial, command) for serial, command in commands.items()}
+            for serial, future in futures.items():
+                try:
+                    results[serial] = future.result()
+                except AdbError as e:
+                    logger.warning(f"Fallo de adb shell en {serial}: {e}")
+                    results[serial] = None
+        return results
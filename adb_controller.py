@@ -1,23 +1,29 @@
 """Basic wrapper around ADB commands.
 
 Este módulo simplifica llamadas comunes a ADB para controlar
-dispositivos Android desde Python.
+dispositivos Android desde Python. Los comandos frecuentes hablan
+directamente con el servidor adb (adb_client) y solo se recurre al
+ejecutable `adb` si el servidor no está disponible.
 """
 
 from __future__ import annotations
 
 import logging
 import subprocess
-from typing import List
+from typing import List, Optional
+
+from adb_client import AdbClient, AdbConnectionError, AdbError
 
 logger = logging.getLogger(__name__)
 
 
 class ADBController:
     """Wrapper sencillo para ejecutar comandos ADB."""
-    def __init__(self, adb_path: str = "adb") -> None:
+    def __init__(self, adb_path: str = "adb", client: Optional[AdbClient] = None) -> None:
         # Ruta al ejecutable de adb, por defecto se asume en PATH
         self.adb_path = adb_path
+        self.client = client or AdbClient()
+        self._server_started = False
 
     def run(self, args: List[str]) -> str:
         """Run an adb command and return its output."""
@@ -29,24 +35,52 @@ class ADBController:
             logger.warning(result.stderr.strip())
         return result.stdout.strip()
 
+    def _ensure_server(self) -> bool:
+        """Arranca el servidor adb (una sola vez) si no está escuchando."""
+        if self._server_started:
+            return False
+        self._server_started = True
+        try:
+            self.run(["start-server"])
+        except OSError as e:
+            logger.warning("No se pudo arrancar el servidor adb: %s", e)
+            return False
+        return True
+
+    def shell(self, device: str, args: List[str]) -> str:
+        """Ejecuta `adb -s <device> shell <args>` por el socket del servidor adb."""
+        command = " ".join(args)
+        try:
+            return self.client.shell(device, command).strip()
+        except AdbConnectionError:
+            if self._ensure_server():
+                return self.shell(device, args)
+            logger.debug("Servidor adb no disponible; se usa el ejecutable para '%s'.", command)
+            return self.run(["-s", device, "shell"] + args)
+        except AdbError as e:
+            logger.warning(str(e))
+            return ""
+
     def list_connected_devices(self) -> List[str]:
         """Lista los seriales de los dispositivos ADB conectados actualmente."""
-        output = self.run(["devices"])
-        devices = []
-        for line in output.splitlines():
-            if line.strip() and not line.startswith("List of devices attached"):
-                parts = line.split("\t")
-                if len(parts) >= 2 and parts[1] == "device":
-                    devices.append(parts[0])
+        try:
+            entries = self.client.devices()
+        except AdbConnectionError:
+            if self._ensure_server():
+                return self.list_connected_devices()
+            entries = []
+            for line in self.run(["devices"]).splitlines():
+                if line.strip() and not line.startswith("List of devices attached"):
+                    parts = line.split("\t")
+                    if len(parts) >= 2:
+                        entries.append((parts[0], parts[1]))
+        devices = [serial for serial, state in entries if state == "device"]
         logger.info("Dispositivos ADB REALMENTE conectados: %s", devices)
         return devices
 
     def start_app(self, device: str, package: str) -> None:
         # Inicia una aplicación en el dispositivo utilizando 'monkey'
-        self.run([
-            "-s",
-            device,
-            "shell",
+        self.shell(device, [
             "monkey",
             "-p",
             package,
@@ -57,8 +91,8 @@ class ADBController:
 
     def input_text(self, device: str, text: str) -> None:
         # Envía texto al dispositivo simulado como si fuera tipeado
-        self.run(["-s", device, "shell", "input", "text", text])
+        self.shell(device, ["input", "text", text])
 
     def tap(self, device: str, x: int, y: int) -> None:
         # Realiza un tap en las coordenadas indicadas
-        self.run(["-s", device, "shell", "input", "tap", str(x), str(y)])
\ No newline at end of file
+        self.shell(device, ["input", "tap", str(x), str(y)])
\ No newline at end of file
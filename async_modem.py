@@ -0,0 +1,313 @@
+"""
+Asyncio-based multiplexer for many modems in a single process.
+
+Cada módem se abre como un stream serie no bloqueante (pyserial-asyncio) con
+su propia tarea de lectura y su propia cola de comandos, de modo que un puerto
+lento o bloqueado no frena al resto. La API replica la de ModemController
+(send_command, read_sms, read_phone_number_from_modem...) como corrutinas.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import serial_asyncio
+
+from modem_controller import (
+    AT_COMMAND_SECONDS,
+    AT_COMMAND_TIMEOUTS,
+    CMGL_ROUND_SECONDS,
+    at_command_name,
+    cmgl_command,
+    is_final_response,
+    message_indices,
+    parse_cmgl,
+    parse_cmgr,
+    parse_iccid,
+    parse_indications,
+    parse_phone_number,
+)
+from sms_pdu import ConcatBuffer, parse_cmgl_pdu, parse_cmgr_pdu
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncModemController:
+    """Módem controlado desde el bucle asyncio: una tarea lectora y una cola de comandos."""
+
+    def __init__(self, port: str, baudrate: int = 115200, pdu_mode: bool = False):
+        self.port = port
+        self.baudrate = baudrate
+        self.pdu_mode = pdu_mode
+        self._concat = ConcatBuffer()
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._commands: asyncio.Queue[Tuple[str, float, asyncio.Future]] = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        # Respuesta del comando en curso; None cuando el puerto está ocioso
+        self._response: Optional[bytearray] = None
+        self._response_event = asyncio.Event()
+        self._urc_buffer = bytearray()
+        # Índices notificados por +CMTI, listos para consumir con next_indication()
+        self.indications: asyncio.Queue[str] = asyncio.Queue()
+        # Instante (time.time) en que llegó el +CMTI de cada índice, para medir latencias
+        self.indication_times: Dict[str, float] = {}
+        self._phone_number: Optional[str] = None
+        self._sim_icc_id: Optional[str] = None
+        self.push_enabled = False
+
+    @property
+    def is_connected(self) -> bool:
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self) -> None:
+        logger.debug(f"Connecting to modem on {self.port} (asyncio)")
+        self._reader, self._writer = await serial_asyncio.open_serial_connection(
+            url=self.port, baudrate=self.baudrate
+        )
+        self._start_tasks()
+        await asyncio.sleep(0.5)
+        await self.send_command("AT", wait=0.2)
+        await self.send_command("ATE0", wait=0.2)
+        await self.send_command("AT+CMGF=0" if self.pdu_mode else "AT+CMGF=1", wait=0.2)
+        logger.info(f"Conectado y configurado módem en {self.port}.")
+
+    async def adopt(self, serial_instance) -> None:
+        """Toma un puerto pyserial ya abierto y configurado, sin reabrirlo ni repetir AT/ATE0/AT+CMGF."""
+        loop = asyncio.get_running_loop()
+        self._reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(self._reader)
+        transport = serial_asyncio.SerialTransport(loop, protocol, serial_instance)
+        self._writer = asyncio.StreamWriter(transport, protocol, self._reader, loop)
+        self._start_tasks()
+        logger.info(f"Módem en {self.port} incorporado al bucle asyncio sin reconectar.")
+
+    def _start_tasks(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._read_loop(), name=f"modem-read-{self.port}"),
+            asyncio.create_task(self._command_loop(), name=f"modem-cmd-{self.port}"),
+        ]
+
+    async def disconnect(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._writer is not None:
+            logger.debug(f"Disconnecting from modem on {self.port}")
+            self._writer.close()
+            self._writer = None
+        self.push_enabled = False
+
+    async def send_command(self, command: str, wait: float = 0.5) -> str:
+        """
+        Encola un comando AT y espera su respuesta. Los comandos de un mismo
+        puerto se ejecutan en orden; `wait` es el plazo máximo de respuesta.
+        """
+        if not self.is_connected:
+            logger.error(f"Puerto {self.port} no está conectado. No se puede enviar el comando: {command}")
+            return ""
+        future = asyncio.get_running_loop().create_future()
+        await self._commands.put((command, wait, future))
+        return await future
+
+    async def _command_loop(self) -> None:
+        """Único consumidor de la cola de comandos del puerto."""
+        while True:
+            command, wait, future = await self._commands.get()
+            try:
+                response = await self._execute(command, wait)
+            except Exception as e:
+                logger.error(f"Error al enviar el comando '{command}' al módem en {self.port}: {e}", exc_info=True)
+                response = ""
+            if not future.done():
+                future.set_result(response)
+
+    async def _execute(self, command: str, wait: float) -> str:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        deadline = started + wait
+        self._response = bytearray()
+        self._response_event.clear()
+        try:
+            self._writer.write(f"{command}\r\n".encode('utf-8'))
+            await self._writer.drain()
+            logger.debug(f"Enviado a {self.port}: '{command}'")
+            while not is_final_response(self._response):
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    logger.debug(f"Plazo de {wait}s agotado en {self.port} sin código de resultado final.")
+                    break
+                try:
+                    await asyncio.wait_for(self._response_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    continue
+                self._response_event.clear()
+            complete = is_final_response(self._response)
+            response = self._response.decode('utf-8', errors='ignore').strip()
+        finally:
+            self._response = None
+        name = at_command_name(command)
+        AT_COMMAND_SECONDS.observe(loop.time() - started, command=name, port=self.port)
+        if not complete:
+            AT_COMMAND_TIMEOUTS.inc(command=name, port=self.port)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Respuesta decodificada de {self.port}: '{response}'")
+        self._push_indications(response)
+        return response
+
+    async def _read_loop(self) -> None:
+        """Lee el puerto de forma continua: respuestas al comando en curso o URCs."""
+        while True:
+            chunk = await self._reader.read(4096)
+            if not chunk:
+                logger.warning(f"El puerto {self.port} se ha cerrado (EOF).")
+                return
+            if self._response is not None:
+                self._response += chunk
+                self._response_event.set()
+                continue
+            self._urc_buffer += chunk
+            complete, separator, rest = self._urc_buffer.rpartition(b"\n")
+            if separator:
+                self._push_indications(complete.decode('utf-8', errors='ignore'))
+                self._urc_buffer = bytearray(rest)
+
+    def _push_indications(self, text: str) -> None:
+        for index in parse_indications(text):
+            logger.debug(f"+CMTI recibido en {self.port}: índice {index}.")
+            self.indication_times.setdefault(index, time.time())
+            self.indications.put_nowait(index)
+
+    async def next_indication(self, timeout: Optional[float] = None) -> Optional[str]:
+        """Espera el próximo índice notificado por +CMTI; None si vence `timeout`."""
+        try:
+            return await asyncio.wait_for(self.indications.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def is_responsive(self, wait: float = 0.5) -> bool:
+        return (await self.send_command("AT", wait=wait)).endswith("OK")
+
+    async def enable_new_message_indications(self) -> bool:
+        """Activa los URC +CMTI (AT+CNMI=2,1,0,0,0)."""
+        response = await self.send_command("AT+CNMI=2,1,0,0,0", wait=1.0)
+        self.push_enabled = response.endswith("OK")
+        if not self.push_enabled:
+            logger.warning(f"El módem en {self.port} rechazó AT+CNMI: '{response}'")
+        return self.push_enabled
+
+    async def read_phone_number_from_modem(self) -> None:
+        """Lee ICCID y MSISDN (AT+CCID, AT+CNUM y, si hace falta, AT+CPBR=1)."""
+        self._phone_number = None
+        self._sim_icc_id = parse_iccid(await self.send_command("AT+CCID", wait=1.0))
+        if self._sim_icc_id:
+            logger.info(f"ICCID encontrado para {self.port}: {self._sim_icc_id}")
+        for command in ("AT+CNUM", "AT+CPBR=1"):
+            self._phone_number = parse_phone_number(await self.send_command(command, wait=2.0))
+            if self._phone_number:
+                logger.info(f"Número de teléfono ({command}) encontrado para {self.port}: {self._phone_number}")
+                return
+        logger.warning(f"No se pudo determinar el número de teléfono para el módem en {self.port}.")
+
+    async def read_sms(self, unread_only: bool = False, delete: bool = True) -> List[Dict[str, str]]:
+        """
+        Lee los SMS almacenados y, con `delete`, ELIMINA uno a uno los completos;
+        las partes en espera de reensamblado siguen en la SIM (ver ModemController.read_sms).
+        """
+        started = time.monotonic()
+        response = await self.send_command(cmgl_command(unread_only, self.pdu_mode), wait=10.0)
+        if self.pdu_mode:
+            stored = parse_cmgl_pdu(response)
+            expired = {part["index"] for part in self._concat.expire()}
+            if expired:
+                await self.delete_messages(expired)
+            messages = self._concat.collect([message for message in stored if message["index"] not in expired])
+        else:
+            messages = parse_cmgl(response)
+        CMGL_ROUND_SECONDS.observe(time.monotonic() - started, port=self.port)
+        if delete and messages:
+            await self.delete_messages(message_indices(messages))
+        return messages
+
+    async def read_sms_at(self, index: str, delete: bool = True) -> Optional[Dict[str, str]]:
+        """
+        Lee un único SMS por índice (AT+CMGR) y, con `delete`, lo ELIMINA después
+        de leerlo; las partes de un SMS concatenado se borran todas al completarlo.
+        """
+        response = await self.send_command(f"AT+CMGR={index}", wait=2.0)
+        message = parse_cmgr_pdu(response, index) if self.pdu_mode else parse_cmgr(response, index)
+        complete = self._concat.add(message) if message and self.pdu_mode else message
+        if complete and delete:
+            await self.delete_messages(message_indices([complete]))
+        return complete
+
+    async def delete_messages(self, indices: Iterable[str]) -> List[str]:
+        """Igual que ModemController.delete_messages: un AT+CMGD=<index> por SMS; devuelve los confirmados."""
+        indices = list(dict.fromkeys(str(index) for index in indices))
+        removed = []
+        for index in indices:
+            response = await self.send_command(f"AT+CMGD={index}", wait=5.0)
+            if response.endswith("OK"):
+                removed.append(index)
+            else:
+                logger.warning(f"No se pudo eliminar el SMS {index} de {self.port} ('{response}').")
+        return removed
+
+
+class ModemService:
+    """Dueño de todos los puertos serie de la granja dentro de un único bucle asyncio."""
+
+    def __init__(self, baudrate: int = 115200, pdu_mode: bool = False):
+        self.baudrate = baudrate
+        self.pdu_mode = pdu_mode
+        self.modems: Dict[str, AsyncModemController] = {}
+
+    async def start(self, ports: Iterable[str], push_sms: bool = True) -> Dict[str, AsyncModemController]:
+        """Conecta todos los puertos en paralelo y devuelve los que quedaron operativos."""
+        ports = list(dict.fromkeys(ports))
+        results = await asyncio.gather(
+            *(self._open(port, push_sms) for port in ports), return_exceptions=True
+        )
+        for port, result in zip(ports, results):
+            if isinstance(result, AsyncModemController):
+                self.modems[port] = result
+            else:
+                logger.warning(f"Fallo al conectar con {port}: {result}")
+        return self.modems
+
+    async def _open(self, port: str, push_sms: bool) -> AsyncModemController:
+        modem = AsyncModemController(port, self.baudrate, self.pdu_mode)
+        await modem.connect()
+        if push_sms:
+            await modem.enable_new_message_indications()
+        return modem
+
+    async def open(self, port: str, push_sms: bool = True) -> AsyncModemController:
+        """Conecta (o reconecta tras un hot-plug) un puerto y lo añade al servicio."""
+        await self.close(port)
+        self.modems[port] = await self._open(port, push_sms)
+        return self.modems[port]
+
+    async def adopt(self, port: str, serial_instance) -> AsyncModemController:
+        """Añade un puerto que ya abrió y configuró el sondeo de la Fase 1, sin reconectarlo."""
+        await self.close(port)
+        modem = AsyncModemController(port, self.baudrate, self.pdu_mode)
+        await modem.adopt(serial_instance)
+        self.modems[port] = modem
+        return modem
+
+    async def close(self, port: str) -> None:
+        """Desconecta un puerto y lo retira del servicio (p. ej. porque se ha desenchufado)."""
+        modem = self.modems.pop(port, None)
+        if modem:
+            try:
+                await modem.disconnect()
+            except Exception as e:
+                logger.debug(f"Error al cerrar {port}: {e}")
+
+    async def stop(self) -> None:
+        await asyncio.gather(*(modem.disconnect() for modem in self.modems.values()))
+        self.modems.clear()
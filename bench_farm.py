@@ -0,0 +1,225 @@
+"""
+End-to-end throughput benchmark of the farm on simulated hardware.
+
+Levanta N dispositivos simulados (fake_worker.py), un módem falso en pty por
+SIM (fake_modem.py), la red SMS simulada y un servidor adb falso, los describe
+en un inventory.json y ejecuta main.py completo (monitor de SMS incluido) en
+un FARM_HOME temporal. Al terminar informa números/hora y los percentiles de
+latencia del código (llegada del SMS al módem -> código en manos del worker).
+
+Con --agents K la granja se reparte en K hosts simulados en localhost: un
+farm_coordinator.py y K farm_agent.py, cada uno con su FARM_HOME, su servidor
+adb falso y su parte de los dispositivos y módems.
+
+    python bench_farm.py --devices 4 --sims-per-device 5
+    python bench_farm.py --devices 8 --fail-under 900   # falla si baja de 900 números/hora
+    python bench_farm.py --devices 6 --agents 3
+
+Solo POSIX (los módems usan pty).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from config import CODE_DIR
+from fake_adb_server import FakeAdbServer
+from fake_modem import SmsGateway, create_modems
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Percentil por rango más cercano; None sin muestras."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_farm(home: Path, modems, serials: List[str], args: argparse.Namespace,
+               extra_settings: Optional[Dict] = None) -> None:
+    """inventory.json y settings.json de la granja simulada."""
+    inventory = {"devices": [
+        {"serial": serial, "sims": [{"modem_port": modem.port, "iccid": modem.iccid}
+                                    for modem in modems[i::len(serials)]]}
+        for i, serial in enumerate(serials)
+    ]}
+    (home / "inventory.json").write_text(json.dumps(inventory, indent=2), encoding="utf-8")
+    settings = {
+        "ModemConfig": {
+            "push_sms": not args.no_push,
+            "poll_interval": args.poll_interval,
+            "async_monitor": args.async_monitor,
+            "service_port": free_port(),
+        },
+        "FarmConfig": {
+            "worker_command": [sys.executable, str(CODE_DIR / "fake_worker.py")],
+            "worker_timeout": args.worker_timeout,
+            "prepare_ahead": not args.no_prepare_ahead,
+        },
+        "BrokerConfig": {"port": free_port(), "wait_timeout": args.worker_timeout},
+        "MetricsConfig": {"flush_interval": 1.0},
+        **(extra_settings or {}),
+    }
+    (home / "settings.json").write_text(json.dumps(settings, indent=2), encoding="utf-8")
+
+
+def read_outcomes(home: Path) -> List[Dict]:
+    from db_manager import DBManager
+
+    db = DBManager(home / "results.txt", home / "farm.db")
+    try:
+        return db.read_outcomes(db.latest_run_id())
+    finally:
+        db.close()
+
+
+def run_agents(home: Path, modems, serials: List[str], env: Dict[str, str], args: argparse.Namespace,
+               adb_servers: List[FakeAdbServer]) -> int:
+    """Coordinador en `home` y un agente por host simulado (home/agent-N); devuelve el peor código de salida."""
+    coordinator = {"CoordinatorConfig": {"listen_host": "127.0.0.1", "port": free_port(), "agents": args.agents}}
+    (home / "settings.json").write_text(json.dumps(coordinator, indent=2), encoding="utf-8")
+    agents = []
+    for i in range(args.agents):
+        agent_home = home / f"agent-{i + 1}"
+        agent_home.mkdir()
+        agent_serials = serials[i::args.agents]
+        agent_modems = [modem for j, modem in enumerate(modems) if serials[j % len(serials)] in agent_serials]
+        write_farm(agent_home, agent_modems, agent_serials, args,
+                   {"CoordinatorConfig": {**coordinator["CoordinatorConfig"], "agent_name": f"agent-{i + 1}"}})
+        adb = FakeAdbServer(devices=agent_serials).start()
+        adb_servers.append(adb)
+        agents.append((agent_home, {**env, "FARM_HOME": str(agent_home), "ANDROID_ADB_SERVER_PORT": str(adb.port)}))
+
+    with (home / "coordinator.out").open("w", encoding="utf-8") as out:
+        processes = [subprocess.Popen([sys.executable, str(CODE_DIR / "farm_coordinator.py")],
+                                      env={**env, "FARM_HOME": str(home)}, stdout=out, stderr=subprocess.STDOUT)]
+        time.sleep(1.0)
+        for agent_home, agent_env in agents:
+            with (agent_home / "agent.out").open("w", encoding="utf-8") as agent_out:
+                processes.append(subprocess.Popen([sys.executable, str(CODE_DIR / "farm_agent.py")], env=agent_env,
+                                                  stdout=agent_out, stderr=subprocess.STDOUT))
+        return max(abs(process.wait()) for process in processes)
+
+
+def run(args: argparse.Namespace) -> Dict:
+    home = Path(tempfile.mkdtemp(prefix="farm-bench-"))
+    serials = [f"SIM_DEVICE_{i + 1:03d}" for i in range(args.devices)]
+    modems = create_modems(args.devices * args.sims_per_device, args.at_latency)
+    gateway = SmsGateway(modems, delivery_delay=args.sms_delay, jitter=args.sms_jitter).start()
+    adb_servers: List[FakeAdbServer] = []
+    try:
+        env = {
+            **os.environ,
+            "FARM_HOME": str(home),
+            "FAKE_SMS_GATEWAY": f"127.0.0.1:{gateway.port}",
+            "FAKE_UI_LATENCY": str(args.ui_latency),
+            "FAKE_CLEAR_LATENCY": str(args.clear_latency),
+        }
+        hosts = f", {args.agents} agentes" if args.agents else ""
+        print(f"Granja simulada en {home}: {len(serials)} dispositivos, {len(modems)} SIMs{hosts}.")
+        started = time.monotonic()
+        if args.agents:
+            returncode = run_agents(home, modems, serials, env, args, adb_servers)
+        else:
+            write_farm(home, modems, serials, args)
+            adb_servers.append(FakeAdbServer(devices=serials).start())
+            env["ANDROID_ADB_SERVER_PORT"] = str(adb_servers[0].port)
+            with (home / "main.out").open("w", encoding="utf-8") as out:
+                returncode = subprocess.call([sys.executable, str(CODE_DIR / "main.py")], env=env,
+                                             stdout=out, stderr=subprocess.STDOUT)
+        wall = time.monotonic() - started
+
+        outcomes = read_outcomes(home)
+        durations = [row["duration"] for row in outcomes if row["duration"] is not None]
+        report = {
+            "devices": len(serials),
+            "agents": args.agents,
+            "sims": len(modems),
+            "processed": len(outcomes),
+            "statuses": dict(Counter(row["status"] for row in outcomes)),
+            "returncode": returncode,
+            "wall_seconds": round(wall, 2),
+            "numbers_per_hour": round(len(outcomes) * 3600 / wall, 1) if wall else 0.0,
+            "code_latency_p50": percentile(gateway.latencies, 0.50),
+            "code_latency_p99": percentile(gateway.latencies, 0.99),
+            "worker_duration_p50": percentile(durations, 0.50),
+            "worker_duration_p99": percentile(durations, 0.99),
+            "farm_home": str(home),
+        }
+        return report
+    finally:
+        for adb in adb_servers:
+            adb.stop()
+        gateway.stop()
+        for modem in modems:
+            modem.stop()
+        if not args.keep:
+            shutil.rmtree(home, ignore_errors=True)
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.3f}s"
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark de extremo a extremo de la granja sobre hardware simulado.")
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--sims-per-device", type=int, default=5)
+    parser.add_argument("--at-latency", type=float, default=0.02, help="Latencia de cada respuesta AT (s).")
+    parser.add_argument("--sms-delay", type=float, default=2.0, help="Retardo de la red hasta que llega el SMS (s).")
+    parser.add_argument("--sms-jitter", type=float, default=1.0)
+    parser.add_argument("--ui-latency", type=float, default=0.5, help="Duración de cada etapa de UI simulada (s).")
+    parser.add_argument("--clear-latency", type=float, default=0.3)
+    parser.add_argument("--worker-timeout", type=float, default=60.0)
+    parser.add_argument("--poll-interval", type=float, default=10.0)
+    parser.add_argument("--no-push", action="store_true", help="Monitor solo por barridos AT+CMGL (sin +CMTI).")
+    parser.add_argument("--async-monitor", action="store_true")
+    parser.add_argument("--no-prepare-ahead", action="store_true")
+    parser.add_argument("--agents", type=int, default=0,
+                        help="Reparte la granja en N agentes con un coordinador (0: main.py en un solo host).")
+    parser.add_argument("--json", type=Path, help="Guarda el informe en este archivo.")
+    parser.add_argument("--keep", action="store_true", help="Conserva el FARM_HOME temporal (logs, farm.db, métricas).")
+    parser.add_argument("--fail-under", type=float, default=0.0,
+                        help="Sale con error si el rendimiento queda por debajo de N números/hora.")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print(f"Procesados: {report['processed']}/{report['sims']} {report['statuses']} en {report['wall_seconds']}s")
+    print(f"Rendimiento: {report['numbers_per_hour']} números/hora")
+    print(f"Latencia del código (SMS en el módem -> worker): p50 {format_seconds(report['code_latency_p50'])}, "
+          f"p99 {format_seconds(report['code_latency_p99'])}")
+    print(f"Duración por número: p50 {format_seconds(report['worker_duration_p50'])}, "
+          f"p99 {format_seconds(report['worker_duration_p99'])}")
+    if args.keep:
+        print(f"Datos de la ejecución en {report['farm_home']}")
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    if report["processed"] < report["sims"]:
+        print(f"ERROR: solo se procesaron {report['processed']} de {report['sims']} SIMs (código de salida {report['returncode']}).")
+        return 1
+    if args.fail_under and report["numbers_per_hour"] < args.fail_under:
+        print(f"ERROR: {report['numbers_per_hour']} números/hora está por debajo del umbral {args.fail_under}.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""
+Microbenchmarks of the AT response parsers and the OTP code extraction.
+
+Genera corpus sintéticos (volcados AT+CMGL de 100 a 10k mensajes en modo
+texto y PDU, GSM-7/UCS2/UTF-8, SMS concatenados, lecturas truncadas y
+respuestas malformadas) y mide para cada parser el tiempo por llamada, el
+rendimiento en mensajes/s y el pico de memoria asignada (tracemalloc).
+
+Los tiempos se normalizan con un bucle de calibración para poder comparar
+máquinas distintas. Cada ejecución se compara con la referencia del
+repositorio (bench_parsers_baseline.json, o la de --baseline) y falla si algún
+caso es más lento que ella en más de --threshold (por defecto 25 %).
+
+    python bench_parsers.py
+    python bench_parsers.py --save-baseline bench_parsers_baseline.json   # tras una mejora intencionada
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+from modem_controller import (
+    is_final_response,
+    parse_cmgl,
+    parse_cmgr,
+    parse_iccid,
+    parse_phone_number,
+)
+from sms_monitor import extract_code
+from sms_pdu import GSM7_BASIC, parse_cmgl_pdu, parse_cmgr_pdu
+
+DEFAULT_SIZES = (100, 1000, 10000)
+# Referencia versionada con la que se compara cada ejecución
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "bench_parsers_baseline.json"
+TEXT_BODIES = (
+    "Telegram code: {code}. Do not give this code to anyone, even if they say they are from Telegram!",
+    "Código de Telegram: {code}. No lo compartas con nadie, ni siquiera con alguien de Telegram.",
+    "Tu saldo es de 12,50 EUR. Recarga en el 22{code} antes del día 30.",
+    "Llamada perdida de +34600111222 a las 12:45. Mensaje de voz disponible.",
+    "Ваш код Telegram: {code} ✅",
+    "Promoción: 5GB extra por solo 3 € este mes. Responde SI.",
+)
+UCS2_BODIES = ("Telegram code {code} 🔑", "Код подтверждения: {code}", "驗證碼 {code}")
+
+
+@dataclass
+class Case:
+    name: str
+    function: Callable[[], object]
+    items: int
+    # Mensajes que debe devolver el parser con el corpus completo (None = no se comprueba)
+    expected: Optional[int] = None
+
+
+# --- Corpus -------------------------------------------------------------------
+
+def _code(rng: random.Random) -> str:
+    return f"{rng.randint(0, 999999):0{rng.choice((5, 6))}d}"
+
+
+def _timestamp(rng: random.Random) -> str:
+    return f"24/{rng.randint(1, 12):02d}/{rng.randint(1, 28):02d},{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00+04"
+
+
+def text_body(rng: random.Random) -> str:
+    if rng.random() < 0.15:
+        # Modems con AT+CSCS="UCS2" devuelven el cuerpo en hexadecimal
+        return rng.choice(UCS2_BODIES).format(code=_code(rng)).encode("utf-16-be").hex().upper()
+    return rng.choice(TEXT_BODIES).format(code=_code(rng))
+
+
+def cmgl_text_dump(count: int, rng: random.Random) -> str:
+    lines = []
+    for index in range(1, count + 1):
+        status = rng.choice(("REC UNREAD", "REC READ"))
+        alpha = rng.choice(('""', ""))
+        lines.append(f'+CMGL: {index},"{status}","+34{rng.randint(600000000, 699999999)}",{alpha},"{_timestamp(rng)}"')
+        lines.append(text_body(rng))
+    return "\r\n".join(lines) + "\r\n\r\nOK"
+
+
+def _pack_septets(septets: Sequence[int]) -> bytes:
+    data = bytearray()
+    carry = carry_bits = 0
+    for septet in septets:
+        carry |= septet << carry_bits
+        carry_bits += 7
+        while carry_bits >= 8:
+            data.append(carry & 0xFF)
+            carry >>= 8
+            carry_bits -= 8
+    if carry_bits:
+        data.append(carry & 0xFF)
+    return bytes(data)
+
+
+def _semi_octets(digits: str) -> bytes:
+    if len(digits) % 2:
+        digits += "F"
+    return bytes.fromhex("".join(digits[i + 1] + digits[i] for i in range(0, len(digits), 2)))
+
+
+def encode_deliver_pdu(sender: str, text: str, ucs2: bool, concat: Optional[tuple] = None) -> str:
+    """SMS-DELIVER en hexadecimal (sin SMSC), con UDH de concatenación opcional (ref, total, seq)."""
+    digits = sender.lstrip("+")
+    udh = bytes((0x05, 0x00, 0x03) + concat) if concat else b""
+    pdu = bytearray((0x00, 0x44 if concat else 0x04, len(digits), 0x91))
+    pdu += _semi_octets(digits)
+    pdu += bytes((0x00, 0x08 if ucs2 else 0x00))
+    pdu += _semi_octets("24010112000040")
+    if ucs2:
+        body = udh + text.encode("utf-16-be")
+        pdu += bytes((len(body),)) + body
+    else:
+        fill = (len(udh) * 8 + 6) // 7 if udh else 0
+        septets = [0] * fill + [GSM7_BASIC.index(char) for char in text]
+        packed = bytearray(_pack_septets(septets))
+        packed[:len(udh)] = udh
+        pdu += bytes((len(septets),)) + packed
+    return pdu.hex().upper()
+
+
+def cmgl_pdu_dump(count: int, rng: random.Random) -> tuple:
+    """Volcado CMGL en modo PDU y número de PDUs que contiene (cada parte de un concatenado cuenta)."""
+    lines = []
+    index = 0
+    while index < count:
+        sender = f"+34{rng.randint(600000000, 699999999)}"
+        ucs2 = rng.random() < 0.3
+        code = _code(rng)
+        text = (rng.choice(UCS2_BODIES) if ucs2 else "Telegram code: {code}. Do not give this code to anyone!").format(code=code)
+        if rng.random() < 0.1 and index + 2 <= count:
+            reference = rng.randint(0, 255)
+            pdus = [encode_deliver_pdu(sender, part, ucs2, (reference, 2, seq))
+                    for seq, part in enumerate((text[:len(text) // 2], text[len(text) // 2:]), start=1)]
+        else:
+            pdus = [encode_deliver_pdu(sender, text, ucs2)]
+        for pdu in pdus:
+            index += 1
+            lines.append(f"+CMGL: {index},{rng.choice((0, 1))},,{len(pdu) // 2 - 1}")
+            lines.append(pdu)
+    return "\r\n".join(lines) + "\r\n\r\nOK", index
+
+
+def truncate(response: str, rng: random.Random) -> str:
+    """Lectura cortada a mitad (plazo agotado antes del OK final)."""
+    return response[:rng.randint(len(response) // 2, len(response) - 10)]
+
+
+def malformed(response: str, rng: random.Random) -> str:
+    """Inserta ruido de línea serie: URCs intercalados, líneas vacías y cabeceras rotas."""
+    lines = response.split("\r\n")
+    noisy = []
+    for line in lines:
+        noisy.append(line)
+        roll = rng.random()
+        if roll < 0.02:
+            noisy.append('+CMTI: "SM",7')
+        elif roll < 0.04:
+            noisy.append('+CMGL: x,"REC')
+        elif roll < 0.05:
+            noisy.append("\x00\xff garbage")
+    return "\r\n".join(noisy)
+
+
+# --- Casos ---------------------------------------------------------------------
+
+def build_cases(sizes: Sequence[int], seed: int = 1234) -> List[Case]:
+    rng = random.Random(seed)
+    cases: List[Case] = []
+    for size in sizes:
+        text = cmgl_text_dump(size, rng)
+        pdu, pdu_messages = cmgl_pdu_dump(size, rng)
+        raw = (text + "\r\n").encode("utf-8")
+        cases += [
+            Case(f"parse_cmgl[text,{size}]", lambda r=text: parse_cmgl(r), size, size),
+            Case(f"parse_cmgl[text,truncated,{size}]", lambda r=truncate(text, rng): parse_cmgl(r), size),
+            Case(f"parse_cmgl[text,malformed,{size}]", lambda r=malformed(text, rng): parse_cmgl(r), size),
+            Case(f"parse_cmgl_pdu[{size}]", lambda r=pdu: parse_cmgl_pdu(r), size, pdu_messages),
+            Case(f"parse_cmgl_pdu[truncated,{size}]", lambda r=truncate(pdu, rng): parse_cmgl_pdu(r), size),
+            Case(f"is_final_response[{size}]", lambda b=raw: is_final_response(b), size),
+        ]
+
+    single_text = '+CMGR: "REC UNREAD","+34600111222",,"24/01/01,12:00:00+04"\r\nTelegram code: 12345. Do not give this code to anyone!\r\n\r\nOK'
+    single_pdu = f"+CMGR: 0,,40\r\n{encode_deliver_pdu('+34600111222', 'Telegram code: 12345', False)}\r\n\r\nOK"
+    identities = [
+        "+CCID: 89340000000000000001\r\n\r\nOK", "+QCCID: 8934000000000000000F\r\n\r\nOK", "ERROR",
+        '+CNUM: "","+34600111222",145\r\n\r\nOK', '+CPBR: 1,"+34600111222",145,"Own"\r\n\r\nOK', "+CNUM: \r\n\r\nOK",
+    ] * 100
+    bodies = [text_body(rng) for _ in range(10000)]
+    cases += [
+        Case("parse_cmgr[text]", lambda: parse_cmgr(single_text, "1"), 1, 1),
+        Case("parse_cmgr_pdu", lambda: parse_cmgr_pdu(single_pdu, "1"), 1, 1),
+        Case("parse_iccid+parse_phone_number[600]",
+             lambda: [(parse_iccid(r), parse_phone_number(r)) for r in identities], len(identities)),
+        Case("extract_code[10000]", lambda: [extract_code(body) for body in bodies], len(bodies)),
+    ]
+    return cases
+
+
+# --- Medición ------------------------------------------------------------------
+
+def calibrate() -> float:
+    """Tiempo de una carga fija de Python puro y regex; sirve de unidad entre máquinas."""
+    import re
+
+    pattern = re.compile(r'(\d{5,6})')
+    text = "Telegram code: 12345. " * 50
+
+    def workload() -> None:
+        total = 0
+        for i in range(20000):
+            total += i % 7
+        pattern.findall(text)
+        "\r\n".join(str(i) for i in range(2000)).split("\r\n")
+
+    return min(timeit.repeat(workload, number=5, repeat=5)) / 5
+
+
+def measure(case: Case, repeat: int, min_time: float = 0.2) -> Dict:
+    # Un parser más rápido pero incorrecto no debe pasar por mejora
+    result = case.function()
+    if case.expected is not None:
+        found = len(result) if isinstance(result, list) else int(result is not None)
+        if found != case.expected:
+            raise AssertionError(f"{case.name}: se esperaban {case.expected} mensajes y el parser devolvió {found}")
+
+    timer = timeit.Timer(case.function)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    seconds = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    tracemalloc.start()
+    try:
+        case.function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "seconds": seconds,
+        "items_per_second": case.items / seconds if seconds else float("inf"),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def run(sizes: Sequence[int], repeat: int, name_filter: str = "") -> Dict:
+    unit = calibrate()
+    results = {}
+    for case in build_cases(sizes):
+        if name_filter and name_filter not in case.name:
+            continue
+        measured = measure(case, repeat)
+        measured["normalized"] = measured["seconds"] / unit
+        results[case.name] = measured
+        print(f"{case.name:<42} {measured['seconds'] * 1000:>10.3f} ms {measured['items_per_second']:>14,.0f} msg/s "
+              f"{measured['peak_kib']:>10.1f} KiB")
+    return {"calibration_seconds": unit, "python": sys.version.split()[0], "results": results}
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Casos cuyo tiempo normalizado empeora más de `threshold` respecto a la referencia."""
+    regressions = []
+    for name, measured in current["results"].items():
+        reference = baseline.get("results", {}).get(name)
+        if not reference:
+            continue
+        ratio = measured["normalized"] / reference["normalized"]
+        if ratio > 1 + threshold:
+            regressions.append(f"{name}: {ratio:.2f}x más lento que la referencia")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Microbenchmarks de los parsers AT y de la extracción de códigos.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Mensajes por volcado CMGL.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="Solo los casos cuyo nombre contiene este texto.")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE,
+                        help="Resultados de referencia con los que comparar (por defecto los del repositorio).")
+    parser.add_argument("--no-baseline", action="store_true", help="Solo mide, sin comparar con ninguna referencia.")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Empeoramiento relativo tolerado antes de fallar (0.25 = 25 %%).")
+    parser.add_argument("--save-baseline", type=Path, help="Guarda los resultados como nueva referencia.")
+    args = parser.parse_args(argv)
+
+    # Los PDU truncados generan avisos por mensaje; no se mide el coste del log
+    logging.basicConfig(level=logging.CRITICAL)
+    started = time.monotonic()
+    current = run(args.sizes, args.repeat, args.filter)
+    print(f"Calibración: {current['calibration_seconds'] * 1000:.3f} ms. Total {time.monotonic() - started:.1f}s.")
+
+    status = 0
+    # Se compara antes de guardar: --save-baseline sobre la misma ruta no debe compararse consigo misma
+    if args.no_baseline:
+        pass
+    elif not args.baseline.exists():
+        print(f"Sin referencia en {args.baseline}: no se comprueban regresiones.")
+        status = 0 if args.baseline == DEFAULT_BASELINE else 1
+    else:
+        regressions = compare(current, json.loads(args.baseline.read_text(encoding="utf-8")), args.threshold)
+        if regressions:
+            print("REGRESIONES:")
+            for line in regressions:
+                print(f"  {line}")
+            status = 1
+        else:
+            print(f"Sin regresiones respecto a {args.baseline} (umbral {args.threshold:.0%}).")
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(current, indent=2), encoding="utf-8")
+        print(f"Referencia guardada en {args.save_baseline}.")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""
+Local broker that pushes OTP codes to the workers waiting for them.
+
+Protocolo: JSON por líneas sobre TCP en localhost.
+    cliente -> broker  {"op": "subscribe", "phone": "+34...", "timeout": 180, "since": 1700000000.0}
+                       {"op": "cancel", "phone": "+34..."}
+                       {"op": "publish", "phone": "+34...", "code": "12345"}
+    broker -> cliente  {"event": "code", "phone": ..., "code": ..., "published_at": ...}
+                       {"event": "timeout" | "cancelled", "phone": ...}
+                       {"event": "ok"} | {"event": "error", "message": ...}
+
+Tras el evento final de una suscripción el broker cierra la conexión.
+Los códigos publicados antes de que el worker se suscriba se guardan durante
+`code_ttl` segundos y se entregan en cuanto llega la suscripción, salvo los
+anteriores a `since` (cuando el worker envió el número): son de un intento
+previo, p. ej. en otro dispositivo antes de devolver la tarea a la cola.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import socket
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class CodeBroker:
+    """Servidor asyncio en un hilo propio; `publish` puede llamarse desde cualquier hilo."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, code_ttl: float = 600.0) -> None:
+        self.host = host
+        self.port = port
+        self.code_ttl = code_ttl
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._thread: Optional[threading.Thread] = None
+        # Suscripciones activas: número -> futuro que recibe (código, published_at)
+        self._waiters: Dict[str, asyncio.Future] = {}
+        # Códigos publicados sin suscriptor todavía: número -> (código, published_at)
+        self._pending: Dict[str, Tuple[str, float]] = {}
+
+    def start(self) -> None:
+        """Arranca el broker en segundo plano y espera a que el puerto esté escuchando."""
+        ready = threading.Event()
+        errors = []
+
+        def run() -> None:
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._server = self._loop.run_until_complete(
+                    asyncio.start_server(self._handle_client, self.host, self.port)
+                )
+            except OSError as e:
+                errors.append(e)
+                ready.set()
+                return
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name="code-broker", daemon=True)
+        self._thread.start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+        logger.info(f"Broker de códigos escuchando en {self.host}:{self.port}.")
+
+    def stop(self) -> None:
+        if not self._loop:
+            return
+
+        async def shutdown() -> None:
+            self._server.close()
+            await self._server.wait_closed()
+            for waiter in self._waiters.values():
+                waiter.cancel()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop = None
+
+    def publish(self, phone: str, code: str) -> None:
+        """Entrega `code` al worker suscrito a `phone` (o lo guarda hasta que se suscriba)."""
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._deliver, phone, code, time.time())
+
+    def _deliver(self, phone: str, code: str, published_at: float) -> None:
+        waiter = self._waiters.get(phone)
+        if waiter and not waiter.done():
+            waiter.set_result((code, published_at))
+            logger.debug(f"Código para {phone} entregado por el broker.")
+            return
+        self._pending[phone] = (code, published_at)
+        self._expire_pending()
+
+    def _expire_pending(self) -> None:
+        limit = time.time() - self.code_ttl
+        for phone in [p for p, (_, published_at) in self._pending.items() if published_at < limit]:
+            del self._pending[phone]
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                    op = request.get("op")
+                    phone = str(request.get("phone", ""))
+                    timeout = float(request.get("timeout", 180))
+                    since = float(request.get("since") or 0)
+                except (ValueError, AttributeError, TypeError):
+                    await self._send(writer, {"event": "error", "message": "petición inválida"})
+                    continue
+
+                if op == "publish":
+                    self._deliver(phone, str(request.get("code", "")), time.time())
+                    await self._send(writer, {"event": "ok"})
+                elif op == "subscribe":
+                    # La suscripción es la última operación de la conexión
+                    await self._serve_subscription(reader, writer, phone, timeout, since)
+                    break
+                elif op == "cancel":
+                    waiter = self._waiters.get(phone)
+                    if waiter and not waiter.done():
+                        waiter.cancel()
+                    self._pending.pop(phone, None)
+                    await self._send(writer, {"event": "cancelled", "phone": phone})
+                else:
+                    await self._send(writer, {"event": "error", "message": f"op desconocida: {op}"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_subscription(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                                  phone: str, timeout: float, since: float = 0.0) -> None:
+        """
+        Espera el código de `phone` hasta `timeout`, un cancel del cliente o su
+        desconexión. Los códigos guardados publicados antes de `since` se descartan.
+        """
+        self._expire_pending()
+        if phone in self._pending and self._pending[phone][1] < since:
+            del self._pending[phone]
+            logger.debug(f"Código anterior al envío del número {phone} descartado.")
+        if phone in self._pending:
+            code, published_at = self._pending.pop(phone)
+            await self._send(writer, {"event": "code", "phone": phone, "code": code, "published_at": published_at})
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[phone] = waiter
+        next_line = asyncio.ensure_future(reader.readline())
+        try:
+            done, _ = await asyncio.wait({waiter, next_line}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if waiter.cancelled():
+                await self._send(writer, {"event": "cancelled", "phone": phone})
+            elif waiter in done:
+                code, published_at = waiter.result()
+                await self._send(writer, {"event": "code", "phone": phone, "code": code, "published_at": published_at})
+            elif next_line in done:
+                # Cualquier línea (o el cierre del socket) durante la espera cancela la suscripción
+                logger.debug(f"Suscripción de {phone} cancelada por el worker.")
+                if next_line.result():
+                    await self._send(writer, {"event": "cancelled", "phone": phone})
+            else:
+                await self._send(writer, {"event": "timeout", "phone": phone})
+        finally:
+            next_line.cancel()
+            if self._waiters.get(phone) is waiter:
+                del self._waiters[phone]
+
+    @staticmethod
+    async def _send(writer: asyncio.StreamWriter, message: dict) -> None:
+        writer.write((json.dumps(message) + "\n").encode("utf-8"))
+        await writer.drain()
+
+
+def _request(host: str, port: int, message: dict, timeout: float) -> Optional[dict]:
+    with socket.create_connection((host, port), timeout=timeout) as conn:
+        conn.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        line = conn.makefile("r", encoding="utf-8").readline()
+    return json.loads(line) if line else None
+
+
+def publish_code(phone: str, code: str, host: str = "127.0.0.1", port: int = 8765, timeout: float = 2.0) -> bool:
+    """Publica un código en un broker de otro proceso. Devuelve False si no está disponible."""
+    try:
+        reply = _request(host, port, {"op": "publish", "phone": phone, "code": code}, timeout)
+        return bool(reply) and reply.get("event") == "ok"
+    except OSError as e:
+        logger.warning(f"No se pudo publicar el código de {phone} en el broker: {e}")
+        return False
+
+
+def wait_for_code(phone: str, timeout: float, host: str = "127.0.0.1", port: int = 8765,
+                  since: Optional[float] = None) -> Optional[str]:
+    """Se suscribe a `phone` y devuelve el código (publicado después de `since`), o None si vence el plazo."""
+    message = {"op": "subscribe", "phone": phone, "timeout": timeout}
+    if since:
+        message["since"] = since
+    reply = _request(host, port, message, timeout + 5)
+    if reply and reply.get("event") == "code":
+        return reply["code"]
+    return None
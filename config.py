@@ -1,25 +1,120 @@
 # config.py
+import json
+import os
 from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Dict
+from typing import Any, List, Dict, Optional
 
-BASE_DIR = Path(__file__).resolve().parent
+from inventory import Inventory, legacy_inventory, load_inventory, read_sim_list
+
+# Directorio del código (scripts que se lanzan como subprocesos)
+CODE_DIR = Path(__file__).resolve().parent
+# Directorio de datos de la granja (resultados, base SQLite, logs, numerosNode).
+# FARM_HOME permite ejecutar una granja aislada, p. ej. la simulada de bench_farm.py.
+BASE_DIR = Path(os.environ.get("FARM_HOME") or CODE_DIR).resolve()
+# Ajustes locales opcionales: {"FarmConfig": {"max_workers": 4}, "DBConfig": {...}, ...}
+SETTINGS_FILE = BASE_DIR / "settings.json"
+
+
+def _load_settings() -> Dict[str, Dict[str, Any]]:
+    if not SETTINGS_FILE.exists():
+        return {}
+    with SETTINGS_FILE.open(encoding="utf-8") as f:
+        return json.load(f)
+
+
+SETTINGS = _load_settings()
+
+# Inventario declarativo (dispositivos, SIMs y puertos Appium/systemPort); ver inventory.py.
+INVENTORY_FILE = BASE_DIR / "inventory.json"
+
+
+@lru_cache(maxsize=1)
+def declared_inventory() -> Optional[Inventory]:
+    """
+    inventory.json validado, leído la primera vez que se pide; None si no existe.
+    Un inventario inválido lanza InventoryError (también al crear ModemConfig o
+    FarmConfig): cada script lo informa al arrancar en lugar de fallar al importar config.
+    """
+    return load_inventory(INVENTORY_FILE) if INVENTORY_FILE.exists() else None
+
+
+def apply_settings(target: Any) -> None:
+    """Aplica a una clase (o instancia) de configuración su sección de settings.json."""
+    name = target.__name__ if isinstance(target, type) else type(target).__name__
+    for key, value in SETTINGS.get(name, {}).items():
+        if not hasattr(target, key):
+            raise ValueError(f"{SETTINGS_FILE}: {name} no tiene el ajuste '{key}'")
+        if isinstance(getattr(target, key), Path):
+            value = Path(value)
+        setattr(target, key, value)
 
 class DBConfig:
     """Configuración de la base de datos."""
     results_file = BASE_DIR / "results.txt"
     sim_list = BASE_DIR / "sim_list.txt"
+    # Base SQLite (WAL) con SIMs, tareas y resultados; results.txt y num_*.txt se exportan desde aquí
+    use_sqlite = True
+    database = BASE_DIR / "farm.db"
+    # Filas acumuladas antes de volcarlas en una sola transacción
+    batch_size = 20
 
 @dataclass
 class ModemConfig:
     ports: List[str] = field(default_factory=list)
     baudrate: int = 115200
     timeout: float = 1.0
+    # Modo PDU (AT+CMGF=0): decodifica UCS2 y reensambla SMS concatenados
+    pdu_mode: bool = False
+    # Recepción push: el módem avisa cada SMS nuevo con +CMTI y solo se lee ese índice
+    push_sms: bool = True
+    push_poll_interval: float = 0.2
+    # En modo push, barrido completo AT+CMGL cada N segundos como reconciliación
+    reconcile_interval: float = 60.0
+    # Pausa entre rondas cuando se usa solo el barrido AT+CMGL
+    poll_interval: float = 10.0
+    # Monitor de SMS sobre un único bucle asyncio (una tarea por módem, requiere pyserial-asyncio)
+    async_monitor: bool = False
+    # Caché de SMS ya procesados: caducidad (segundos) y máximo de entradas
+    dedup_ttl: float = 3600.0
+    dedup_max_entries: int = 10000
+    # Detección de módems (Fase 1): puertos sondeados en paralelo y plazo por puerto
+    probe_workers: int = 16
+    probe_deadline: float = 8.0
+    # Caché de identidades (puerto USB + ICCID -> número): con el mismo ICCID se omiten AT+CNUM/AT+CPBR
+    identity_cache: bool = True
+    identity_cache_file: Path = BASE_DIR / "modem_identity.json"
+    # Servicio de módems (sms_monitor.py --serve): dueño de los puertos desde el sondeo hasta el final
+    service_host: str = "127.0.0.1"
+    service_port: int = 8766
+
+    def __post_init__(self) -> None:
+        apply_settings(self)
+        # Con inventario se sondean solo sus módems (sin él, todos los puertos serie)
+        inventory = declared_inventory()
+        if inventory is not None and not self.ports:
+            self.ports = inventory.modem_ports()
 
 @dataclass
 class FarmConfig:
     """Configuración de la granja de dispositivos y servidores Appium."""
     adb_path: str = "adb"
+    # Un proceso Node y una sesión Appium por dispositivo, reutilizados para todos sus números
+    persistent_workers: bool = True
+    # Tiempo máximo por número antes de dar el worker por colgado (segundos)
+    worker_timeout: float = 240.0
+    # Máximo de números procesándose a la vez en toda la granja (0 = uno por dispositivo)
+    max_workers: int = 0
+    # Preparar el dispositivo (limpiar app, pantalla de número) mientras espera hueco para su siguiente SIM
+    prepare_ahead: bool = True
+    # Servidores Appium: plazo para responder en /status, intervalo del supervisor y fallos tolerados
+    appium_ready_timeout: float = 60.0
+    appium_health_interval: float = 10.0
+    appium_max_failed_checks: int = 3
+    # Comando del worker (vacío = node telegram_reader.js); fake_worker.py en la simulación.
+    # En modo persistente se le añade '--serve <serial> <puerto>'; en spawn, '<número> <serial> <puerto>'
+    worker_command: List[str] = field(default_factory=list)
     
     # Lista final de dispositivos (Se reemplazan los seriales reales por variables de entorno o plantillas por seguridad)
     devices: List[Dict[str, any]] = field(default_factory=lambda: [
@@ -36,8 +131,74 @@ class FarmConfig:
         #(Podríamos agregar más dispositivos aquí si es necesario)
     ])
 
+    def __post_init__(self) -> None:
+        apply_settings(self)
+        # inventory.json, si existe, es la única fuente de dispositivos y puertos
+        inventory = declared_inventory()
+        if inventory is not None:
+            self.devices = inventory.device_configs()
+
+
+
+class BrokerConfig:
+    """Broker local (TCP en localhost) que entrega los códigos OTP a los workers."""
+    enabled = True
+    host = "127.0.0.1"
+    port = 8765
+    # Segundos que se guarda un código publicado antes de que el worker se suscriba
+    code_ttl = 600.0
+    # Plazo máximo que un worker espera su código
+    wait_timeout = 180
+
+
+def farm_inventory(farm_cfg: "FarmConfig") -> Inventory:
+    """Inventario de la granja: inventory.json o, si no existe, FarmConfig.devices + sim_list.txt."""
+    inventory = declared_inventory()
+    if inventory is not None:
+        return inventory
+    return legacy_inventory(farm_cfg.devices, read_sim_list(DBConfig.sim_list), str(DBConfig.sim_list))
+
+
+class HotplugConfig:
+    """Seguimiento en caliente de teléfonos (adb host:track-devices) y módems (udev o sondeo de puertos)."""
+    enabled = True
+    # Reescaneo de puertos serie sin pyudev (y plazo máximo entre eventos udev)
+    poll_interval = 1.0
+    # Sin dispositivos activos y con tareas pendientes, segundos que se espera a que vuelva alguno
+    device_wait = 60.0
+
+
+class CoordinatorConfig:
+    """Modo multi-host: farm_coordinator.py reparte y guarda resultados; farm_agent.py en cada host USB."""
+    # Dirección en la que escucha el coordinador y a la que se conectan los agentes
+    listen_host = "0.0.0.0"
+    host = "127.0.0.1"
+    port = 8770
+    # Agentes que deben despedirse (op "bye") para dar la ejecución por terminada
+    agents = 1
+    # Nombre del agente en el coordinador; vacío usa el nombre del host
+    agent_name = ""
+    # Segundos que se espera a un agente desconectado sin "bye" antes de darlo por perdido
+    agent_timeout = 300.0
+    request_timeout = 30.0
+
+
+class MetricsConfig:
+    """Contadores e histogramas de latencia de cada fase (ver metrics.py)."""
+    enabled = True
+    # Un JSON por proceso (main.json, sms_monitor.json), reescrito cada flush_interval segundos
+    json_dir = BASE_DIR / "metrics"
+    flush_interval = 15.0
+    # Endpoints /metrics en formato Prometheus; 0 desactiva el servidor HTTP
+    http_host = "127.0.0.1"
+    main_http_port = 0
+    monitor_http_port = 0
 
 
 class LoggingConfig:
     log_file = BASE_DIR / "sms.txt"
     log_level = "INFO"
+
+
+for _config in (DBConfig, BrokerConfig, HotplugConfig, CoordinatorConfig, MetricsConfig, LoggingConfig):
+    apply_settings(_config)
@@ -2,25 +2,310 @@
 
 Este módulo gestiona la lectura y escritura de archivos CSV donde se
 almacenan los números analizados y si requieren 2FA.
+
+Con `db_path`, DBManager usa además una base SQLite (modo WAL) con tablas de
+SIMs, tareas y resultados. Las escrituras se acumulan en memoria y se vuelcan
+por lotes en una única transacción, de modo que varios hilos y procesos
+pueden escribir a la vez sin carreras de append. Los archivos de siempre
+(results.txt y num_*.txt) se generan con las funciones de exportación.
+La tabla de tareas es el diario de cada ejecución (probing, pending,
+dispatched, awaiting_code, done) y permite reanudarla.
 """
 
 from __future__ import annotations
 
 import csv
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
 from pathlib import Path
-from typing import Iterable, Dict
+from typing import Iterable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+RESULTS_FIELDS = ["phone_number", "device_serial", "sim_number_icc_id", "modem_port", "timestamp"]
+
+# Archivo de texto de cada estado (mismo formato que escribía telegram_reader.js)
+STATUS_FILES = {
+    "2FA": "num_2fa.txt",
+    "NO_2FA": "num_no_2fa.txt",
+    "SUSPENDED": "num_suspendidos.txt",
+    "TOO_MANY_ATTEMPTS": "num_reintentos.txt",
+    "UNKNOWN": "num_error.txt",
+}
+
+# Estados del diario de tareas, en orden
+TASK_STATES = ("probing", "pending", "dispatched", "awaiting_code", "done")
+# Resultados concluyentes: la SIM no necesita volver a procesarse
+FINAL_STATUSES = ("2FA", "NO_2FA", "SUSPENDED", "TOO_MANY_ATTEMPTS")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sims (
+    phone_number TEXT PRIMARY KEY,
+    iccid TEXT NOT NULL DEFAULT '',
+    modem_port TEXT NOT NULL DEFAULT '',
+    device_serial TEXT NOT NULL DEFAULT '',
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sims_iccid ON sims (iccid);
+CREATE INDEX IF NOT EXISTS idx_sims_port ON sims (modem_port);
+
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    modem_port TEXT NOT NULL,
+    phone_number TEXT NOT NULL DEFAULT '',
+    iccid TEXT NOT NULL DEFAULT '',
+    preferred_device TEXT NOT NULL DEFAULT '',
+    device_serial TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL,
+    outcome TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    UNIQUE (run_id, modem_port)
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_phone ON tasks (phone_number);
+CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks (state);
+
+CREATE TABLE IF NOT EXISTS outcomes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id TEXT NOT NULL,
+    phone_number TEXT NOT NULL,
+    iccid TEXT NOT NULL DEFAULT '',
+    modem_port TEXT NOT NULL DEFAULT '',
+    device_serial TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL,
+    duration REAL,
+    stages TEXT,
+    recorded_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outcomes_phone ON outcomes (phone_number);
+CREATE INDEX IF NOT EXISTS idx_outcomes_iccid ON outcomes (iccid);
+CREATE INDEX IF NOT EXISTS idx_outcomes_port ON outcomes (modem_port);
+CREATE INDEX IF NOT EXISTS idx_outcomes_status ON outcomes (status);
+CREATE INDEX IF NOT EXISTS idx_outcomes_run ON outcomes (run_id);
+"""
+
+UPSERT_SIM = """
+INSERT INTO sims (phone_number, iccid, modem_port, device_serial, updated_at)
+VALUES (:phone_number, :iccid, :modem_port, :device_serial, :updated_at)
+ON CONFLICT (phone_number) DO UPDATE SET
+    iccid = CASE WHEN excluded.iccid != '' THEN excluded.iccid ELSE sims.iccid END,
+    modem_port = excluded.modem_port,
+    device_serial = excluded.device_serial,
+    updated_at = excluded.updated_at
+"""
+
+UPSERT_TASK = """
+INSERT INTO tasks (run_id, modem_port, phone_number, iccid, preferred_device, device_serial, state, outcome,
+                   created_at, updated_at)
+VALUES (:run_id, :modem_port, :phone_number, :iccid, :preferred_device, :device_serial, :state, :outcome,
+        :updated_at, :updated_at)
+ON CONFLICT (run_id, modem_port) DO UPDATE SET
+    phone_number = CASE WHEN excluded.phone_number != '' THEN excluded.phone_number ELSE tasks.phone_number END,
+    iccid = CASE WHEN excluded.iccid != '' THEN excluded.iccid ELSE tasks.iccid END,
+    preferred_device = CASE WHEN excluded.preferred_device != '' THEN excluded.preferred_device ELSE tasks.preferred_device END,
+    device_serial = CASE WHEN excluded.device_serial != '' THEN excluded.device_serial ELSE tasks.device_serial END,
+    state = excluded.state,
+    outcome = COALESCE(excluded.outcome, tasks.outcome),
+    updated_at = excluded.updated_at
+"""
+
+INSERT_OUTCOME = """
+INSERT INTO outcomes (run_id, phone_number, iccid, modem_port, device_serial, status, duration, stages, recorded_at)
+VALUES (:run_id, :phone_number, :iccid, :modem_port, :device_serial, :status, :duration, :stages, :recorded_at)
+"""
+
+
+def _now() -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S")
 
 
 class DBManager:
-    """Manejo sencillo de almacenamiento de resultados en CSV."""
+    """Manejo sencillo de almacenamiento de resultados en CSV (o SQLite si se indica `db_path`)."""
 
-    def __init__(self, results_path: Path) -> None:
+    def __init__(self, results_path: Path, db_path: Optional[Path] = None,
+                 batch_size: int = 50, run_id: Optional[str] = None) -> None:
         # Ruta donde se almacenarán los resultados
         self.results_path = results_path
         self.results_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.run_id = run_id or f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Escrituras pendientes: (sentencia, parámetros), en orden de llegada
+        self._pending: List[tuple] = []
+        if self.db_path:
+            self._init_schema()
+
+    # --- SQLite ---
+
+    def _connection(self) -> sqlite3.Connection:
+        """Una conexión por hilo; WAL permite lectores mientras otro proceso escribe."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self) -> None:
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection().executescript(SCHEMA)
+
+    def _queue(self, statement: str, params: Dict) -> None:
+        with self._lock:
+            self._pending.append((statement, params))
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """Vuelca las escrituras pendientes en una única transacción (BEGIN IMMEDIATE)."""
+        if not self.db_path:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        conn = self._connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for statement, params in pending:
+                conn.execute(statement, params)
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logger.error(f"Error al escribir {len(pending)} filas en {self.db_path}: {e}")
+            with self._lock:
+                self._pending[:0] = pending
+            raise
+
+    def close(self) -> None:
+        self.flush()
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def record_task(self, task: Dict[str, str], state: str, device_serial: str = "",
+                    outcome: Optional[str] = None) -> None:
+        """Registra (o actualiza) en el diario el estado de la tarea de un puerto en esta ejecución."""
+        if not self.db_path:
+            return
+        self._queue(UPSERT_TASK, {
+            "run_id": self.run_id,
+            "modem_port": task["modem_port"],
+            "phone_number": task.get("phone_number") or "",
+            "iccid": task.get("sim_number_icc_id") or "",
+            "preferred_device": task.get("preferred_device") or "",
+            "device_serial": device_serial,
+            "state": state,
+            "outcome": outcome,
+            "updated_at": _now(),
+        })
+
+    def latest_run_id(self) -> Optional[str]:
+        """Última ejecución registrada en el diario de tareas."""
+        self.flush()
+        row = self._connection().execute("SELECT run_id FROM tasks ORDER BY id DESC LIMIT 1").fetchone()
+        return row["run_id"] if row else None
+
+    def read_journal(self, run_id: Optional[str] = None) -> Dict[str, Dict[str, str]]:
+        """Diario de una ejecución: puerto -> fila de la tarea."""
+        self.flush()
+        rows = self._connection().execute("SELECT * FROM tasks WHERE run_id = ?", (run_id or self.run_id,))
+        return {row["modem_port"]: dict(row) for row in rows}
+
+    def completed_identifiers(self) -> Set[str]:
+        """ICCIDs y números que ya tienen un resultado concluyente en cualquier ejecución."""
+        self.flush()
+        placeholders = ",".join("?" for _ in FINAL_STATUSES)
+        rows = self._connection().execute(
+            f"SELECT phone_number, iccid FROM outcomes WHERE status IN ({placeholders})", FINAL_STATUSES
+        )
+        identifiers: Set[str] = set()
+        for row in rows:
+            identifiers.update(value for value in (row["phone_number"], row["iccid"]) if value)
+        return identifiers
+
+    def record_outcome(self, task: Dict[str, str], device_serial: str, status: str,
+                       duration: Optional[float] = None, stages: Optional[Dict[str, float]] = None) -> None:
+        """Guarda el resultado de un número procesado."""
+        if not self.db_path:
+            return
+        self._queue(INSERT_OUTCOME, {
+            "run_id": self.run_id,
+            "phone_number": task["phone_number"],
+            "iccid": task.get("sim_number_icc_id", ""),
+            "modem_port": task.get("modem_port", ""),
+            "device_serial": device_serial,
+            "status": status,
+            "duration": duration,
+            "stages": json.dumps(stages) if stages else None,
+            "recorded_at": _now(),
+        })
+
+    def read_outcomes(self, run_id: Optional[str] = None, after_id: int = 0) -> List[Dict[str, str]]:
+        """Resultados guardados (de `run_id` si se indica) con id mayor que `after_id`."""
+        self.flush()
+        query = "SELECT * FROM outcomes WHERE id > ?"
+        params: tuple = (after_id,)
+        if run_id:
+            query += " AND run_id = ?"
+            params += (run_id,)
+        return [dict(row) for row in self._connection().execute(query + " ORDER BY id", params)]
+
+    def last_outcome_id(self) -> int:
+        self.flush()
+        row = self._connection().execute("SELECT COALESCE(MAX(id), 0) AS last FROM outcomes").fetchone()
+        return row["last"]
+
+    def export_results(self, path: Optional[Path] = None, run_id: Optional[str] = None) -> Path:
+        """Escribe las SIMs en formato results.txt para los consumidores de siempre."""
+        path = path or self.results_path
+        rows = list(self.read_results(run_id))
+        with path.open("w", newline="") as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=RESULTS_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        return path
+
+    def export_status_files(self, directory: Path, run_id: Optional[str] = None, after_id: int = 0) -> Dict[str, int]:
+        """Añade los resultados a num_2fa.txt, num_no_2fa.txt... (phone,port,iccid,serial)."""
+        lines: Dict[str, List[str]] = {}
+        for outcome in self.read_outcomes(run_id or self.run_id, after_id):
+            file_name = STATUS_FILES.get(outcome["status"])
+            if file_name:
+                lines.setdefault(file_name, []).append(
+                    f"{outcome['phone_number']},{outcome['modem_port']},{outcome['iccid']},{outcome['device_serial']}\n"
+                )
+        for file_name, entries in lines.items():
+            with (directory / file_name).open("a", encoding="utf-8") as f:
+                f.writelines(entries)
+        return {file_name: len(entries) for file_name, entries in lines.items()}
+
+    # --- API de siempre ---
 
     def append_result(self, row: Dict[str, str]) -> None:
         """Append a row of data to the results CSV."""
+        if self.db_path:
+            self._queue(UPSERT_SIM, {
+                "phone_number": row["phone_number"],
+                "iccid": row.get("sim_number_icc_id", ""),
+                "modem_port": row.get("modem_port", ""),
+                "device_serial": row.get("device_serial", ""),
+                "updated_at": row.get("timestamp") or _now(),
+            })
+            return
         file_exists = self.results_path.exists()
         with self.results_path.open("a", newline="") as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=row.keys())
@@ -29,8 +314,23 @@ class DBManager:
                 writer.writeheader()
             writer.writerow(row)
 
-    def read_results(self) -> Iterable[Dict[str, str]]:
-        """Iterar sobre los resultados almacenados."""
+    def read_results(self, run_id: Optional[str] = None) -> Iterable[Dict[str, str]]:
+        """Iterar sobre los resultados almacenados (en SQLite, solo las SIMs de `run_id` si se indica)."""
+        if self.db_path:
+            self.flush()
+            query = "SELECT phone_number, device_serial, iccid, modem_port, updated_at FROM sims"
+            params: tuple = ()
+            if run_id:
+                query += " WHERE phone_number IN (SELECT phone_number FROM tasks WHERE run_id = ? AND phone_number != '')"
+                params = (run_id,)
+            rows = self._connection().execute(query + " ORDER BY modem_port", params)
+            for row in rows:
+                yield {
+                    "phone_number": row["phone_number"], "device_serial": row["device_serial"],
+                    "sim_number_icc_id": row["iccid"], "modem_port": row["modem_port"],
+                    "timestamp": row["updated_at"],
+                }
+            return
         if not self.results_path.exists():
             return []
         with self.results_path.open(newline="") as csvfile:
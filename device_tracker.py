@@ -0,0 +1,135 @@
+"""
+Hot-plug tracking of ADB devices and serial modems.
+
+Un hilo sigue el flujo host:track-devices del servidor adb (el servidor avisa
+en cuanto un teléfono aparece, desaparece o cambia de estado) y otro vigila
+los puertos serie: con pyudev despierta con cada evento 'tty' del kernel y,
+sin él, vuelve a listar los puertos cada `poll_interval` segundos. Los cambios
+se publican como DeviceEvent (attach/detach) a los suscriptores, que los
+reciben desde esos hilos y deben volver rápido.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional, Set
+
+import serial.tools.list_ports
+
+from adb_client import AdbClient, AdbError
+
+try:
+    import pyudev
+except ImportError:  # solo Linux; sin él se sondean los puertos periódicamente
+    pyudev = None
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class DeviceEvent:
+    kind: str  # "adb" o "serial"
+    action: str  # "attach" o "detach"
+    device: str  # serial adb o ruta del puerto
+
+
+class DeviceTracker:
+    """
+    Vigila los teléfonos de `adb_client` (None para no seguirlos) y los puertos
+    serie del sistema más `serial_ports`, rutas que no salen en list_ports
+    (p. ej. los pty de los módems simulados).
+    """
+
+    def __init__(self, adb_client: Optional[AdbClient] = None, serial_ports: Iterable[str] = (),
+                 track_serial: bool = True, poll_interval: float = 1.0) -> None:
+        self.adb_client = adb_client
+        self.track_serial = track_serial
+        self.watched_ports = set(serial_ports)
+        self.poll_interval = poll_interval
+        # Estado conocido: teléfonos en estado 'device' y puertos presentes
+        self.adb_devices: Set[str] = set()
+        self.serial_ports: Set[str] = set()
+        self._listeners: List[Callable[[DeviceEvent], None]] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def subscribe(self, listener: Callable[[DeviceEvent], None]) -> None:
+        self._listeners.append(listener)
+
+    def start(self) -> "DeviceTracker":
+        """Toma la foto inicial (sin emitir eventos) y arranca los hilos de seguimiento."""
+        if self.adb_client:
+            try:
+                self.adb_devices = {serial for serial, state in self.adb_client.devices() if state == "device"}
+            except AdbError as e:
+                logger.warning(f"Seguimiento adb sin estado inicial: {e}")
+            self._spawn(self._track_adb, "hotplug-adb")
+        if self.track_serial:
+            self.serial_ports = self._scan_serial()
+            self._spawn(self._track_serial, "hotplug-serial")
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=self.poll_interval + 1)
+
+    def _spawn(self, target: Callable[[], None], name: str) -> None:
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _update(self, kind: str, known: Set[str], current: Set[str]) -> None:
+        """Actualiza `known` con `current` y emite un evento por cada alta o baja."""
+        with self._lock:
+            attached, detached = current - known, known - current
+            known -= detached
+            known |= attached
+        for action, devices in (("detach", detached), ("attach", attached)):
+            for device in sorted(devices):
+                logger.info(f"Hot-plug: {kind} {device} {'conectado' if action == 'attach' else 'desconectado'}.")
+                self._emit(DeviceEvent(kind, action, device))
+
+    def _emit(self, event: DeviceEvent) -> None:
+        for listener in self._listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.error(f"Error al atender el evento {event}: {e}", exc_info=True)
+
+    def _track_adb(self) -> None:
+        backoff = self.poll_interval
+        while not self._stop.is_set():
+            try:
+                for entries in self.adb_client.track_devices(self._stop, self.poll_interval):
+                    backoff = self.poll_interval
+                    self._update("adb", self.adb_devices, {serial for serial, state in entries if state == "device"})
+            except (AdbError, OSError, ValueError) as e:
+                logger.debug(f"Seguimiento adb interrumpido: {e}. Reintentando en {backoff:.0f}s.")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def _scan_serial(self) -> Set[str]:
+        ports = {info.device for info in serial.tools.list_ports.comports()}
+        return ports | {port for port in self.watched_ports if os.path.exists(port)}
+
+    def _track_serial(self) -> None:
+        monitor = None
+        if pyudev is not None:
+            try:
+                monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+                monitor.filter_by("tty")
+                monitor.start()
+            except (OSError, ValueError) as e:
+                logger.debug(f"udev no disponible ({e}); se sondean los puertos cada {self.poll_interval}s.")
+                monitor = None
+        while not self._stop.is_set():
+            if monitor is not None:
+                # Cualquier evento tty adelanta el reescaneo; sin eventos se reescanea igualmente
+                monitor.poll(timeout=self.poll_interval)
+            else:
+                self._stop.wait(self.poll_interval)
+            self._update("serial", self.serial_ports, self._scan_serial())
@@ -0,0 +1,151 @@
+"""
+Long-lived UI worker: one Node process and one Appium session per device.
+
+Envuelve `node telegram_reader.js --serve <serial> <appium_port>`: los números
+se envían por stdin como JSON y cada resultado vuelve por stdout como una
+línea '@@EVENT {...}'. El resto de la salida del worker va al log del nodo.
+`prepare` adelanta la limpieza y navegación de la app antes de asignar el número.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from config import CODE_DIR
+
+logger = logging.getLogger(__name__)
+
+EVENT_PREFIX = "@@EVENT "
+
+
+class WorkerError(RuntimeError):
+    """El worker no arrancó, se cerró o no respondió a tiempo."""
+
+
+class DeviceWorker:
+    """Proceso Node persistente asociado a un dispositivo y a su servidor Appium."""
+
+    def __init__(self, device_serial: str, appium_port: int, log_file: Path,
+                 command: Optional[List[str]] = None, env: Optional[Dict[str, str]] = None,
+                 system_port: Optional[int] = None) -> None:
+        self.device_serial = device_serial
+        self.appium_port = appium_port
+        # Puerto local de UiAutomator2 (appium:systemPort); único por dispositivo en el mismo host
+        self.system_port = system_port
+        self.log_file = log_file
+        self.command = command or ["node", str(CODE_DIR / "telegram_reader.js")]
+        # Variables de entorno adicionales para el worker
+        self.env = env or {}
+        self._process: Optional[subprocess.Popen] = None
+        self._events: "queue.Queue[Optional[Dict]]" = queue.Queue()
+        self._reader: Optional[threading.Thread] = None
+
+    @property
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def start(self, ready_timeout: float = 120.0) -> None:
+        """Lanza el worker y espera a que su sesión Appium esté abierta."""
+        self.log_file.parent.mkdir(parents=True, exist_ok=True)
+        command = self.command + ["--serve", self.device_serial, str(self.appium_port)]
+        if self.system_port:
+            command.append(str(self.system_port))
+        self._events = queue.Queue()
+        self._process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, encoding="utf-8", errors="replace", bufsize=1,
+            env={**os.environ, **self.env} if self.env else None,
+        )
+        self._reader = threading.Thread(
+            target=self._read_output, name=f"worker-{self.device_serial}", daemon=True
+        )
+        self._reader.start()
+        event = self._next_event(ready_timeout)
+        if event.get("event") != "ready":
+            self.stop()
+            raise WorkerError(f"El worker de {self.device_serial} no quedó listo: {event}")
+        logger.info(f"Worker persistente listo en {self.device_serial} (Appium {self.appium_port}).")
+
+    def _read_output(self) -> None:
+        """Separa los eventos JSON del resto de la salida, que va al log del nodo."""
+        with open(self.log_file, "a", encoding="utf-8") as log:
+            for line in self._process.stdout:
+                if line.startswith(EVENT_PREFIX):
+                    try:
+                        self._events.put(json.loads(line[len(EVENT_PREFIX):]))
+                        continue
+                    except ValueError:
+                        pass
+                log.write(line)
+                log.flush()
+        self._events.put(None)
+
+    def _next_event(self, timeout: float) -> Dict:
+        try:
+            event = self._events.get(timeout=timeout)
+        except queue.Empty:
+            raise WorkerError(f"El worker de {self.device_serial} no respondió en {timeout:.0f}s.") from None
+        if event is None:
+            raise WorkerError(f"El worker de {self.device_serial} terminó inesperadamente.")
+        return event
+
+    def _send(self, message: Dict) -> None:
+        try:
+            self._process.stdin.write(json.dumps(message) + "\n")
+            self._process.stdin.flush()
+        except (OSError, ValueError) as e:
+            raise WorkerError(f"No se pudo escribir al worker de {self.device_serial}: {e}") from e
+
+    def prepare(self, timeout: float) -> Dict:
+        """Deja el dispositivo en la pantalla de número; devuelve el evento 'prepared'."""
+        if not self.is_alive:
+            raise WorkerError(f"El worker de {self.device_serial} no está en ejecución.")
+        self._send({"cmd": "prepare"})
+        deadline = time.monotonic() + timeout
+        while True:
+            event = self._next_event(max(0.0, deadline - time.monotonic()))
+            if event.get("event") == "prepared":
+                return event
+            logger.debug(f"Evento del worker {self.device_serial}: {event}")
+
+    def process(self, task: Dict[str, str], timeout: float,
+                on_event: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """Procesa un número y devuelve el evento 'result'; el resto de eventos van a `on_event`."""
+        if not self.is_alive:
+            raise WorkerError(f"El worker de {self.device_serial} no está en ejecución.")
+        phone_number = task["phone_number"]
+        self._send({
+            "cmd": "process",
+            "phoneNumber": phone_number,
+            "port": task.get("modem_port", ""),
+            "iccid": task.get("sim_number_icc_id", ""),
+        })
+        deadline = time.monotonic() + timeout
+        while True:
+            event = self._next_event(max(0.0, deadline - time.monotonic()))
+            if event.get("event") == "result" and event.get("phoneNumber") == phone_number:
+                return event
+            logger.debug(f"Evento del worker {self.device_serial}: {event}")
+            if on_event:
+                on_event(event)
+
+    def stop(self, timeout: float = 15.0) -> None:
+        """Pide un cierre ordenado (cierra la sesión Appium) y, si no responde, lo mata."""
+        if self._process is None:
+            return
+        if self.is_alive:
+            try:
+                self._send({"cmd": "shutdown"})
+                self._process.stdin.close()
+                self._process.wait(timeout=timeout)
+            except (WorkerError, OSError, subprocess.TimeoutExpired):
+                self._process.kill()
+                self._process.wait()
+        self._process = None
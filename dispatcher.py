@@ -0,0 +1,342 @@
+"""
+Queue-based dispatcher that decouples SIMs from devices.
+
+Las SIM pendientes viven en una cola compartida. Cada dispositivo libre toma
+primero las SIM que sim_list.txt le asigna y, cuando no le quedan, se lleva la
+más antigua del dispositivo con más trabajo pendiente. Un semáforo limita los
+workers activos a la vez y al final se resume el rendimiento por dispositivo.
+Un dispositivo que no puede arrancar su worker se retira y devuelve su tarea.
+
+La preparación del dispositivo (limpiar la app y llegar a la pantalla del
+número) se hace fuera del semáforo: mientras otros dispositivos esperan su
+SMS, el siguiente ya queda listo para recibir número en cuanto haya hueco.
+Antes de prepararse cada dispositivo reserva una tarea de la cola: al final de
+la ejecución no se preparan más dispositivos que tareas quedan.
+Cada etapa (slot, prep, submit, code_wait, verify) se contabiliza por separado.
+
+Los dispositivos pueden entrar y salir en caliente (device_tracker.py):
+`add_device` arranca (o reincorpora) un dispositivo durante la ejecución,
+`drain_device` lo retira tras su número en curso y `park`/`unpark` apartan y
+devuelven a la cola las tareas cuyo módem se ha desconectado.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Optional, Protocol, Set
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceUnavailable(RuntimeError):
+    """El dispositivo no puede seguir trabajando; su tarea vuelve a la cola."""
+
+
+# Etapas de cada número, en el orden del resumen final
+STAGES = ("slot", "prep", "submit", "code_wait", "verify")
+
+
+class DeviceRunner(Protocol):
+    """Ejecuta tareas en un dispositivo concreto (worker persistente o proceso por número)."""
+
+    def prepare(self) -> bool:
+        """Prepara el dispositivo para el próximo número; False si no se pudo o no aplica."""
+        ...
+
+    def process(self, task: Dict) -> Dict:
+        """Procesa un número; devuelve {'status': ..., 'stages': {etapa: segundos}}."""
+        ...
+
+    def close(self) -> None: ...
+
+
+@dataclass
+class DeviceStats:
+    serial: str
+    processed: int = 0
+    # Tareas cuya SIM estaba asignada a otro dispositivo
+    borrowed: int = 0
+    busy_seconds: float = 0.0
+    statuses: Counter = field(default_factory=Counter)
+    stage_seconds: Counter = field(default_factory=Counter)
+
+
+class TaskDispatcher:
+    """Reparte las tareas pendientes entre los dispositivos a medida que quedan libres."""
+
+    def __init__(self, tasks: List[Dict], max_workers: int = 0,
+                 on_result: Optional[Callable[[str, Dict, Dict, float], None]] = None,
+                 on_dispatch: Optional[Callable[[str, Dict], None]] = None) -> None:
+        self._pending: Deque[Dict] = deque(tasks)
+        self._lock = threading.Lock()
+        self.max_workers = max_workers
+        # Se llama con (dispositivo, tarea, resultado, segundos) tras cada número
+        self.on_result = on_result
+        # Se llama con (dispositivo, tarea) justo antes de entregar la tarea al dispositivo
+        self.on_dispatch = on_dispatch
+        self.stats: Dict[str, DeviceStats] = {}
+        # Tareas apartadas (módem desconectado) hasta que `unpark` las devuelva a la cola
+        self._parked: List[Dict] = []
+        # Dispositivos conocidos, sus hilos y los que no deben volver a arrancar hasta `add_device`
+        self._devices: Dict[str, Dict] = {}
+        self._threads: Dict[str, threading.Thread] = {}
+        self._stopped: Set[str] = set()
+        self._make_runner: Optional[Callable[[Dict], DeviceRunner]] = None
+        self._slots: Optional[threading.BoundedSemaphore] = None
+        # Cambios en los hilos de dispositivo (altas y reanudaciones), para run()
+        self._changed = threading.Condition()
+        self._generation = 0
+        # Dispositivos preparándose o preparados que aún no han tomado su tarea
+        self._claims = 0
+
+    def next_task(self, device_serial: str) -> Optional[Dict]:
+        """Siguiente tarea para `device_serial`: primero las suyas, si no la del más cargado."""
+        with self._lock:
+            if not self._pending:
+                return None
+            for task in self._pending:
+                if task.get("preferred_device") == device_serial:
+                    self._pending.remove(task)
+                    return task
+
+            backlog = Counter(task.get("preferred_device") for task in self._pending)
+            busiest = backlog.most_common(1)[0][0]
+            for task in self._pending:
+                if task.get("preferred_device") == busiest:
+                    self._pending.remove(task)
+                    return task
+        return None
+
+    def requeue(self, task: Dict) -> None:
+        with self._lock:
+            self._pending.appendleft(task)
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    @property
+    def parked(self) -> int:
+        with self._lock:
+            return len(self._parked)
+
+    def tasks(self, parked: bool = False) -> List[Dict]:
+        """Copia de las tareas en cola (o de las apartadas)."""
+        with self._lock:
+            return list(self._parked if parked else self._pending)
+
+    def park(self, predicate: Callable[[Dict], bool]) -> int:
+        """Aparta de la cola las tareas que cumplen `predicate`; devuelve cuántas."""
+        with self._lock:
+            matching = [task for task in self._pending if predicate(task)]
+            for task in matching:
+                self._pending.remove(task)
+            self._parked.extend(matching)
+        return len(matching)
+
+    def unpark(self, predicate: Callable[[Dict], bool]) -> int:
+        """Devuelve a la cola las tareas apartadas que cumplen `predicate` y reanuda los dispositivos ociosos."""
+        with self._lock:
+            matching = [task for task in self._parked if predicate(task)]
+            for task in matching:
+                self._parked.remove(task)
+            self._pending.extendleft(reversed(matching))
+        if matching:
+            self._resume_devices()
+        return len(matching)
+
+    def add_device(self, device: Dict) -> bool:
+        """Incorpora un dispositivo (nuevo o reconectado) a la ejecución; False si ya estaba trabajando."""
+        with self._changed:
+            self._devices[device["serial"]] = device
+            self._stopped.discard(device["serial"])
+        return self._start_device(device["serial"])
+
+    def drain_device(self, device_serial: str) -> None:
+        """El dispositivo termina su número en curso y no toma más tareas."""
+        with self._changed:
+            self._stopped.add(device_serial)
+
+    def _resume_devices(self) -> None:
+        """Reanuda los dispositivos ociosos (sin hilo activo) que no se han retirado."""
+        for serial in list(self._devices):
+            self._start_device(serial)
+
+    def _claim(self) -> bool:
+        """Reserva una tarea para un dispositivo que va a prepararse; False si todas están reservadas."""
+        pending = self.pending
+        with self._lock:
+            if pending <= self._claims:
+                return False
+            self._claims += 1
+            return True
+
+    def _release_claim(self) -> None:
+        with self._lock:
+            self._claims -= 1
+
+    def _start_device(self, serial: str) -> bool:
+        with self._changed:
+            thread = self._threads.get(serial)
+            if self._make_runner is None or serial in self._stopped or (thread and thread.is_alive()):
+                return False
+            thread = threading.Thread(target=self._device_loop,
+                                      args=(self._devices[serial], self._make_runner, self._slots),
+                                      name=f"device-{serial}")
+            self._threads[serial] = thread
+            thread.start()
+            self._generation += 1
+            self._changed.notify_all()
+        return True
+
+    def record(self, device_serial: str, task: Dict, status: str, elapsed: float,
+               stages: Optional[Dict[str, float]] = None) -> None:
+        with self._lock:
+            stats = self.stats.setdefault(device_serial, DeviceStats(device_serial))
+            stats.processed += 1
+            stats.busy_seconds += elapsed
+            stats.statuses[status] += 1
+            stats.stage_seconds.update(stages or {})
+            if task.get("preferred_device") != device_serial:
+                stats.borrowed += 1
+
+    def record_stage(self, device_serial: str, stage: str, seconds: float) -> None:
+        with self._lock:
+            stats = self.stats.setdefault(device_serial, DeviceStats(device_serial))
+            stats.stage_seconds[stage] += seconds
+
+    def run(self, devices: List[Dict], make_runner: Callable[[Dict], DeviceRunner],
+            device_wait: float = 0.0) -> float:
+        """
+        Lanza un hilo por dispositivo y espera a que la cola se vacíe. Si no queda
+        ningún dispositivo trabajando pero sí tareas, espera hasta `device_wait`
+        segundos a que se incorpore o reanude alguno. Devuelve el tiempo total.
+        """
+        self._slots = threading.BoundedSemaphore(self.max_workers) if self.max_workers > 0 else None
+        self._make_runner = make_runner
+        started = time.monotonic()
+        for device in devices:
+            self.add_device(device)
+        while True:
+            with self._changed:
+                threads = list(self._threads.values())
+                generation = self._generation
+            for thread in threads:
+                thread.join()
+            with self._changed:
+                # Un dispositivo que salió justo cuando volvían tareas a la cola se reanuda aquí
+                if self.pending:
+                    self._resume_devices()
+                if self._generation != generation:
+                    continue
+                remaining = self.pending + self.parked
+                if not remaining or device_wait <= 0:
+                    break
+                logger.warning(f"No queda ningún dispositivo activo y faltan {remaining} tareas; "
+                               f"esperando hasta {device_wait:.0f}s a que vuelva alguno.")
+                if not self._changed.wait_for(lambda: self._generation != generation, device_wait):
+                    break
+        self._make_runner = None
+        if self.pending:
+            logger.error(f"Quedaron {self.pending} tareas sin procesar: no hay dispositivos disponibles.")
+        if self.parked:
+            logger.error(f"Quedaron {self.parked} tareas sin procesar: su módem no volvió a conectarse.")
+        return time.monotonic() - started
+
+    def _device_loop(self, device: Dict, make_runner: Callable[[Dict], DeviceRunner],
+                     slots: Optional[threading.BoundedSemaphore]) -> None:
+        serial = device["serial"]
+        self.stats.setdefault(serial, DeviceStats(serial))
+        runner = make_runner(device)
+        claimed = False
+        try:
+            while self.pending and serial not in self._stopped:
+                # Sin tarea que reservar no se prepara: otro dispositivo ya preparado la tomará
+                if not self._claim():
+                    return
+                claimed = True
+                # Etapa de preparación, fuera del límite de workers concurrentes
+                started = time.monotonic()
+                try:
+                    if runner.prepare():
+                        self.record_stage(serial, "prep", time.monotonic() - started)
+                except DeviceUnavailable as e:
+                    logger.error(f"{e} Se retira {serial}.")
+                    self.drain_device(serial)
+                    self._release_claim()
+                    claimed = False
+                    # Su reserva queda libre: un dispositivo ocioso puede prepararse para ella
+                    self._resume_devices()
+                    return
+
+                started = time.monotonic()
+                if slots:
+                    slots.acquire()
+                self.record_stage(serial, "slot", time.monotonic() - started)
+                try:
+                    task = self.next_task(serial) if serial not in self._stopped else None
+                    self._release_claim()
+                    claimed = False
+                    if task is None:
+                        return
+                    if task.get("preferred_device") != serial:
+                        logger.info(f"{serial} toma {task['phone_number']} (asignada a {task.get('preferred_device')}).")
+                    if self.on_dispatch:
+                        self._notify(self.on_dispatch, serial, task)
+                    task_started = time.monotonic()
+                    try:
+                        outcome = runner.process(task)
+                    except DeviceUnavailable as e:
+                        logger.error(f"{e} Se retira {serial} y {task['phone_number']} vuelve a la cola.")
+                        self.requeue(task)
+                        self.drain_device(serial)
+                        self._resume_devices()
+                        return
+                    except Exception as e:
+                        logger.error(f"Error al procesar {task['phone_number']} en {serial}: {e}", exc_info=True)
+                        outcome = {"status": "ERROR"}
+                    elapsed = time.monotonic() - task_started
+                    self.record(serial, task, outcome.get("status", "UNKNOWN"), elapsed, outcome.get("stages"))
+                    if self.on_result:
+                        self._notify(self.on_result, serial, task, outcome, elapsed)
+                finally:
+                    if slots:
+                        slots.release()
+        finally:
+            if claimed:
+                self._release_claim()
+            runner.close()
+
+    @staticmethod
+    def _notify(callback: Callable, serial: str, task: Dict, *args) -> None:
+        try:
+            callback(serial, task, *args)
+        except Exception as e:
+            logger.error(f"Error al registrar {task['phone_number']} de {serial}: {e}", exc_info=True)
+
+    def summary_lines(self, wall_seconds: float) -> List[str]:
+        """Resumen de rendimiento por dispositivo y tiempo medio por etapa, para el log final."""
+        stage_header = " ".join(f"{stage:>9}" for stage in STAGES)
+        lines = [f"{'Dispositivo':<20} {'Números':>7} {'Prestadas':>9} {'Núm/h':>7} {'Media(s)':>8} {stage_header}  Estados"]
+        hours = wall_seconds / 3600 if wall_seconds > 0 else 0
+        totals: Counter = Counter()
+        for serial, stats in sorted(self.stats.items()):
+            per_hour = stats.processed / hours if hours else 0.0
+            average = stats.busy_seconds / stats.processed if stats.processed else 0.0
+            stages = " ".join(
+                f"{stats.stage_seconds[stage] / stats.processed if stats.processed else 0.0:>9.1f}" for stage in STAGES
+            )
+            statuses = ", ".join(f"{status}={count}" for status, count in stats.statuses.most_common())
+            lines.append(
+                f"{serial:<20} {stats.processed:>7} {stats.borrowed:>9} {per_hour:>7.1f} {average:>8.1f} {stages}  {statuses}"
+            )
+            totals.update(stats.stage_seconds)
+        total = sum(totals.values())
+        if total:
+            shares = ", ".join(f"{stage}={totals[stage]:.0f}s ({totals[stage] / total:.0%})" for stage in STAGES)
+            lines.append(f"Tiempo acumulado por etapa: {shares}")
+        return lines
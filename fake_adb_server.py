@@ -0,0 +1,169 @@
+"""
+Fake adb server for testing without phones.
+
+Implementa el subconjunto del protocolo del servidor adb que usa la granja
+(host:version, host:devices, host:track-devices, host:transport:<serial>,
+shell:<cmd>) y guarda los comandos recibidos. Las respuestas de shell se
+pueden fijar por prefijo; `set_device` simula que un teléfono se conecta o
+se desconecta.
+
+    python fake_adb_server.py --port 5037 --devices DEVICE_SERIAL_01 DEVICE_SERIAL_02
+"""
+from __future__ import annotations
+
+import argparse
+import logging
+import socketserver
+import threading
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ADB_SERVER_VERSION = 41
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    server: "FakeAdbServer"
+
+    def _read_request(self) -> Optional[str]:
+        header = self._recv(4)
+        if header is None:
+            return None
+        body = self._recv(int(header, 16))
+        return body.decode("utf-8") if body is not None else None
+
+    def _recv(self, size: int) -> Optional[bytes]:
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return bytes(data)
+
+    def _okay(self, payload: Optional[str] = None) -> None:
+        message = b"OKAY"
+        if payload is not None:
+            encoded = payload.encode("utf-8")
+            message += f"{len(encoded):04x}".encode("ascii") + encoded
+        self.request.sendall(message)
+
+    def _fail(self, reason: str) -> None:
+        encoded = reason.encode("utf-8")
+        self.request.sendall(b"FAIL" + f"{len(encoded):04x}".encode("ascii") + encoded)
+
+    def _track_devices(self) -> None:
+        """Envía la lista de dispositivos al conectar y después en cada cambio."""
+        self.request.sendall(b"OKAY")
+        version = -1
+        while True:
+            with self.server.changed:
+                self.server.changed.wait_for(lambda: self.server.version != version, timeout=0.5)
+                if self.server.version == version:
+                    continue
+                version = self.server.version
+                payload = self.server.device_list().encode("utf-8")
+            try:
+                self.request.sendall(f"{len(payload):04x}".encode("ascii") + payload)
+            except OSError:
+                return
+
+    def handle(self) -> None:
+        serial = None
+        while True:
+            service = self._read_request()
+            if service is None:
+                return
+            if service == "host:version":
+                self._okay(f"{ADB_SERVER_VERSION:04x}")
+                return
+            if service == "host:devices":
+                self._okay(self.server.device_list())
+                return
+            if service == "host:track-devices":
+                self._track_devices()
+                return
+            if service.startswith("host:transport:"):
+                serial = service[len("host:transport:"):]
+                if self.server.devices.get(serial) != "device":
+                    self._fail(f"device '{serial}' not found")
+                    return
+                self._okay()
+                continue
+            if service.startswith("shell:") and serial:
+                command = service[len("shell:"):]
+                self.server.record(serial, command)
+                self._okay()
+                self.request.sendall(self.server.reply_for(command).encode("utf-8"))
+                return
+            self._fail(f"unknown host service '{service}'")
+            return
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    """Servidor adb falso en un hilo propio; `commands` guarda (serial, comando)."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, devices: Optional[List[str]] = None) -> None:
+        super().__init__((host, port), _Handler)
+        self.devices: Dict[str, str] = {serial: "device" for serial in devices or []}
+        self.replies: Dict[str, str] = {}
+        self.commands: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+        # Se incrementa en cada cambio de `devices` y despierta a los host:track-devices
+        self.version = 0
+        self.changed = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def device_list(self) -> str:
+        return "".join(f"{serial}\t{state}\n" for serial, state in list(self.devices.items()))
+
+    def set_device(self, serial: str, state: Optional[str] = "device") -> None:
+        """Conecta (o cambia de estado) un dispositivo; con `state` None lo desconecta."""
+        with self.changed:
+            if state is None:
+                self.devices.pop(serial, None)
+            else:
+                self.devices[serial] = state
+            self.version += 1
+            self.changed.notify_all()
+
+    def record(self, serial: str, command: str) -> None:
+        with self._lock:
+            self.commands.append((serial, command))
+        logger.debug(f"[fake adb] {serial}: {command}")
+
+    def reply_for(self, command: str) -> str:
+        for prefix, reply in self.replies.items():
+            if command.startswith(prefix):
+                return reply
+        return ""
+
+    def start(self) -> "FakeAdbServer":
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-adb", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor adb falso para pruebas sin teléfonos.")
+    parser.add_argument("--port", type=int, default=5037)
+    parser.add_argument("--devices", nargs="*", default=["DEVICE_SERIAL_01"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG, format="%(asctime)s %(message)s")
+    server = FakeAdbServer(port=args.port, devices=args.devices)
+    print(f"Servidor adb falso en 127.0.0.1:{server.port} con {len(server.devices)} dispositivos.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
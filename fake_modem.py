@@ -0,0 +1,303 @@
+"""
+Fake AT modems on pseudo-terminals for running the farm without hardware.
+
+Cada FakeModem abre un pty y atiende en su extremo maestro el subconjunto de
+comandos AT que usa la granja (AT, ATE0, AT+CMGF, AT+CNMI, AT+CCID, AT+CNUM,
+AT+CPBR, AT+CMGL, AT+CMGR, AT+CMGD) en modo texto, con latencia configurable.
+`port` es la ruta del extremo esclavo (/dev/pts/N), que se abre con pyserial
+como un módem real. `inject_sms` guarda un SMS y, si el módem tiene las
+notificaciones activas (AT+CNMI), emite el URC +CMTI.
+
+SmsGateway hace de "red": un worker simulado le pide por TCP/JSON que envíe el
+SMS con el código a un número y lo inyecta en su módem tras `delivery_delay`.
+
+    python fake_modem.py --count 4 --gateway-port 8790
+
+Solo funciona en sistemas POSIX (os.openpty).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import select
+import socketserver
+import threading
+import time
+import tty
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CMGL_STATUSES = {"ALL": None, "REC UNREAD": "REC UNREAD", "REC READ": "REC READ"}
+COMMAND_PATTERN = re.compile(r'^AT(?P<name>[+&]?[A-Z]*)(?P<args>.*)$', re.IGNORECASE)
+
+
+class FakeModem:
+    """Módem AT simulado sobre un pty; `latency` (segundos) se aplica a cada respuesta."""
+
+    def __init__(self, iccid: str, phone_number: Optional[str], latency: float = 0.0,
+                 latencies: Optional[Dict[str, float]] = None, capacity: int = 50) -> None:
+        self.iccid = iccid
+        self.phone_number = phone_number
+        self.latency = latency
+        # Latencia por comando (p. ej. {"+CMGL": 0.5}); el resto usa `latency`
+        self.latencies = {name.upper(): value for name, value in (latencies or {}).items()}
+        self.capacity = capacity
+        self.text_mode = True
+        self.indications = False
+        # Índice -> (estado, remitente, marca de tiempo, texto)
+        self.messages: Dict[int, Tuple[str, str, str, str]] = {}
+        self.commands: List[str] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._master, self._slave = os.openpty()
+        # Sin eco ni edición de línea hasta que pyserial configure el puerto
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "FakeModem":
+        self._thread = threading.Thread(target=self._serve, name=f"fake-modem-{self.port}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _serve(self) -> None:
+        buffer = b""
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                chunk = os.read(self._master, 4096)
+            except OSError:
+                # EIO mientras nadie tiene abierto el esclavo
+                time.sleep(0.05)
+                continue
+            buffer += chunk
+            while b"\r" in buffer:
+                line, buffer = buffer.split(b"\r", 1)
+                command = line.decode("utf-8", errors="ignore").strip()
+                if command:
+                    self._respond(command)
+
+    def _write(self, text: str) -> None:
+        data = text.encode("utf-8")
+        with self._write_lock:
+            while data:
+                try:
+                    written = os.write(self._master, data)
+                except OSError:
+                    return
+                data = data[written:]
+
+    def _respond(self, command: str) -> None:
+        self.commands.append(command)
+        match = COMMAND_PATTERN.match(command)
+        name = match.group("name").upper() if match else ""
+        delay = self.latencies.get(name, self.latency)
+        if delay:
+            time.sleep(delay)
+        try:
+            lines = self.execute(name, match.group("args") if match else "") if match else None
+        except ValueError:
+            lines = None
+        if lines is None:
+            self._write("\r\nERROR\r\n")
+        else:
+            self._write("".join(f"\r\n{line}" for line in lines) + ("\r\n" if lines else "") + "\r\nOK\r\n")
+
+    def execute(self, name: str, args: str) -> Optional[List[str]]:
+        """Líneas de respuesta del comando (sin el OK final); None para responder ERROR."""
+        if name in ("", "E0", "E1", "E", "Z", "&F"):
+            return []
+        if name == "+CMGF":
+            # Solo se simula el modo texto
+            self.text_mode = args.strip("=") == "1"
+            return [] if self.text_mode else None
+        if name == "+CNMI":
+            fields = args.strip("=").split(",")
+            self.indications = len(fields) > 1 and fields[1].strip() == "1"
+            return []
+        if name == "+CCID":
+            return [f"+CCID: {self.iccid}"]
+        if name == "+CNUM":
+            return [f'+CNUM: "","{self.phone_number}",145'] if self.phone_number else []
+        if name == "+CPBR":
+            return [f'+CPBR: 1,"{self.phone_number}",145,"Own"'] if self.phone_number else []
+        if name == "+CMGL":
+            return self._list(args.strip("=").strip('"').upper())
+        if name == "+CMGR":
+            return self._read(int(args.strip("=")))
+        if name == "+CMGD":
+            return self._delete(args.strip("="))
+        return None
+
+    def _list(self, status: str) -> List[str]:
+        if status not in CMGL_STATUSES:
+            raise ValueError(status)
+        wanted = CMGL_STATUSES[status]
+        lines = []
+        with self._lock:
+            for index in sorted(self.messages):
+                stat, sender, timestamp, text = self.messages[index]
+                if wanted and stat != wanted:
+                    continue
+                lines += [f'+CMGL: {index},"{stat}","{sender}",,"{timestamp}"', text]
+                self.messages[index] = ("REC READ", sender, timestamp, text)
+        return lines
+
+    def _read(self, index: int) -> List[str]:
+        with self._lock:
+            if index not in self.messages:
+                return []
+            stat, sender, timestamp, text = self.messages[index]
+            self.messages[index] = ("REC READ", sender, timestamp, text)
+        return [f'+CMGR: "{stat}","{sender}",,"{timestamp}"', text]
+
+    def _delete(self, args: str) -> List[str]:
+        with self._lock:
+            if args == "?":
+                # Como los módems reales: posiciones válidas de la memoria, no las ocupadas
+                return [f"+CMGD: (1-{self.capacity}),(0-4)"]
+            index, _, flag = args.partition(",")
+            flag = int(flag or 0)
+            if flag == 0:
+                self.messages.pop(int(index), None)
+            elif flag == 4:
+                self.messages.clear()
+            else:
+                # 1: leídos; 2/3: leídos y enviados (aquí no hay enviados)
+                for i in [i for i, message in self.messages.items() if message[0] == "REC READ"]:
+                    del self.messages[i]
+        return []
+
+    def inject_sms(self, text: str, sender: str = "Telegram") -> Optional[int]:
+        """Guarda un SMS recibido y emite +CMTI si procede; None si la memoria está llena."""
+        with self._lock:
+            index = next((i for i in range(1, self.capacity + 1) if i not in self.messages), None)
+            if index is None:
+                logger.warning(f"[fake modem] Memoria llena en {self.port}; SMS descartado.")
+                return None
+            timestamp = time.strftime("%y/%m/%d,%H:%M:%S+00", time.gmtime())
+            self.messages[index] = ("REC UNREAD", sender, timestamp, text)
+        if self.indications:
+            self._write(f'\r\n+CMTI: "SM",{index}\r\n')
+        return index
+
+
+class _GatewayHandler(socketserver.StreamRequestHandler):
+    server: "SmsGateway"
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                reply = self.server.handle_request_message(request)
+            except (ValueError, AttributeError) as e:
+                reply = {"event": "error", "message": str(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+
+
+class SmsGateway(socketserver.ThreadingTCPServer):
+    """
+    Red móvil simulada. Peticiones JSON por líneas:
+        {"op": "send", "phone": "+34..."}      -> envía un código a ese número
+        {"op": "received", "phone": "+34..."}  -> el worker ya tiene el código
+    `latencies` guarda, por código entregado, los segundos entre la llegada del
+    SMS al módem y su recepción en el worker.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, modems: Iterable[FakeModem], host: str = "127.0.0.1", port: int = 0,
+                 delivery_delay: float = 1.0, jitter: float = 0.0) -> None:
+        super().__init__((host, port), _GatewayHandler)
+        self.modems = {modem.phone_number: modem for modem in modems}
+        self.delivery_delay = delivery_delay
+        self.jitter = jitter
+        self.latencies: List[float] = []
+        self._delivered_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def handle_request_message(self, request: Dict) -> Dict:
+        op, phone = request.get("op"), str(request.get("phone", ""))
+        if op == "send":
+            modem = self.modems.get(phone)
+            if modem is None:
+                return {"event": "error", "message": f"número desconocido {phone}"}
+            code = f"{random.randint(0, 99999):05d}"
+            delay = self.delivery_delay + random.uniform(0, self.jitter)
+            threading.Timer(delay, self._deliver, (modem, phone, code)).start()
+            return {"event": "ok"}
+        if op == "received":
+            with self._lock:
+                delivered_at = self._delivered_at.pop(phone, None)
+                if delivered_at is not None:
+                    self.latencies.append(time.time() - delivered_at)
+            return {"event": "ok"}
+        return {"event": "error", "message": f"operación desconocida {op}"}
+
+    def _deliver(self, modem: FakeModem, phone: str, code: str) -> None:
+        with self._lock:
+            self._delivered_at[phone] = time.time()
+        modem.inject_sms(f"Telegram code: {code}. Do not give this code to anyone.")
+
+    def start(self) -> "SmsGateway":
+        self._thread = threading.Thread(target=self.serve_forever, name="sms-gateway", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def create_modems(count: int, latency: float = 0.0, first_number: int = 34600000001) -> List[FakeModem]:
+    """`count` módems arrancados, con ICCID y número consecutivos."""
+    return [
+        FakeModem(f"8934{i:016d}", f"+{first_number + i}", latency).start()
+        for i in range(count)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Módems AT simulados sobre pty y red SMS falsa.")
+    parser.add_argument("--count", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.02, help="Latencia de cada respuesta AT (s).")
+    parser.add_argument("--gateway-port", type=int, default=8790)
+    parser.add_argument("--delivery-delay", type=float, default=2.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    modems = create_modems(args.count, args.latency)
+    gateway = SmsGateway(modems, port=args.gateway_port, delivery_delay=args.delivery_delay).start()
+    for modem in modems:
+        print(f"{modem.port}\t{modem.iccid}\t{modem.phone_number}")
+    print(f"Red SMS falsa en 127.0.0.1:{gateway.port}. Ctrl+C para terminar.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        gateway.stop()
+        for modem in modems:
+            modem.stop()
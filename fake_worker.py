@@ -0,0 +1,159 @@
+"""
+Stand-in for `node telegram_reader.js --serve` (and its Appium session).
+
+Habla el mismo protocolo que DeviceWorker espera (JSON por stdin, eventos
+'@@EVENT {...}' por stdout) pero sustituye la UI por pausas configurables:
+al "enviar" el número pide a la red SMS simulada (fake_modem.SmsGateway) que
+mande el código, espera a recibirlo del broker como el worker real y lo
+"teclea". Sirve para medir la granja completa sin teléfonos (bench_farm.py).
+
+Variables de entorno:
+    FAKE_SMS_GATEWAY     host:puerto de la red SMS simulada
+    FAKE_UI_LATENCY      segundos de cada etapa de UI (submit, verify...)
+    FAKE_CLEAR_LATENCY   segundos de la limpieza de la app
+    FAKE_READY_LATENCY   segundos hasta abrir la "sesión Appium"
+"""
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+EVENT_PREFIX = "@@EVENT "
+FARM_HOME = Path(os.environ.get("FARM_HOME") or Path(__file__).resolve().parent)
+CODE_BROKER = (os.environ.get("CODE_BROKER_HOST", "127.0.0.1"), int(os.environ.get("CODE_BROKER_PORT", 8765)))
+CODE_WAIT_TIMEOUT = int(os.environ.get("CODE_WAIT_TIMEOUT_MS", 180000)) / 1000
+UI_LATENCY = float(os.environ.get("FAKE_UI_LATENCY", 0.5))
+CLEAR_LATENCY = float(os.environ.get("FAKE_CLEAR_LATENCY", 0.3))
+READY_LATENCY = float(os.environ.get("FAKE_READY_LATENCY", 0.5))
+
+
+def emit(event: Dict) -> None:
+    sys.stdout.write(EVENT_PREFIX + json.dumps(event) + "\n")
+    sys.stdout.flush()
+
+
+def request_sms(phone_number: str, op: str = "send") -> None:
+    """Avisa a la red simulada (envío del código o código recibido)."""
+    address = os.environ.get("FAKE_SMS_GATEWAY")
+    if not address:
+        return
+    host, _, port = address.rpartition(":")
+    try:
+        with socket.create_connection((host, int(port)), timeout=5) as sock:
+            sock.sendall((json.dumps({"op": op, "phone": phone_number}) + "\n").encode("utf-8"))
+            sock.makefile().readline()
+    except OSError as e:
+        print(f"[ERROR][{phone_number}] Red SMS simulada no disponible: {e}", flush=True)
+
+
+def wait_for_code(phone_number: str, since: float) -> Optional[Tuple[str, float]]:
+    """
+    Código y momento de publicación (epoch): por el broker o sondeando
+    numerosNode/<número>.txt. Se ignoran los códigos anteriores a `since`.
+    """
+    try:
+        with socket.create_connection(CODE_BROKER, timeout=5) as sock:
+            sock.settimeout(CODE_WAIT_TIMEOUT + 5)
+            sock.sendall((json.dumps({"op": "subscribe", "phone": phone_number, "timeout": CODE_WAIT_TIMEOUT,
+                                     "since": since}) + "\n").encode("utf-8"))
+            line = sock.makefile(encoding="utf-8").readline()
+        message = json.loads(line) if line else {}
+        if message.get("event") == "code":
+            return str(message["code"]), float(message.get("published_at") or time.time())
+        return None
+    except (OSError, ValueError):
+        pass
+    code_file = FARM_HOME / "numerosNode" / f"{phone_number}.txt"
+    deadline = time.monotonic() + CODE_WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            code = code_file.read_text(encoding="utf-8").strip()
+            written_at = code_file.stat().st_mtime if code else 0.0
+            if code and written_at >= since:
+                return code, written_at
+        except OSError:
+            pass
+        time.sleep(0.5)
+    return None
+
+
+def prepare(timings: Dict[str, int]) -> bool:
+    started = time.monotonic()
+    time.sleep(CLEAR_LATENCY)
+    timings["pmClear"] = int((time.monotonic() - started) * 1000)
+    time.sleep(UI_LATENCY)
+    return True
+
+
+def process_number(phone_number: str, prepared: bool, timings: Dict[str, int], device_serial: str) -> str:
+    stage_start = time.monotonic()
+
+    def end_stage(stage: str) -> None:
+        nonlocal stage_start
+        now = time.monotonic()
+        timings[stage] = timings.get(stage, 0) + int((now - stage_start) * 1000)
+        stage_start = now
+
+    if not prepared:
+        prepare(timings)
+        end_stage("prep")
+    time.sleep(UI_LATENCY)
+    submitted_at = time.time()
+    request_sms(phone_number)
+    end_stage("submit")
+    emit({"event": "awaiting_code", "phoneNumber": phone_number, "deviceSerial": device_serial})
+    received = wait_for_code(phone_number, submitted_at)
+    end_stage("codeWait")
+    if not received:
+        end_stage("verify")
+        return "UNKNOWN"
+    request_sms(phone_number, "received")
+    timings["codeTyped"] = max(0, int((time.time() - received[1]) * 1000))
+    time.sleep(UI_LATENCY)
+    end_stage("verify")
+    return "NO_2FA"
+
+
+def serve(device_serial: str) -> None:
+    time.sleep(READY_LATENCY)
+    emit({"event": "ready", "deviceSerial": device_serial})
+    prepared = False
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            emit({"event": "error", "deviceSerial": device_serial, "message": f"JSON inválido: {e}"})
+            continue
+        if request.get("cmd") == "shutdown":
+            break
+        if request.get("cmd") == "prepare":
+            started = time.monotonic()
+            timings: Dict[str, int] = {}
+            prepared = prepare(timings)
+            emit({"event": "prepared", "deviceSerial": device_serial, "ok": prepared,
+                  "durationMs": int((time.monotonic() - started) * 1000), "timings": timings})
+            continue
+        if request.get("cmd") != "process" or not request.get("phoneNumber"):
+            emit({"event": "error", "deviceSerial": device_serial, "message": f"Petición no soportada: {line.strip()}"})
+            continue
+        phone_number = request["phoneNumber"]
+        started = time.monotonic()
+        timings = {}
+        status = process_number(phone_number, prepared, timings, device_serial)
+        prepared = False
+        print(f"[INFO][{phone_number}] {status} en {device_serial}", flush=True)
+        emit({"event": "result", "phoneNumber": phone_number, "deviceSerial": device_serial, "status": status,
+              "durationMs": int((time.monotonic() - started) * 1000), "timings": timings})
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "--serve":
+        sys.exit("Uso: python fake_worker.py --serve <deviceSerial> <appiumPort> [systemPort]")
+    serve(sys.argv[2])
@@ -0,0 +1,308 @@
+"""
+Agent of a multi-host farm: runs the modems, SMS monitor and workers of one USB host.
+
+Hace las fases 1 a 3 de main.py con el hardware local (servicio de módems,
+tareas de su inventory.json y monitorización de SMS) y entrega sus tareas al
+coordinador (farm_coordinator.py). En la fase 4 los teléfonos locales piden
+cada número al coordinador y le envían el estado y el resultado; el
+coordinador guarda el diario y los resultados de toda la granja. Los
+servidores Appium del host se arrancan como siempre con servidorFarm.py.
+
+Cada agente usa su propio FARM_HOME (inventario, settings.json, farm.db local
+y sms.txt); para probar varios en una sola máquina basta con darles FARM_HOME,
+nombre y puertos distintos:
+
+    python farm_agent.py --coordinator 10.0.0.5:8770 --name host-a
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import socket
+import threading
+from typing import Callable, Dict, List, Optional, Set
+
+import metrics
+from adb_client import AdbClient
+from config import (CoordinatorConfig, DBConfig, FarmConfig, HotplugConfig, LoggingConfig, MetricsConfig,
+                    ModemConfig, farm_inventory)
+from db_manager import DBManager
+from device_tracker import DeviceTracker
+from dispatcher import TaskDispatcher
+from inventory import InventoryError
+from main import (apply_hotplug_event, build_tasks, detect_modems, fail_unwatched, runner_factory, select_devices,
+                  start_modem_service, stop_sms_monitor, watch_sims)
+from modem_service import ModemServiceError
+from utils import init_logging
+
+logger = logging.getLogger(__name__)
+
+
+class CoordinatorError(RuntimeError):
+    """El coordinador no responde o rechazó una petición."""
+
+
+class CoordinatorClient:
+    """
+    Conexión persistente con el coordinador. Las peticiones de los hilos de
+    dispositivo se serializan; si la conexión se pierde se reabre una vez y se
+    vuelve a saludar con las mismas tareas (el coordinador ignora las que ya tiene)
+    y con los puertos de las que este agente tiene en curso.
+    """
+
+    def __init__(self, host: str, port: int, agent: str, timeout: float = 30.0) -> None:
+        self.host = host
+        self.port = port
+        self.agent = agent
+        self.timeout = timeout
+        self.run_id: Optional[str] = None
+        self._tasks: List[Dict] = []
+        self._failed: List[Dict] = []
+        # Puertos de las tareas recibidas con 'next' que aún no tienen resultado ni se han devuelto
+        self._held: Set[str] = set()
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._reader = None
+
+    def connect(self, tasks: List[Dict], failed: Optional[List[Dict]] = None) -> Dict:
+        """
+        Abre la conexión y presenta las tareas del agente (op hello); `failed`
+        son las que no se reparten porque su módem no quedó vigilado.
+        """
+        self._tasks = list(tasks)
+        self._failed = list(failed or [])
+        with self._lock:
+            return self._open()
+
+    def _open(self) -> Dict:
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile("r", encoding="utf-8")
+        reply = self._exchange({"op": "hello", "agent": self.agent, "tasks": self._tasks, "failed": self._failed,
+                                "in_flight": sorted(self._held)})
+        self.run_id = reply.get("run_id")
+        return reply
+
+    def _close(self) -> None:
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._reader = None
+
+    def _exchange(self, message: Dict) -> Dict:
+        self._sock.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("el coordinador cerró la conexión")
+        reply = json.loads(line)
+        if reply.get("event") == "error":
+            raise CoordinatorError(f"El coordinador rechazó '{message['op']}': {reply.get('message')}")
+        return reply
+
+    def request(self, op: str, **fields) -> Dict:
+        with self._lock:
+            reply = self._request({"op": op, **fields})
+            if op == "next" and reply["event"] == "task":
+                self._held.add(reply["task"]["modem_port"])
+            elif op in ("requeue", "result"):
+                self._held.discard(fields["task"]["modem_port"])
+            return reply
+
+    def _request(self, message: Dict) -> Dict:
+        try:
+            if self._sock is None:
+                self._open()
+            return self._exchange(message)
+        except (OSError, ValueError) as e:
+            self._close()
+            logger.warning(f"Conexión con el coordinador perdida ({e}); reconectando...")
+        try:
+            self._open()
+            return self._exchange(message)
+        except (OSError, ValueError) as e:
+            self._close()
+            raise CoordinatorError(f"Sin conexión con el coordinador {self.host}:{self.port}: {e}") from e
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+
+class RemoteDispatcher(TaskDispatcher):
+    """TaskDispatcher cuya cola vive en el coordinador; los hilos y runners de dispositivo son locales."""
+
+    def __init__(self, client: CoordinatorClient, max_workers: int = 0,
+                 on_result: Optional[Callable[[str, Dict, Dict, float], None]] = None,
+                 on_dispatch: Optional[Callable[[str, Dict], None]] = None) -> None:
+        super().__init__([], max_workers, on_result, on_dispatch)
+        self.client = client
+
+    def next_task(self, device_serial: str) -> Optional[Dict]:
+        reply = self.client.request("next", device=device_serial)
+        return reply["task"] if reply["event"] == "task" else None
+
+    def requeue(self, task: Dict) -> None:
+        self.client.request("requeue", task=task)
+
+    @property
+    def pending(self) -> int:
+        return self.client.request("pending")["pending"]
+
+    @property
+    def parked(self) -> int:
+        return self.client.request("pending")["parked"]
+
+    def tasks(self, parked: bool = False) -> List[Dict]:
+        return self.client.request("tasks", parked=parked)["tasks"]
+
+    def park(self, predicate: Callable[[Dict], bool]) -> int:
+        ports = [task["modem_port"] for task in self.tasks() if predicate(task)]
+        return self.client.request("park", ports=ports)["count"] if ports else 0
+
+    def unpark(self, predicate: Callable[[Dict], bool]) -> int:
+        ports = [task["modem_port"] for task in self.tasks(parked=True) if predicate(task)]
+        count = self.client.request("unpark", ports=ports)["count"] if ports else 0
+        if count:
+            self._resume_devices()
+        return count
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Agente de la granja multi-host: hardware y workers de este host.")
+    parser.add_argument("--coordinator", default=f"{CoordinatorConfig.host}:{CoordinatorConfig.port}",
+                        help="host:puerto del coordinador.")
+    parser.add_argument("--name", default=CoordinatorConfig.agent_name or socket.gethostname(),
+                        help="Nombre del agente en el coordinador (único en la granja).")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    init_logging(LoggingConfig.log_file, LoggingConfig.log_level, serve=True)
+    db_cfg = DBConfig()
+    try:
+        modem_cfg = ModemConfig()
+        farm_cfg = FarmConfig()
+    except (InventoryError, OSError) as e:
+        logger.error(f"Inventario del host no válido: {e}. Finalizando.")
+        return
+    host, _, port = args.coordinator.rpartition(":")
+    client = CoordinatorClient(host, int(port), args.name, CoordinatorConfig.request_timeout)
+
+    db = DBManager(db_cfg.results_file, db_cfg.database if db_cfg.use_sqlite else None, db_cfg.batch_size)
+    if db_cfg.results_file.exists():
+        db_cfg.results_file.unlink()
+    exporter = metrics.start_exporter("agent", MetricsConfig.main_http_port)
+
+    logger.info(f"--- Agente {args.name}: Fase 1, recolectando información de módems ---")
+    monitor_process = modem_service = None
+    sim_data_map, skipped_ports = {}, set()
+    try:
+        monitor_process, modem_service = start_modem_service(modem_cfg)
+        sim_data_map, skipped_ports = detect_modems(db, modem_cfg, {}, modem_service)
+    except ModemServiceError as e:
+        logger.error(f"{e}. El agente no presentará tareas.")
+
+    logger.info("--- Fase 2: Mapeando SIMs a dispositivos ---")
+    try:
+        inventory = farm_inventory(farm_cfg)
+    except (InventoryError, OSError) as e:
+        logger.error(f"Inventario del host no válido: {e}.")
+        inventory = None
+    device_map = {device['serial']: device for device in farm_cfg.devices}
+    tasks = build_tasks(inventory, sim_data_map, skipped_ports, device_map) if inventory else []
+    devices = select_devices(farm_cfg, tasks) if tasks else []
+    if tasks and not devices:
+        logger.error("No hay dispositivos disponibles en este host; sus tareas no se presentan al coordinador.")
+        tasks = []
+
+    # Los módems se pasan a vigilancia antes de saludar: el coordinador solo reparte tareas con módem vigilado
+    failed = []
+    if tasks:
+        logger.info("--- Fase 3: Pasando los módems de las tareas a monitorización de SMS ---")
+        try:
+            watched = watch_sims(db, tasks, modem_service)
+            failed = [task for task in tasks if task['modem_port'] in set(watched['failed'])]
+            tasks = fail_unwatched(db, tasks, watched)
+            logger.info(f"Monitor de SMS vigilando {len(watched['live'])} módems; {len(failed)} sin conexión.")
+        except ModemServiceError as e:
+            logger.error(f"{e}. El agente no presentará tareas.")
+            tasks = []
+
+    # Aunque no tenga tareas, el agente saluda y se despide para que el coordinador no lo espere
+    try:
+        reply = client.connect(tasks, failed)
+    except (OSError, ValueError, CoordinatorError) as e:
+        logger.error(f"No se pudo conectar con el coordinador {args.coordinator}: {e}. Finalizando.")
+        stop_sms_monitor(monitor_process)
+        db.close()
+        if exporter:
+            exporter.stop()
+        return
+    logger.info(f"Conectado al coordinador {args.coordinator} (ejecución {reply.get('run_id')}): "
+                f"{len(tasks)} tareas en {len(devices)} dispositivos.")
+
+    elapsed = 0.0
+    dispatcher = None
+    tracker = None
+    try:
+        if tasks:
+            logger.info("--- Fase 4: Procesando las tareas que asigna el coordinador ---")
+
+            # Diario local para consulta; el diario de la granja lo lleva el coordinador
+            def journal_task(device_serial: str, task: dict, state: str, outcome: str | None = None) -> None:
+                db.record_task(task, state, device_serial, outcome)
+                db.flush()
+                if state != "done":
+                    client.request("state", device=device_serial, task=task, state=state)
+
+            def store_result(device_serial: str, task: dict, outcome: dict, elapsed: float) -> None:
+                status = outcome.get('status', 'UNKNOWN')
+                journal_task(device_serial, task, "done", status)
+                client.request("result", device=device_serial, task=task, elapsed=elapsed,
+                               outcome={"status": status, "stages": outcome.get('stages')})
+
+            def on_worker_event(device_serial: str, task: dict, event: dict) -> None:
+                if event.get('event') == "awaiting_code":
+                    try:
+                        journal_task(device_serial, task, "awaiting_code")
+                    except CoordinatorError as e:
+                        logger.warning(f"No se pudo avisar al coordinador de {task['phone_number']}: {e}")
+
+            dispatcher = RemoteDispatcher(client, farm_cfg.max_workers, store_result,
+                                          lambda serial, task: journal_task(serial, task, "dispatched"))
+            # Los resultados los guarda el coordinador: los workers no escriben num_*.txt
+            make_runner = runner_factory(farm_cfg, True, on_worker_event)
+            if HotplugConfig.enabled:
+                tracker = DeviceTracker(AdbClient(), modem_cfg.ports, poll_interval=HotplugConfig.poll_interval)
+                tracker.subscribe(lambda event: apply_hotplug_event(dispatcher, device_map, event))
+                tracker.start()
+            elapsed = dispatcher.run(devices, make_runner, HotplugConfig.device_wait if tracker else 0.0)
+    except CoordinatorError as e:
+        logger.error(f"{e}. El agente se detiene; el coordinador conserva sus tareas pendientes.")
+    finally:
+        if tracker:
+            tracker.stop()
+        try:
+            client.request("bye")
+        except CoordinatorError as e:
+            logger.warning(f"No se pudo despedir del coordinador: {e}")
+        client.close()
+        db.close()
+        if exporter:
+            exporter.stop()
+
+    if dispatcher:
+        logger.info(f"Rendimiento por dispositivo de {args.name} ({elapsed:.0f}s en total):")
+        for line in dispatcher.summary_lines(elapsed):
+            logger.info(line)
+
+    logger.info("--- Fase 5: Deteniendo monitor de SMS... ---")
+    stop_sms_monitor(monitor_process)
+    logger.info(f"Agente {args.name} finalizado.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+"""
+Coordinator of a multi-host farm: owns the task queue and the results.
+
+Cada host USB ejecuta farm_agent.py (módems, monitor de SMS, Appium y workers
+locales) y se conecta aquí. El coordinador guarda el diario y los resultados
+de toda la granja en su FARM_HOME y reparte las tareas. Las de un agente solo
+van a sus propios teléfonos: el SMS llega a un módem de ese host y el código
+lo entrega su broker local.
+
+Protocolo: JSON por líneas sobre TCP, una respuesta por petición.
+    agente -> coordinador  {"op": "hello", "agent": "host-a", "tasks": [...], "failed": [...], "in_flight": [puertos]}
+                           {"op": "next", "device": "R58M123"}
+                           {"op": "requeue", "task": {...}}
+                           {"op": "state", "device": ..., "task": {...}, "state": "dispatched"}
+                           {"op": "result", "device": ..., "task": {...}, "outcome": {...}, "elapsed": 12.3}
+                           {"op": "tasks", "parked": false}
+                           {"op": "park" | "unpark", "ports": ["/dev/ttyUSB0"]}
+                           {"op": "pending"}
+                           {"op": "bye"}
+    coordinador -> agente  {"event": "ok", ...} | {"event": "task", "task": {...}} | {"event": "empty"}
+                           {"event": "error", "message": ...}
+
+En el diario central el puerto de cada tarea se guarda como "<agente>:<puerto>"
+(dos hosts pueden tener su /dev/ttyUSB0). Un agente que se desconecta sin
+"bye" conserva su cola y sus tareas en curso: al volver a saludar declara las
+que sigue teniendo ("in_flight") y las demás vuelven a la cola. Si no vuelve en
+`agent_timeout` segundos se da por perdido y sus tareas sin terminar quedan en
+el diario como AGENT_LOST. Las
+tareas de "failed" (su módem no quedó vigilado en el agente) no se reparten:
+se cierran en el diario como MODEM_UNAVAILABLE.
+
+    python farm_coordinator.py --agents 3
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import socketserver
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+
+import metrics
+from config import BASE_DIR, CoordinatorConfig, DBConfig, LoggingConfig
+from db_manager import DBManager
+from dispatcher import TaskDispatcher
+from utils import init_logging
+
+logger = logging.getLogger(__name__)
+
+AGENT_RESULTS = metrics.counter(
+    "coordinator_results_total", "Números terminados por cada agente según su estado.", ("agent", "status"))
+
+
+@dataclass
+class AgentState:
+    name: str
+    queue: TaskDispatcher = field(default_factory=lambda: TaskDispatcher([]))
+    # Puertos con tarea en esta ejecución y tareas entregadas sin resultado todavía
+    known_ports: Set[str] = field(default_factory=set)
+    in_flight: Dict[str, Dict] = field(default_factory=dict)
+    connected: bool = False
+    finished: bool = False
+    lost: bool = False
+    started: float = field(default_factory=time.monotonic)
+    last_seen: float = field(default_factory=time.monotonic)
+    wall_seconds: float = 0.0
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "FarmCoordinator"
+
+    def _send(self, message: Dict) -> None:
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+
+    def handle(self) -> None:
+        agent: Optional[str] = None
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    op = request.get("op")
+                except (ValueError, AttributeError):
+                    self._send({"event": "error", "message": "JSON inválido"})
+                    continue
+                if op == "hello" and request.get("agent"):
+                    agent = str(request["agent"])
+                    self._send(self.server.hello(agent, request.get("tasks") or [], request.get("failed") or [],
+                                                 request.get("in_flight") or []))
+                elif agent is None:
+                    self._send({"event": "error", "message": "la primera petición debe ser hello"})
+                else:
+                    try:
+                        self._send(self.server.handle_request(agent, op, request))
+                    except (KeyError, TypeError, ValueError) as e:
+                        self._send({"event": "error", "message": f"petición '{op}' inválida: {e}"})
+                    if op == "bye":
+                        break
+        except ConnectionError:
+            pass
+        finally:
+            if agent is not None:
+                self.server.disconnected(agent)
+
+
+class FarmCoordinator(socketserver.ThreadingTCPServer):
+    """Colas por agente, diario y resultados centrales; cada conexión de agente en su propio hilo."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, db: DBManager, host: str = "0.0.0.0", port: int = 8770) -> None:
+        super().__init__((host, port), _Handler)
+        self.db = db
+        self.agents: Dict[str, AgentState] = {}
+        self._changed = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> "FarmCoordinator":
+        self._thread = threading.Thread(target=self.serve_forever, name="farm-coordinator", daemon=True)
+        self._thread.start()
+        logger.info(f"Coordinador escuchando en {self.server_address[0]}:{self.port} (ejecución {self.db.run_id}).")
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    @staticmethod
+    def _central(agent: str, task: Dict) -> Dict:
+        """La tarea tal como se guarda en el diario central (puerto cualificado con el agente)."""
+        return {**task, "modem_port": f"{agent}:{task['modem_port']}"}
+
+    def hello(self, agent: str, tasks: List[Dict], failed: Optional[List[Dict]] = None,
+              in_flight: Optional[List[str]] = None) -> Dict:
+        with self._changed:
+            state = self.agents.get(agent)
+            if state is None:
+                state = self.agents[agent] = AgentState(agent)
+            elif state.finished:
+                # Un agente que vuelve tras despedirse empieza una tanda nueva
+                state.finished = state.lost = False
+                state.started = time.monotonic()
+            state.connected = True
+            state.last_seen = time.monotonic()
+            # Las tareas en curso que el agente ya no tiene (proceso reiniciado, respuesta perdida) vuelven a la cola
+            held = set(in_flight or [])
+            orphans = [task for port, task in state.in_flight.items() if port not in held]
+            for task in orphans:
+                del state.in_flight[task["modem_port"]]
+                state.queue.requeue(task)
+                self.db.record_task(self._central(agent, task), "pending")
+            new_tasks = [task for task in tasks if task["modem_port"] not in state.known_ports]
+            for task in reversed(new_tasks):
+                state.known_ports.add(task["modem_port"])
+                state.queue.requeue(task)
+                self.db.record_task(self._central(agent, task), "pending")
+            new_failed = [task for task in failed or [] if task["modem_port"] not in state.known_ports]
+            for task in new_failed:
+                state.known_ports.add(task["modem_port"])
+                self.db.record_task(self._central(agent, task), "done", outcome="MODEM_UNAVAILABLE")
+            self._changed.notify_all()
+        self.db.flush()
+        if orphans:
+            logger.warning(f"Agente {agent}: {len(orphans)} números en curso que ya no tiene vuelven a la cola.")
+        if state.in_flight:
+            logger.info(f"Agente {agent} reconectado con {len(state.in_flight)} números en curso.")
+        if new_failed:
+            logger.warning(f"Agente {agent}: {len(new_failed)} tareas sin módem vigilado se dan por fallidas.")
+        logger.info(f"Agente {agent} conectado: {len(new_tasks)} tareas nuevas, {state.queue.pending} en cola.")
+        return {"event": "ok", "run_id": self.db.run_id, "pending": state.queue.pending}
+
+    def handle_request(self, agent: str, op: Optional[str], request: Dict) -> Dict:
+        state = self.agents[agent]
+        state.last_seen = time.monotonic()
+        if op == "next":
+            task = state.queue.next_task(request["device"])
+            if task is None:
+                return {"event": "empty"}
+            state.in_flight[task["modem_port"]] = task
+            return {"event": "task", "task": task}
+        if op == "requeue":
+            task = request["task"]
+            state.in_flight.pop(task["modem_port"], None)
+            state.queue.requeue(task)
+            return {"event": "ok"}
+        if op == "state":
+            self.db.record_task(self._central(agent, request["task"]), request["state"], request["device"])
+            self.db.flush()
+            return {"event": "ok"}
+        if op == "result":
+            self.record_result(agent, request["device"], request["task"], request["outcome"], float(request["elapsed"]))
+            return {"event": "ok"}
+        if op == "pending":
+            return {"event": "ok", "pending": state.queue.pending, "parked": state.queue.parked}
+        if op == "tasks":
+            return {"event": "ok", "tasks": state.queue.tasks(parked=bool(request.get("parked")))}
+        if op in ("park", "unpark"):
+            ports = set(request["ports"])
+            move = state.queue.park if op == "park" else state.queue.unpark
+            return {"event": "ok", "count": move(lambda task: task["modem_port"] in ports)}
+        if op == "bye":
+            with self._changed:
+                state.finished = True
+                state.wall_seconds = time.monotonic() - state.started
+                self._changed.notify_all()
+            logger.info(f"Agente {agent} ha terminado ({state.queue.pending} tareas sin procesar).")
+            return {"event": "ok"}
+        return {"event": "error", "message": f"op desconocida: {op}"}
+
+    def record_result(self, agent: str, device: str, task: Dict, outcome: Dict, elapsed: float) -> None:
+        state = self.agents[agent]
+        if state.in_flight.pop(task["modem_port"], None) is None:
+            # Reenvío del agente tras reconectar: el resultado ya se guardó
+            logger.debug(f"Resultado repetido de {task['modem_port']} ({agent}); se ignora.")
+            return
+        status = outcome.get("status", "UNKNOWN")
+        state.queue.record(device, task, status, elapsed, outcome.get("stages"))
+        central = self._central(agent, task)
+        self.db.record_outcome(central, device, status, elapsed, outcome.get("stages"))
+        self.db.record_task(central, "done", device, status)
+        self.db.flush()
+        AGENT_RESULTS.inc(agent=agent, status=status)
+
+    def disconnected(self, agent: str) -> None:
+        with self._changed:
+            state = self.agents[agent]
+            state.connected = False
+            state.last_seen = time.monotonic()
+            self._changed.notify_all()
+        if not state.finished:
+            logger.warning(f"Agente {agent} desconectado sin despedirse: conserva {state.queue.pending} tareas "
+                           f"en cola y {len(state.in_flight)} en curso.")
+
+    def wait_agents(self, expected: int, agent_timeout: float) -> None:
+        """Espera a que al menos `expected` agentes se conecten y todos los conocidos terminen o se pierdan."""
+        with self._changed:
+            while True:
+                agents = list(self.agents.values())
+                if len(agents) >= expected and all(state.finished for state in agents):
+                    return
+                now = time.monotonic()
+                for state in agents:
+                    if not (state.connected or state.finished) and now - state.last_seen > agent_timeout:
+                        logger.error(f"Agente {state.name} no ha vuelto en {agent_timeout:.0f}s; se da por perdido "
+                                     f"con {state.queue.pending + len(state.in_flight)} tareas sin terminar.")
+                        state.finished = state.lost = True
+                        state.wall_seconds = now - state.started
+                        self.record_lost(state)
+                self._changed.wait(1.0)
+
+    def record_lost(self, state: AgentState) -> None:
+        """Deja en el diario central como AGENT_LOST las tareas sin terminar de un agente perdido."""
+        unfinished = state.queue.tasks() + state.queue.tasks(parked=True) + list(state.in_flight.values())
+        for task in unfinished:
+            self.db.record_task(self._central(state.name, task), "done", outcome="AGENT_LOST")
+        self.db.flush()
+
+    def summary_lines(self) -> List[str]:
+        lines = []
+        for name, state in sorted(self.agents.items()):
+            lost = " (perdido)" if state.lost else ""
+            lines.append(f"--- Agente {name}{lost}: {state.wall_seconds:.0f}s ---")
+            lines.extend(state.queue.summary_lines(state.wall_seconds))
+        return lines
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Coordinador de una granja repartida en varios hosts USB.")
+    parser.add_argument("--host", default=CoordinatorConfig.listen_host)
+    parser.add_argument("--port", type=int, default=CoordinatorConfig.port)
+    parser.add_argument("--agents", type=int, default=CoordinatorConfig.agents,
+                        help="Agentes que deben terminar para dar la ejecución por acabada.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    init_logging(LoggingConfig.log_file, LoggingConfig.log_level)
+    db_cfg = DBConfig()
+    if not db_cfg.use_sqlite:
+        logger.error("El coordinador necesita la base SQLite (DBConfig.use_sqlite). Finalizando.")
+        return
+    db = DBManager(db_cfg.results_file, db_cfg.database, db_cfg.batch_size)
+    exporter = metrics.start_exporter("coordinator")
+    first_outcome_id = db.last_outcome_id()
+    coordinator = FarmCoordinator(db, args.host, args.port).start()
+    try:
+        logger.info(f"Esperando a {args.agents} agentes...")
+        coordinator.wait_agents(args.agents, CoordinatorConfig.agent_timeout)
+    except KeyboardInterrupt:
+        logger.warning("Coordinador interrumpido; se guardan los resultados recibidos.")
+    finally:
+        coordinator.stop()
+        exported = db.export_status_files(BASE_DIR, after_id=first_outcome_id)
+        logger.info(f"Resultados guardados en {db_cfg.database.name} y exportados: {exported}")
+        db.close()
+        if exporter:
+            exporter.stop()
+
+    for line in coordinator.summary_lines():
+        logger.info(line)
+    logger.info("=======================================")
+    logger.info("=   EJECUCIÓN MULTI-HOST COMPLETA     =")
+    logger.info("=======================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Declarative farm inventory: devices, their SIMs and their ports, in one file.
+
+inventory.json (en FARM_HOME) sustituye a FarmConfig.devices y sim_list.txt:
+
+    {
+      "appium_port_base": 4723,
+      "system_port_base": 8200,
+      "devices": [
+        {"serial": "R58M123", "sims": [{"modem_port": "/dev/ttyUSB0", "iccid": "8934..."}]},
+        {"serial": "R58M456", "appium_port": 4800, "sims": [{"modem_port": "COM12"}]}
+      ]
+    }
+
+Se valida una sola vez al arrancar (seriales, puertos de módem e ICCID únicos;
+puertos TCP sin colisiones) y se indexa por serial, puerto de módem e ICCID.
+Los puertos Appium y systemPort (UiAutomator2) que no se indican se asignan
+automáticamente desde su base, saltando los ya ocupados. Pasar de 10 a 300
+dispositivos es añadir entradas al archivo.
+"""
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+
+class InventoryError(ValueError):
+    """El inventario no es válido (duplicados, colisiones de puertos, formato)."""
+
+
+@dataclass(frozen=True)
+class DeviceEntry:
+    serial: str
+    appium_port: int
+    system_port: int
+
+    def as_config(self) -> Dict[str, object]:
+        """Formato de FarmConfig.devices."""
+        return {"serial": self.serial, "appium_port": self.appium_port, "system_port": self.system_port}
+
+
+@dataclass(frozen=True)
+class SimEntry:
+    modem_port: str
+    device_serial: Optional[str]
+    iccid: str = ""
+    phone_number: str = ""
+
+    def as_association(self) -> Dict[str, str]:
+        """Formato de una fila de sim_list.txt."""
+        return {"modem_port": self.modem_port, "phone_number": self.phone_number,
+                "device_serial": self.device_serial or "", "iccid": self.iccid}
+
+
+class Inventory:
+    """Dispositivos y SIMs validados, con búsquedas O(1) por serial, puerto e ICCID."""
+
+    def __init__(self, devices: List[DeviceEntry], sims: List[SimEntry], source: str = "") -> None:
+        self.devices = devices
+        self.sims = sims
+        self.source = source
+        self._by_serial: Dict[str, DeviceEntry] = {}
+        self._by_port: Dict[str, SimEntry] = {}
+        self._by_iccid: Dict[str, SimEntry] = {}
+        used_ports: Dict[int, str] = {}
+        for device in devices:
+            if device.serial in self._by_serial:
+                raise InventoryError(f"{source}: el dispositivo {device.serial} aparece dos veces")
+            self._by_serial[device.serial] = device
+            for kind, port in (("appium_port", device.appium_port), ("system_port", device.system_port)):
+                if port in used_ports:
+                    raise InventoryError(f"{source}: {kind} {port} de {device.serial} ya lo usa {used_ports[port]}")
+                used_ports[port] = device.serial
+        for sim in sims:
+            if sim.modem_port in self._by_port:
+                raise InventoryError(f"{source}: el módem {sim.modem_port} aparece dos veces")
+            self._by_port[sim.modem_port] = sim
+            if sim.iccid:
+                if sim.iccid in self._by_iccid:
+                    raise InventoryError(f"{source}: el ICCID {sim.iccid} aparece dos veces")
+                self._by_iccid[sim.iccid] = sim
+
+    def device(self, serial: str) -> Optional[DeviceEntry]:
+        return self._by_serial.get(serial)
+
+    def sim_for_port(self, modem_port: str) -> Optional[SimEntry]:
+        return self._by_port.get(modem_port)
+
+    def sim_for_iccid(self, iccid: str) -> Optional[SimEntry]:
+        return self._by_iccid.get(iccid)
+
+    def modem_ports(self) -> List[str]:
+        return [sim.modem_port for sim in self.sims]
+
+    def device_configs(self) -> List[Dict[str, object]]:
+        return [device.as_config() for device in self.devices]
+
+    def associations(self) -> List[Dict[str, str]]:
+        return [sim.as_association() for sim in self.sims]
+
+
+def _allocate(requested: Optional[int], base: int, used: Set[int]) -> int:
+    """Puerto pedido o, si no hay, el primero libre desde `base`."""
+    if requested is not None:
+        return int(requested)
+    port = base
+    while port in used:
+        port += 1
+    return port
+
+
+def build_inventory(data: Dict, source: str = "") -> Inventory:
+    """Valida el contenido de inventory.json y asigna los puertos que falten."""
+    if not isinstance(data.get("devices"), list):
+        raise InventoryError(f"{source}: falta la lista 'devices'")
+    appium_base = int(data.get("appium_port_base", 4723))
+    system_base = int(data.get("system_port_base", 8200))
+    # Los puertos fijados a mano se reservan antes de asignar los automáticos
+    used = {int(entry[key]) for entry in data["devices"] for key in ("appium_port", "system_port") if entry.get(key)}
+    devices, sims = [], []
+    for entry in data["devices"]:
+        serial = str(entry.get("serial") or "").strip()
+        if not serial:
+            raise InventoryError(f"{source}: dispositivo sin 'serial': {entry}")
+        unknown = set(entry) - {"serial", "appium_port", "system_port", "sims"}
+        if unknown:
+            raise InventoryError(f"{source}: {serial} tiene claves desconocidas {sorted(unknown)}")
+        appium_port = _allocate(entry.get("appium_port"), appium_base, used)
+        used.add(appium_port)
+        system_port = _allocate(entry.get("system_port"), system_base, used)
+        used.add(system_port)
+        devices.append(DeviceEntry(serial, appium_port, system_port))
+        for sim in entry.get("sims", []):
+            if not sim.get("modem_port"):
+                raise InventoryError(f"{source}: SIM de {serial} sin 'modem_port': {sim}")
+            sims.append(SimEntry(str(sim["modem_port"]), serial, str(sim.get("iccid") or ""),
+                                 str(sim.get("phone_number") or "")))
+    return Inventory(devices, sims, source)
+
+
+def load_inventory(path: Path) -> Inventory:
+    try:
+        with path.open(encoding="utf-8") as f:
+            data = json.load(f)
+    except ValueError as e:
+        raise InventoryError(f"{path}: JSON inválido: {e}") from e
+    return build_inventory(data, str(path))
+
+
+def read_sim_list(path: Path) -> List[Dict[str, str]]:
+    """Filas de sim_list.txt (CSV con cabecera modem_port,phone_number,device_serial)."""
+    if not path.exists():
+        return []
+    rows = []
+    with path.open(encoding="utf-8") as txtfile:
+        header = [h.strip() for h in txtfile.readline().strip().split(',')]
+        for line in txtfile:
+            parts = [p.strip() for p in line.strip().split(',')]
+            if len(parts) == len(header):
+                rows.append(dict(zip(header, parts)))
+    return rows
+
+
+def legacy_inventory(devices: Iterable[Dict], sim_rows: Iterable[Dict[str, str]], source: str = "") -> Inventory:
+    """Inventario equivalente a FarmConfig.devices + sim_list.txt (configuración anterior)."""
+    return Inventory(
+        [DeviceEntry(device["serial"], int(device["appium_port"]),
+                     int(device.get("system_port") or 8200 + i)) for i, device in enumerate(devices)],
+        [SimEntry(row["modem_port"], row.get("device_serial") or None, row.get("iccid", ""), row.get("phone_number", ""))
+         for row in sim_rows if row.get("modem_port")],
+        source,
+    )
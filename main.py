@@ -1,18 +1,26 @@
 # main.py
 from __future__ import annotations
 
+import argparse
 import logging
+import os
 import subprocess
 import sys
 import time
-import re
 import serial.tools.list_ports
-from multiprocessing import Process
 from pathlib import Path
 
-from config import DBConfig, LoggingConfig, ModemConfig, FarmConfig, BASE_DIR
-from modem_controller import ModemController
+from config import (BrokerConfig, DBConfig, HotplugConfig, LoggingConfig, MetricsConfig, ModemConfig, FarmConfig,
+                    BASE_DIR, CODE_DIR, farm_inventory)
+import metrics
+from adb_client import AdbClient
+from inventory import Inventory, InventoryError
+from modem_service import ModemServiceClient, ModemServiceError
+from adb_controller import ADBController
 from db_manager import DBManager
+from device_tracker import DeviceEvent, DeviceTracker
+from device_worker import DeviceWorker, WorkerError
+from dispatcher import DeviceUnavailable, TaskDispatcher
 from utils import init_logging
 
 logger = logging.getLogger(__name__)
@@ -21,122 +29,303 @@ def get_available_serial_ports() -> list[str]:
     ports = serial.tools.list_ports.comports()
     return [port.device for port in ports]
 
-def is_valid_phone_number(number: str) -> bool:
-    return bool(re.fullmatch(r'^\+?\d{7,20}$', number or ""))
+WORKER_SECONDS = metrics.histogram(
+    "worker_duration_seconds", "Duración del procesamiento de un número por estado final.", ("status", "mode"))
+WORKER_STAGE_SECONDS = metrics.histogram(
+    "worker_stage_seconds", "Duración de cada etapa del worker de Node (prep, submit, code_wait, verify).", ("stage",))
+PM_CLEAR_SECONDS = metrics.histogram(
+    "device_app_clear_seconds", "Tiempo de limpieza de datos de Telegram (pm clear / mobile: clearApp).", ("device",))
+CODE_TYPED_SECONDS = metrics.histogram(
+    "code_written_to_typed_seconds", "Desde que el monitor publica/escribe el código hasta que el worker lo teclea.")
 
-def load_sim_list(path: Path) -> list[dict[str, str]]:
-    if not path.exists():
-        logger.error(f"El archivo de configuración de SIMs '{path.name}' no fue encontrado.")
-        return []
-    sim_entries = []
-    try:
-        with path.open(encoding='utf-8') as txtfile:
-            header = [h.strip() for h in txtfile.readline().strip().split(',')]
-            for line in txtfile:
-                parts = [p.strip() for p in line.strip().split(',')]
-                if len(parts) == len(header):
-                    sim_entries.append(dict(zip(header, parts)))
-    except Exception as e:
-        logger.error(f"Error al leer la lista de SIMs desde {path}: {e}")
-    return sim_entries
-
-def run_node_worker(phone_number: str, device_serial: str, appium_port: int):
+def run_node_worker(phone_number: str, device_serial: str, appium_port: int, timeout: float = 240.0,
+                    env: dict | None = None, command: list[str] | None = None) -> str:
     log_dir = BASE_DIR / "logs"
     log_dir.mkdir(parents=True, exist_ok=True)
     log_file_name = log_dir / f"node_{device_serial}.log"
     logger.info(f"Iniciando worker para {phone_number} en dispositivo {device_serial}...")
-    node_script_path = str(BASE_DIR / 'telegram_reader.js')
-    command = ['node', node_script_path, phone_number, device_serial, str(appium_port)]
+    command = (command or ['node', str(CODE_DIR / 'telegram_reader.js')]) + [phone_number, device_serial, str(appium_port)]
+    started = time.monotonic()
+    status = "ERROR"
     try:
-        with open(log_file_name, "w", encoding="utf-8") as log_file:
-            process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, text=True)
-            process.wait(timeout=240)
+        with open(log_file_name, "a", encoding="utf-8") as log_file:
+            process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, text=True,
+                                       env={**os.environ, **env} if env else None)
+            process.wait(timeout=timeout)
             logger.info(f"Worker para {phone_number} en {device_serial} ha finalizado.")
+            status = "DONE" if process.returncode == 0 else "ERROR"
     except subprocess.TimeoutExpired:
         logger.warning(f"Worker para {phone_number} en {device_serial} ha excedido el tiempo límite.")
         process.kill()
+        status = "TIMEOUT"
     except Exception as e:
         logger.error(f"Error al ejecutar worker para {phone_number}: {e}")
+    WORKER_SECONDS.observe(time.monotonic() - started, status=status, mode="spawn")
+    return status
 
-def main() -> None:
-    init_logging(LoggingConfig.log_file, LoggingConfig.log_level)
-    db_cfg = DBConfig()
-    modem_cfg = ModemConfig()
-    farm_cfg = FarmConfig()
-    
-    if db_cfg.results_file.exists():
-        db_cfg.results_file.unlink()
+class SpawnRunner:
+    """Modo clásico: un proceso Node (y una sesión Appium) por número."""
 
-    logger.info("--- Fase 1: Recolectando información de módems ---")
+    def __init__(self, device: dict, worker_timeout: float = 240.0, env: dict | None = None,
+                 command: list[str] | None = None) -> None:
+        self.device = device
+        self.worker_timeout = worker_timeout
+        self.env = env
+        self.command = command
+
+    def prepare(self) -> bool:
+        # Cada proceso prepara su propia sesión: no se puede adelantar
+        return False
+
+    def process(self, task: dict) -> dict:
+        return {"status": run_node_worker(task['phone_number'], self.device['serial'], self.device['appium_port'],
+                                          self.worker_timeout, self.env, self.command)}
+
+    def close(self) -> None:
+        pass
+
+# Etapas que informa telegram_reader.js (ms) -> nombres del resumen del dispatcher
+STAGE_NAMES = {"prep": "prep", "submit": "submit", "codeWait": "code_wait", "verify": "verify"}
+
+def observe_worker_timings(device_serial: str, timings: dict) -> None:
+    """Registra en las métricas los tiempos (ms) que informa telegram_reader.js."""
+    for name, ms in timings.items():
+        if name in STAGE_NAMES:
+            WORKER_STAGE_SECONDS.observe(ms / 1000, stage=STAGE_NAMES[name])
+    if 'pmClear' in timings:
+        PM_CLEAR_SECONDS.observe(timings['pmClear'] / 1000, device=device_serial)
+    if 'codeTyped' in timings:
+        CODE_TYPED_SECONDS.observe(timings['codeTyped'] / 1000)
+
+class PersistentRunner:
+    """Un único worker y una única sesión Appium para todos los números del dispositivo."""
+
+    def __init__(self, device: dict, worker_timeout: float, prepare_ahead: bool = True,
+                 env: dict | None = None, on_event=None, command: list[str] | None = None) -> None:
+        self.device_serial = device['serial']
+        self.worker_timeout = worker_timeout
+        self.prepare_ahead = prepare_ahead
+        # Se llama con (dispositivo, tarea, evento) para los eventos intermedios del worker
+        self.on_event = on_event
+        self.worker = DeviceWorker(device['serial'], device['appium_port'],
+                                   BASE_DIR / "logs" / f"node_{device['serial']}.log", command=command, env=env,
+                                   system_port=device.get('system_port'))
+
+    def _ensure_started(self) -> None:
+        if not self.worker.is_alive:
+            try:
+                self.worker.start()
+            except WorkerError as e:
+                raise DeviceUnavailable(f"No se pudo iniciar el worker de {self.device_serial}: {e}") from e
+
+    def prepare(self) -> bool:
+        """Limpia la app y la deja en la pantalla de número antes de recibir la SIM."""
+        if not self.prepare_ahead:
+            return False
+        self._ensure_started()
+        try:
+            event = self.worker.prepare(self.worker_timeout)
+        except WorkerError as e:
+            logger.warning(f"No se pudo preparar {self.device_serial}: {e}")
+            self.worker.stop()
+            return False
+        observe_worker_timings(self.device_serial, event.get('timings') or {})
+        if not event.get('ok'):
+            logger.warning(f"{self.device_serial} no llegó a la pantalla de número; se reintentará con el número.")
+        return bool(event.get('ok'))
+
+    def process(self, task: dict) -> dict:
+        phone_number = task['phone_number']
+        self._ensure_started()
+        started = time.monotonic()
+        try:
+            logger.info(f"Procesando {phone_number} en el worker persistente de {self.device_serial}...")
+            result = self.worker.process(
+                task, self.worker_timeout,
+                on_event=(lambda event: self.on_event(self.device_serial, task, event)) if self.on_event else None,
+            )
+        except WorkerError as e:
+            # Sesión perdida o número colgado: se reinicia el worker para el siguiente número
+            logger.warning(f"Worker para {phone_number} en {self.device_serial} falló: {e}")
+            self.worker.stop()
+            WORKER_SECONDS.observe(time.monotonic() - started, status="WORKER_ERROR", mode="persistent")
+            return {"status": "WORKER_ERROR"}
+        timings = result.get('timings') or {}
+        stages = {STAGE_NAMES[name]: ms / 1000 for name, ms in timings.items() if name in STAGE_NAMES}
+        observe_worker_timings(self.device_serial, timings)
+        WORKER_SECONDS.observe(result.get('durationMs', 0) / 1000, status=result.get('status') or "UNKNOWN",
+                               mode="persistent")
+        logger.info(
+            f"Worker para {phone_number} en {self.device_serial} ha finalizado: "
+            f"{result.get('status')} ({result.get('durationMs', 0) / 1000:.1f}s, "
+            f"espera de código {stages.get('code_wait', 0.0):.1f}s)."
+        )
+        return {"status": result.get('status') or "UNKNOWN", "stages": stages}
+
+    def close(self) -> None:
+        self.worker.stop()
+
+def select_devices(farm_cfg: FarmConfig, tasks: list[dict]) -> list[dict]:
+    """
+    Dispositivos que participan en el reparto: los asignados en el inventario
+    más cualquier otro dispositivo configurado que adb vea conectado.
+    """
+    preferred = {task.get('preferred_device') for task in tasks}
+    try:
+        connected = set(ADBController(farm_cfg.adb_path).list_connected_devices())
+    except OSError as e:
+        logger.warning(f"No se pudo consultar adb ({e}); solo se usan los dispositivos con SIMs asignadas.")
+        connected = set()
+    return [device for device in farm_cfg.devices
+            if device['serial'] in preferred or device['serial'] in connected]
+
+def apply_hotplug_event(dispatcher: TaskDispatcher, device_map: dict[str, dict], event: DeviceEvent) -> None:
+    """Refleja en el reparto un teléfono o un módem que se conecta o desconecta durante la ejecución."""
+    if event.kind == "adb":
+        device = device_map.get(event.device)
+        if device is None:
+            return
+        if event.action == "attach":
+            if dispatcher.add_device(device):
+                logger.info(f"{event.device} se incorpora al reparto.")
+        else:
+            dispatcher.drain_device(event.device)
+            logger.warning(f"{event.device} desconectado: termina su número en curso y deja de recibir tareas.")
+        return
+    on_port = lambda task: task.get('modem_port') == event.device
+    if event.action == "detach":
+        parked = dispatcher.park(on_port)
+        if parked:
+            logger.warning(f"Módem {event.device} desconectado: {parked} tareas apartadas hasta que vuelva.")
+    else:
+        resumed = dispatcher.unpark(on_port)
+        if resumed:
+            logger.info(f"Módem {event.device} reconectado: {resumed} tareas vuelven a la cola.")
+
+def start_modem_service(modem_cfg: ModemConfig) -> tuple[subprocess.Popen, ModemServiceClient]:
+    """
+    Lanza sms_monitor.py --serve, que será el dueño de los puertos serie desde
+    el sondeo hasta el final de la ejecución, y espera a que atienda peticiones.
+    """
+    process = subprocess.Popen([sys.executable, str(CODE_DIR / 'sms_monitor.py'), "--serve"])
+    client = ModemServiceClient(modem_cfg.service_host, modem_cfg.service_port)
+    try:
+        client.wait_ready(process)
+    except ModemServiceError:
+        stop_sms_monitor(process)
+        raise
+    return process, client
+
+def detect_modems(db: DBManager, modem_cfg: ModemConfig, journal: dict,
+                  service: ModemServiceClient) -> tuple[dict[str, dict], set[str]]:
+    """
+    Fase 1: sondea los puertos en el servicio de módems (o los recupera del
+    diario). Devuelve (puerto -> SIM, puertos ya terminados).
+    """
     if not modem_cfg.ports:
         modem_cfg.ports.extend(get_available_serial_ports())
+    phase_started = time.monotonic()
     sim_data_map = {}
+    ports_to_probe = []
+    # Puertos que no se procesan en esta invocación (ya terminados o con resultado previo)
+    skipped_ports = set()
     for port in modem_cfg.ports:
-        modem = ModemController(port, modem_cfg.baudrate, modem_cfg.timeout)
-        try:
-            modem.connect()
-            modem.read_phone_number_from_modem()
-            phone_number = modem._phone_number if is_valid_phone_number(modem._phone_number) else modem._sim_icc_id
-            if phone_number:
-                sim_data_map[port] = {"phone_number": phone_number, "modem_port": port}
-                logger.info(f"Detectado en {port}: {phone_number}")
-            else:
-                logger.warning(f"No se pudo obtener un identificador válido para {port}.")
-        except Exception as e:
-            logger.error(f"Error durante la detección en {port}: {e}")
-        finally:
-            if modem.serial and modem.serial.is_open:
-                modem.disconnect()
+        entry = journal.get(port)
+        # Un módem que no llegó a vigilarse (MODEM_UNAVAILABLE) no se procesó: se vuelve a sondear
+        if entry is None or entry['state'] == "probing" or entry['outcome'] == "MODEM_UNAVAILABLE":
+            ports_to_probe.append(port)
+        elif entry['state'] == "done":
+            skipped_ports.add(port)
+        elif entry['phone_number']:
+            # Sondeado en la ejecución anterior: se confía en el diario
+            sim_data_map[port] = {"phone_number": entry['phone_number'], "modem_port": port,
+                                  "sim_number_icc_id": entry['iccid']}
+    if journal:
+        logger.info(f"{len(sim_data_map)} módems recuperados del diario; se sondean {len(ports_to_probe)} puertos.")
 
-    logger.info("--- Fase 2: Mapeando SIMs a dispositivos ---")
-    sim_device_associations = load_sim_list(db_cfg.sim_list)
-    tasks = []
-    device_map = {device['serial']: device for device in farm_cfg.devices}
-    for association in sim_device_associations:
-        device_serial = association.get('device_serial')
-        modem_port = association.get('modem_port')
-        sim_info = sim_data_map.get(modem_port)
-        device_info = device_map.get(device_serial)
-        if sim_info and device_info:
-            tasks.append({**sim_info, **device_info})
+    for port in ports_to_probe:
+        db.record_task({"modem_port": port}, "probing")
+    db.flush()
+    probes = service.probe(ports_to_probe, modem_cfg)
+    for port in ports_to_probe:
+        probe = probes[port]
+        phone_number = probe["phone_number"]
+        if phone_number:
+            sim_data_map[port] = {"phone_number": phone_number, "modem_port": port,
+                                  "sim_number_icc_id": probe["iccid"] or ""}
+            db.record_task(sim_data_map[port], "pending")
+            logger.info(f"Detectado en {port}: {phone_number} ({probe['elapsed']:.2f}s)")
+            continue
+        db.record_task({"modem_port": port}, "done", outcome=probe["status"].upper())
+        if probe["status"] == "no_response":
+            logger.info(f"Puerto {port} descartado: no responde a AT ({probe['elapsed']:.2f}s).")
         else:
-            logger.warning(f"Se omitió la asociación para {modem_port} / {device_serial} por falta de datos.")
-            
-    if not tasks:
-        logger.error("No se crearon tareas. Verifique sim_list.txt y los módems. Finalizando.")
-        return
-        
-    logger.info(f"Se han creado {len(tasks)} tareas para procesar.")
+            logger.warning(f"No se pudo obtener un identificador válido para {port} ({probe['status']}, {probe['elapsed']:.2f}s).")
+    db.flush()
+    logger.info(
+        f"Fase 1 completada en {time.monotonic() - phase_started:.2f}s: "
+        f"{len(sim_data_map)} módems detectados de {len(modem_cfg.ports)} puertos."
+    )
+    return sim_data_map, skipped_ports
+
+def build_tasks(inventory: Inventory, sim_data_map: dict[str, dict], skipped_ports: set[str],
+                device_map: dict[str, dict]) -> list[dict]:
+    """Fase 2: una tarea por SIM del inventario cuyo módem se ha detectado."""
+    # Una SIM del inventario con ICCID se reconoce aunque su módem haya cambiado de puerto
+    detected_by_iccid = {info['sim_number_icc_id']: info for info in sim_data_map.values() if info.get('sim_number_icc_id')}
+    tasks = []
+    assigned_ports = set()
+    for sim in inventory.sims:
+        device_serial = sim.device_serial
+        sim_info = (sim.iccid and detected_by_iccid.get(sim.iccid)) or sim_data_map.get(sim.modem_port)
+        if sim.modem_port in skipped_ports or (sim_info and sim_info['modem_port'] in skipped_ports):
+            continue
+        if not sim_info or sim_info['modem_port'] in assigned_ports:
+            logger.warning(f"Se omitió la asociación para {sim.modem_port} / {device_serial}: módem no detectado.")
+            continue
+        if sim_info['modem_port'] != sim.modem_port:
+            logger.info(f"SIM {sim.iccid} de {sim.modem_port} detectada ahora en {sim_info['modem_port']}.")
+        if device_serial not in device_map:
+            logger.warning(f"Dispositivo {device_serial} de {sim.modem_port} no configurado; la SIM irá al primero libre.")
+            device_serial = None
+        assigned_ports.add(sim_info['modem_port'])
+        # El emparejamiento del inventario es una preferencia: cualquier dispositivo libre puede tomar la SIM
+        tasks.append({**sim_info, "preferred_device": device_serial})
+    return tasks
 
-    logger.info("--- Fase 3: Iniciando el monitor de SMS en segundo plano ---")
-    temp_db = DBManager(db_cfg.results_file)
+def watch_sims(db: DBManager, tasks: list[dict], service: ModemServiceClient) -> dict[str, list[str]]:
+    """
+    Fase 3: registra las tareas como pendientes y pide al servicio de módems que
+    vigile sus puertos. Devuelve los puertos vigilados ('live') y los que fallaron.
+    """
     for task in tasks:
-        temp_db.append_result({
-            "phone_number": task['phone_number'], "device_serial": task.get('serial', ''),
-            "sim_number_icc_id": "", "modem_port": task.get('modem_port', ''), "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+        db.append_result({
+            "phone_number": task['phone_number'], "device_serial": task.get('preferred_device') or '',
+            "sim_number_icc_id": task.get('sim_number_icc_id', ''), "modem_port": task.get('modem_port', ''),
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
         })
-    monitor_script_path = str(BASE_DIR / 'sms_monitor.py')
-    monitor_process = subprocess.Popen([sys.executable, monitor_script_path])
-    logger.info(f"Monitor de SMS iniciado (PID: {monitor_process.pid}). Esperando 10 segundos...")
-    time.sleep(10)
-
-    # --- INICIO DE LA CORRECCIÓN DE PARALELISMO ---
-    logger.info("--- Fase 4: Lanzando TODOS los workers en paralelo ---")
-    
-    processes = []
+        db.record_task(task, "pending")
+    if db.db_path:
+        db.flush()
+        # results.txt se sigue generando para el modo clásico de telegram_reader.js
+        db.export_results(run_id=db.run_id)
+    return service.watch(tasks)
+
+def fail_unwatched(db: DBManager, tasks: list[dict], watched: dict[str, list[str]]) -> list[dict]:
+    """
+    Cierra como MODEM_UNAVAILABLE las tareas cuyo módem el servicio no pudo
+    vigilar: su código nunca llegaría y el worker agotaría el plazo esperándolo.
+    --resume y --only-new los vuelven a intentar. Devuelve las tareas que sí se reparten.
+    """
+    failed = set(watched['failed'])
     for task in tasks:
-        p = Process(target=run_node_worker, args=(task['phone_number'], task['serial'], task['appium_port']))
-        processes.append(p)
-    
-    # Primero se inician TODOS
-    for p in processes:
-        p.start()
-        
-    # Y después se espera a que TODOS terminen
-    for p in processes:
-        p.join()
+        if task['modem_port'] in failed:
+            logger.error(f"El módem {task['modem_port']} de {task['phone_number']} no está vigilado; la tarea se da por fallida.")
+            db.record_task(task, "done", outcome="MODEM_UNAVAILABLE")
+    db.flush()
+    return [task for task in tasks if task['modem_port'] not in failed]
 
-    logger.info("--- Fase 5: Todos los workers han finalizado. Deteniendo monitor de SMS... ---")
+def stop_sms_monitor(monitor_process: subprocess.Popen | None) -> None:
     if monitor_process and monitor_process.poll() is None:
         monitor_process.terminate()
         try:
@@ -144,7 +333,182 @@ def main() -> None:
         except subprocess.TimeoutExpired:
             monitor_process.kill()
         logger.info("Monitor de SMS detenido.")
-    
+
+def runner_factory(farm_cfg: FarmConfig, results_in_db: bool, on_worker_event=None):
+    """Construye el DeviceRunner de cada dispositivo según FarmConfig.persistent_workers."""
+    worker_env = {"CODE_BROKER_HOST": BrokerConfig.host, "CODE_BROKER_PORT": str(BrokerConfig.port)}
+    command = farm_cfg.worker_command or None
+    if not farm_cfg.persistent_workers:
+        # En modo spawn solo vuelve el código de salida: el worker sigue escribiendo sus num_*.txt
+        return lambda device: SpawnRunner(device, farm_cfg.worker_timeout, worker_env, command)
+    # Con SQLite el orquestador guarda los resultados; el worker no escribe los num_*.txt
+    if results_in_db:
+        worker_env["FARM_RESULTS_SINK"] = "orchestrator"
+    return lambda device: PersistentRunner(device, farm_cfg.worker_timeout, farm_cfg.prepare_ahead,
+                                           worker_env, on_worker_event, command)
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Orquestador de la granja: detecta módems, reparte las SIMs y lanza los workers.")
+    parser.add_argument("--resume", nargs="?", const="latest", metavar="RUN_ID",
+                        help="Reanuda una ejecución (por defecto la última): salta los números terminados "
+                             "y vuelve a lanzar los que quedaron a medias.")
+    parser.add_argument("--only-new", action="store_true",
+                        help="Omite las SIMs (ICCID o número) que ya tienen un resultado concluyente.")
+    return parser.parse_args(argv)
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    # main.py es el dueño de sms.txt; el monitor le envía sus registros (FARM_LOG_SOCKET)
+    init_logging(LoggingConfig.log_file, LoggingConfig.log_level, serve=True)
+    db_cfg = DBConfig()
+    try:
+        modem_cfg = ModemConfig()
+        farm_cfg = FarmConfig()
+    except (InventoryError, OSError) as e:
+        logger.error(f"Inventario de la granja no válido: {e}. Finalizando.")
+        return
+
+    if (args.resume or args.only_new) and not db_cfg.use_sqlite:
+        logger.error("--resume y --only-new necesitan la base SQLite (DBConfig.use_sqlite). Finalizando.")
+        return
+    db = DBManager(db_cfg.results_file, db_cfg.database if db_cfg.use_sqlite else None, db_cfg.batch_size)
+
+    # Diario de la ejecución que se reanuda: puerto -> estado de su tarea
+    journal = {}
+    if args.resume:
+        run_id = db.latest_run_id() if args.resume == "latest" else args.resume
+        journal = db.read_journal(run_id) if run_id else {}
+        if not journal:
+            logger.error(f"No hay ninguna ejecución '{args.resume}' que reanudar. Finalizando.")
+            return
+        db.run_id = run_id
+        finished = sum(1 for entry in journal.values()
+                       if entry['state'] == "done" and entry['outcome'] != "MODEM_UNAVAILABLE")
+        logger.info(f"Reanudando la ejecución {run_id}: {finished} de {len(journal)} puertos ya terminados.")
+    elif db_cfg.results_file.exists():
+        db_cfg.results_file.unlink()
+
+    exporter = metrics.start_exporter("main", MetricsConfig.main_http_port)
+
+    logger.info("--- Fase 1: Recolectando información de módems ---")
+    monitor_process = None
+    try:
+        monitor_process, modem_service = start_modem_service(modem_cfg)
+        logger.info(f"Servicio de módems iniciado (PID: {monitor_process.pid}).")
+        sim_data_map, skipped_ports = detect_modems(db, modem_cfg, journal, modem_service)
+    except ModemServiceError as e:
+        logger.error(f"{e}. Finalizando.")
+        stop_sms_monitor(monitor_process)
+        db.close()
+        if exporter:
+            exporter.stop()
+        return
+
+    if args.only_new:
+        known = db.completed_identifiers()
+        for port, sim_info in list(sim_data_map.items()):
+            if sim_info['phone_number'] in known or sim_info.get('sim_number_icc_id') in known:
+                db.record_task(sim_info, "done", outcome="ALREADY_DONE")
+                del sim_data_map[port]
+                skipped_ports.add(port)
+        db.flush()
+        logger.info(f"Modo solo SIMs nuevas: quedan {len(sim_data_map)} SIMs sin resultado previo.")
+
+    logger.info("--- Fase 2: Mapeando SIMs a dispositivos ---")
+    try:
+        inventory = farm_inventory(farm_cfg)
+    except (InventoryError, OSError) as e:
+        logger.error(f"Inventario de la granja no válido: {e}. Finalizando.")
+        stop_sms_monitor(monitor_process)
+        if exporter:
+            exporter.stop()
+        return
+    device_map = {device['serial']: device for device in farm_cfg.devices}
+    tasks = build_tasks(inventory, sim_data_map, skipped_ports, device_map)
+
+    if not tasks:
+        logger.error(f"No se crearon tareas. Verifique {Path(inventory.source).name} y los módems. Finalizando.")
+        stop_sms_monitor(monitor_process)
+        if exporter:
+            exporter.stop()
+        return
+
+    devices = select_devices(farm_cfg, tasks)
+    if not devices:
+        logger.error("No hay dispositivos disponibles para procesar las tareas. Finalizando.")
+        stop_sms_monitor(monitor_process)
+        if exporter:
+            exporter.stop()
+        return
+
+    logger.info(f"Se han creado {len(tasks)} tareas para procesar en {len(devices)} dispositivos.")
+
+    logger.info("--- Fase 3: Pasando los módems de las tareas a monitorización de SMS ---")
+    try:
+        watched = watch_sims(db, tasks, modem_service)
+    except ModemServiceError as e:
+        logger.error(f"{e}. Finalizando.")
+        stop_sms_monitor(monitor_process)
+        db.close()
+        if exporter:
+            exporter.stop()
+        return
+    # La respuesta de 'watch' llega cuando los módems ya están vigilados: los workers arrancan sin más espera
+    tasks = fail_unwatched(db, tasks, watched)
+    logger.info(f"Monitor de SMS vigilando {len(watched['live'])} módems; {len(watched['failed'])} sin conexión.")
+    if not tasks:
+        logger.error("Ningún módem de las tareas quedó vigilado. Finalizando.")
+        stop_sms_monitor(monitor_process)
+        db.close()
+        if exporter:
+            exporter.stop()
+        return
+
+    logger.info("--- Fase 4: Repartiendo las tareas entre los dispositivos ---")
+    # El diario se vuelca en cada cambio de estado para que --resume vea el punto exacto
+    def journal_task(device_serial: str, task: dict, state: str, outcome: str | None = None) -> None:
+        db.record_task(task, state, device_serial, outcome)
+        db.flush()
+
+    def store_result(device_serial: str, task: dict, outcome: dict, elapsed: float) -> None:
+        status = outcome.get('status', 'UNKNOWN')
+        db.record_outcome(task, device_serial, status, elapsed, outcome.get('stages'))
+        journal_task(device_serial, task, "done", status)
+
+    def on_worker_event(device_serial: str, task: dict, event: dict) -> None:
+        if event.get('event') == "awaiting_code":
+            journal_task(device_serial, task, "awaiting_code")
+
+    dispatcher = TaskDispatcher(tasks, max_workers=farm_cfg.max_workers, on_result=store_result,
+                                on_dispatch=lambda serial, task: journal_task(serial, task, "dispatched"))
+    make_runner = runner_factory(farm_cfg, bool(db.db_path), on_worker_event)
+    # Solo se exportan los resultados de esta invocación (al reanudar ya se exportaron los anteriores)
+    first_outcome_id = db.last_outcome_id() if db.db_path else 0
+    # Teléfonos y módems que se desconectan o vuelven durante la ejecución
+    tracker = None
+    if HotplugConfig.enabled:
+        tracker = DeviceTracker(AdbClient(), modem_cfg.ports, poll_interval=HotplugConfig.poll_interval)
+        tracker.subscribe(lambda event: apply_hotplug_event(dispatcher, device_map, event))
+        tracker.start()
+    try:
+        elapsed = dispatcher.run(devices, make_runner, HotplugConfig.device_wait if tracker else 0.0)
+    finally:
+        if tracker:
+            tracker.stop()
+        if db.db_path:
+            exported = db.export_status_files(BASE_DIR, after_id=first_outcome_id)
+            logger.info(f"Resultados guardados en {db_cfg.database.name} y exportados: {exported}")
+        db.close()
+        if exporter:
+            exporter.stop()
+
+    logger.info(f"Rendimiento por dispositivo ({elapsed:.0f}s en total):")
+    for line in dispatcher.summary_lines(elapsed):
+        logger.info(line)
+
+    logger.info("--- Fase 5: Todos los workers han finalizado. Deteniendo monitor de SMS... ---")
+    stop_sms_monitor(monitor_process)
+
     logger.info("=======================================")
     logger.info("=     PROCESO DE LA GRANJA COMPLETO     =")
     logger.info("=======================================")
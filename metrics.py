@@ -0,0 +1,324 @@
+"""
+In-process metrics: counters and latency histograms for every pipeline phase.
+
+Cada proceso (main.py, sms_monitor.py) tiene su propio registro. Las métricas
+se exportan en formato texto de Prometheus (endpoint HTTP opcional) y/o se
+vuelcan periódicamente a un JSON en MetricsConfig.json_dir. Las etapas del
+worker de Node llegan a main.py en sus eventos y se registran allí.
+"""
+from __future__ import annotations
+
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Límites superiores (segundos) por defecto: de comandos AT de milisegundos a esperas de SMS de minutos
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} espera las etiquetas {self.labelnames}, recibió {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+
+class Counter(_Metric):
+    """Contador monótono con etiquetas."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> Dict[LabelValues, float]:
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value:g}" for key, value in self.samples().items()]
+
+    def snapshot(self) -> List[Dict]:
+        return [{"labels": dict(zip(self.labelnames, key)), "value": value} for key, value in self.samples().items()]
+
+
+class _HistogramSeries:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, size: int) -> None:
+        self.counts = [0] * size
+        self.total = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """Histograma de latencias con cubetas fijas (acumuladas al exportar, como Prometheus)."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[LabelValues, _HistogramSeries] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _HistogramSeries(len(self.buckets) + 1)
+            series.counts[position] += 1
+            series.total += value
+            series.count += 1
+
+    def time(self, **labels: str) -> "_Timer":
+        """Context manager que observa la duración del bloque."""
+        return _Timer(self, labels)
+
+    def _copy(self) -> Dict[LabelValues, Tuple[List[int], float, int]]:
+        with self._lock:
+            return {key: (list(s.counts), s.total, s.count) for key, s in self._series.items()}
+
+    def quantile(self, q: float, **labels: str) -> Optional[float]:
+        """Cuantil aproximado (límite superior de la cubeta que lo contiene)."""
+        series = self._copy().get(self._key(labels))
+        if not series or not series[2]:
+            return None
+        return self._quantile(series[0], series[2], q)
+
+    def _quantile(self, counts: List[int], count: int, q: float) -> float:
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._copy().items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total:g}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def snapshot(self) -> List[Dict]:
+        def bound(value: Optional[float]):
+            return "+Inf" if value == float("inf") else value
+
+        series = []
+        for key, (counts, total, count) in self._copy().items():
+            series.append({
+                "labels": dict(zip(self.labelnames, key)),
+                "count": count,
+                "sum": round(total, 6),
+                "mean": round(total / count, 6) if count else None,
+                "p50": bound(self._quantile(counts, count, 0.5)) if count else None,
+                "p99": bound(self._quantile(counts, count, 0.99)) if count else None,
+                "buckets": {("+Inf" if b == float("inf") else f"{b:g}"): c
+                            for b, c in zip(self.buckets + (float("inf"),), counts) if c},
+            })
+        return series
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]) -> None:
+        self.histogram = histogram
+        self.labels = labels
+        self.started = 0.0
+
+    def __enter__(self) -> "_Timer":
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.monotonic() - self.started, **self.labels)
+
+
+class Registry:
+    """Registro de métricas de un proceso; counter()/histogram() devuelven la existente si ya está creada."""
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"La métrica {name} ya existe como {metric.kind}")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def metrics(self) -> Iterable[_Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict:
+        return {
+            "timestamp": time.time(),
+            "pid": os.getpid(),
+            "metrics": {
+                metric.name: {"type": metric.kind, "help": metric.documentation, "series": metric.snapshot()}
+                for metric in self.metrics()
+            },
+        }
+
+    def write_json(self, path: Path) -> None:
+        """Escribe el snapshot de forma atómica (archivo temporal + rename)."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(path.suffix + ".tmp")
+        tmp.write_text(json.dumps(self.snapshot(), indent=2), encoding="utf-8")
+        os.replace(tmp, path)
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.counter(name, documentation, labelnames)
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.histogram(name, documentation, labelnames, buckets)
+
+
+class MetricsExporter:
+    """Exporta un registro: endpoint /metrics (Prometheus) y/o volcado JSON periódico."""
+
+    def __init__(self, registry: Registry = REGISTRY, json_path: Optional[Path] = None,
+                 flush_interval: float = 15.0, http_host: str = "127.0.0.1", http_port: int = 0) -> None:
+        self.registry = registry
+        self.json_path = json_path
+        self.flush_interval = flush_interval
+        self.http_host = http_host
+        self.http_port = http_port
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        if self.http_port:
+            registry = self.registry
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self) -> None:
+                    if self.path.split("?")[0] != "/metrics":
+                        self.send_error(404)
+                        return
+                    body = registry.render_prometheus().encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format: str, *args) -> None:
+                    pass
+
+            try:
+                self._server = ThreadingHTTPServer((self.http_host, self.http_port), Handler)
+            except OSError as e:
+                logger.warning(f"No se pudo abrir el endpoint de métricas en {self.http_host}:{self.http_port}: {e}")
+            else:
+                self._threads.append(threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True))
+                logger.info(f"Métricas Prometheus en http://{self.http_host}:{self.http_port}/metrics")
+        if self.json_path:
+            self._threads.append(threading.Thread(target=self._flush_loop, name="metrics-json", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.json_path:
+            return
+        try:
+            self.registry.write_json(self.json_path)
+        except OSError as e:
+            logger.warning(f"No se pudieron volcar las métricas a {self.json_path}: {e}")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+        self.flush()
+
+
+def start_exporter(process_name: str, http_port: int = 0) -> Optional[MetricsExporter]:
+    """Arranca el exportador del proceso según MetricsConfig; None si las métricas están desactivadas."""
+    from config import MetricsConfig
+
+    if not MetricsConfig.enabled:
+        return None
+    exporter = MetricsExporter(
+        json_path=MetricsConfig.json_dir / f"{process_name}.json",
+        flush_interval=MetricsConfig.flush_interval,
+        http_host=MetricsConfig.http_host,
+        http_port=http_port,
+    )
+    exporter.start()
+    return exporter
@@ -6,19 +6,137 @@ from __future__ import annotations
 import logging
 import time
 import re
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, List, Optional
 import serial
 
+import metrics
+from sms_pdu import ConcatBuffer, parse_cmgl_pdu, parse_cmgr_pdu
+
 logger = logging.getLogger(__name__)
 
+# Códigos de resultado final que cierran la respuesta de un comando AT.
+FINAL_RESULT_CODES = ("OK", "ERROR")
+FINAL_RESULT_PREFIXES = ("+CME ERROR", "+CMS ERROR")
+# Intervalo de sondeo del buffer serie mientras se espera la respuesta.
+POLL_INTERVAL = 0.01
+# URC de nuevo SMS almacenado: +CMTI: "<mem>",<index>
+CMTI_PATTERN = re.compile(r'\+CMTI:\s*"([^"]*)",\s*(\d+)')
+# Respuesta de lectura individual en modo texto: +CMGR: <stat>,<oa>,...\r\n<cuerpo>
+CMGR_PATTERN = re.compile(
+    r'\+CMGR:\s*"([^"]*)",([^\r\n]*)\r\n(.*?)(?=\r\nOK|\r\nERROR|$)',
+    re.DOTALL
+)
+# SMS listados con AT+CMGL en modo texto. La cabecera varía según el módem
+# (<alpha> vacío con o sin comillas), así que el resto de la línea se captura
+# entero y se reparte después con QUOTED_FIELD_PATTERN.
+CMGL_PATTERN = re.compile(
+    r'\+CMGL:\s*(\d+),\s*"([^"]*)",([^\r\n]*)\r\n(.*?)(?=\r\n\+CMGL:|\r\nOK|\r\nERROR|$)',
+    re.DOTALL | re.IGNORECASE
+)
+QUOTED_FIELD_PATTERN = re.compile(r'"([^"]*)"')
+ICCID_PATTERN = re.compile(r'\d{18,22}')
+PHONE_NUMBER_PATTERN = re.compile(r'"(\+?\d{7,15})"')
+# Nombre del comando AT sin argumentos (AT+CMGR=3 -> AT+CMGR) para etiquetar métricas
+AT_COMMAND_NAME_PATTERN = re.compile(r'^(AT[+&]?[A-Z]*)', re.IGNORECASE)
+
+AT_COMMAND_SECONDS = metrics.histogram(
+    "modem_at_command_seconds", "Latencia de los comandos AT hasta el código de resultado final.", ("command", "port"))
+AT_COMMAND_TIMEOUTS = metrics.counter(
+    "modem_at_command_timeouts_total", "Comandos AT sin código de resultado final dentro del plazo.", ("command", "port"))
+CMGL_ROUND_SECONDS = metrics.histogram(
+    "sms_cmgl_round_seconds", "Duración de un barrido AT+CMGL (lectura y parseo).", ("port",))
+
+
+def is_final_response(buffer: bytes) -> bool:
+    """Indica si el buffer termina en un código de resultado final (OK, ERROR, +CME/+CMS ERROR)."""
+    if not buffer.endswith(b"\n"):
+        return False
+    text = buffer.decode('utf-8', errors='ignore').rstrip()
+    last_line = text.rsplit("\n", 1)[-1].strip()
+    return last_line in FINAL_RESULT_CODES or last_line.startswith(FINAL_RESULT_PREFIXES)
+
+
+def at_command_name(command: str) -> str:
+    """Nombre del comando AT sin parámetros, para no disparar la cardinalidad de las métricas."""
+    match = AT_COMMAND_NAME_PATTERN.match(command.strip())
+    return match.group(1).upper() if match else "OTHER"
+
+
+def parse_indications(text: str) -> List[str]:
+    """Devuelve los índices de SMS notificados por +CMTI en `text`."""
+    return [match.group(2) for match in CMTI_PATTERN.finditer(text)]
+
+
+def parse_iccid(response: str) -> Optional[str]:
+    """Extrae el ICCID de la respuesta a AT+CCID."""
+    match = ICCID_PATTERN.search(response)
+    return match.group(0).strip() if match else None
+
+
+def parse_phone_number(response: str) -> Optional[str]:
+    """Extrae el MSISDN de la respuesta a AT+CNUM o AT+CPBR."""
+    match = PHONE_NUMBER_PATTERN.search(response)
+    return match.group(1).strip() if match else None
+
+
+def _build_message(index: str, status: str, header: str, content: str) -> Dict[str, str]:
+    """Arma el dict de un SMS a partir de la cabecera de CMGL/CMGR (<oa>,[<alpha>],<scts>)."""
+    fields = QUOTED_FIELD_PATTERN.findall(header)
+    return {
+        "content": content.strip(),
+        "index": str(index).strip(),
+        "status": status,
+        "sender": fields[0] if fields else "",
+        "timestamp": fields[-1] if len(fields) >= 2 else "",
+    }
+
+
+def cmgl_command(unread_only: bool, pdu_mode: bool) -> str:
+    """AT+CMGL para todos los SMS o solo los no leídos, en modo texto o PDU."""
+    if pdu_mode:
+        return "AT+CMGL=0" if unread_only else "AT+CMGL=4"
+    return "AT+CMGL=\"REC UNREAD\"" if unread_only else "AT+CMGL=\"ALL\""
+
+
+def parse_cmgl(response: str) -> List[Dict[str, str]]:
+    """Parsea el listado de AT+CMGL en modo texto."""
+    return [
+        _build_message(match.group(1), match.group(2), match.group(3), match.group(4))
+        for match in CMGL_PATTERN.finditer(response)
+    ]
+
+
+def parse_cmgr(response: str, index: str) -> Optional[Dict[str, str]]:
+    """Parsea la respuesta de AT+CMGR en modo texto; None si la posición está vacía."""
+    match = CMGR_PATTERN.search(response)
+    if not match:
+        return None
+    return _build_message(index, match.group(1), match.group(2), match.group(3))
+
+
+def message_indices(messages: Iterable[Dict[str, str]]) -> List[str]:
+    """Índices en la SIM de los mensajes, incluidas todas las partes de un SMS reensamblado."""
+    return [index for message in messages for index in message.get("parts", message["index"]).split(",")]
+
+
 class ModemController:
-    def __init__(self, port: str, baudrate: int = 115200, timeout: float = 1.0):
+    def __init__(self, port: str, baudrate: int = 115200, timeout: float = 1.0, pdu_mode: bool = False):
         self.port = port
         self.baudrate = baudrate
         self.timeout = timeout
+        # Modo PDU (AT+CMGF=0): decodificación binaria con soporte UCS2 y SMS concatenados
+        self.pdu_mode = pdu_mode
+        self._concat = ConcatBuffer()
         self.serial: Optional[serial.Serial] = None
         self._phone_number: Optional[str] = None
         self._sim_icc_id: Optional[str] = None
+        # Índices de SMS notificados por +CMTI y aún no leídos
+        self._pending_indices: List[str] = []
+        # Instante (time.time) en que llegó el +CMTI de cada índice, para medir latencias
+        self.indication_times: Dict[str, float] = {}
+        # Fragmento de línea URC incompleta pendiente de completar
+        self._urc_buffer = bytearray()
+        self.push_enabled = False
 
     def connect(self) -> None:
         logger.debug(f"Connecting to modem on {self.port}")
@@ -27,7 +145,7 @@ class ModemController:
             time.sleep(0.5) 
             self.send_command("AT", wait=0.2)
             self.send_command("ATE0", wait=0.2)
-            self.send_command("AT+CMGF=1", wait=0.2)
+            self.send_command("AT+CMGF=0" if self.pdu_mode else "AT+CMGF=1", wait=0.2)
             logger.info(f"Conectado y configurado módem en {self.port}.")
         except serial.SerialException as e:
             logger.error(f"Error al conectar con el módem en {self.port}: {e}")
@@ -39,10 +157,13 @@ class ModemController:
             logger.debug(f"Disconnecting from modem on {self.port}")
             self.serial.close()
             self.serial = None
+        self.push_enabled = False
 
     def send_command(self, command: str, wait: float = 0.5) -> str:
         """
         Envía un comando AT al módem y devuelve la respuesta.
+        `wait` es el tiempo máximo de espera: la lectura termina en cuanto llega
+        un código de resultado final, sin agotar el plazo completo.
         Añade depuración detallada para entender la comunicación.
         """
         if not self.serial or not self.serial.is_open:
@@ -50,55 +171,144 @@ class ModemController:
             return ""
         try:
             full_command = f"{command}\r\n"
+            started = time.monotonic()
             self.serial.write(full_command.encode('utf-8'))
             logger.debug(f"Enviado a {self.port}: '{command}'")
             
-            time.sleep(wait)
-
-            response_bytes = self.serial.read_all()
+            response_bytes = self._read_response(wait)
+            name = at_command_name(command)
+            AT_COMMAND_SECONDS.observe(time.monotonic() - started, command=name, port=self.port)
+            if not is_final_response(response_bytes):
+                AT_COMMAND_TIMEOUTS.inc(command=name, port=self.port)
             response = response_bytes.decode('utf-8', errors='ignore').strip()
+            # Un +CMTI puede llegar intercalado con la respuesta de cualquier comando
+            self._collect_indications(response)
             
-            logger.debug(f"Respuesta cruda (bytes) de {self.port}: {response_bytes.hex()}") 
-            logger.debug(f"Respuesta decodificada de {self.port}: '{response}'")
+            # El volcado hexadecimal solo se construye si DEBUG está activo
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Respuesta cruda (bytes) de {self.port}: {response_bytes.hex()}")
+                logger.debug(f"Respuesta decodificada de {self.port}: '{response}'")
             
             return response
         except Exception as e:
             logger.error(f"Error al enviar el comando '{command}' al módem en {self.port}: {e}", exc_info=True)
             return ""
 
-    def read_phone_number_from_modem(self) -> None:
+    def _read_response(self, timeout: float) -> bytes:
+        """Lee del puerto hasta recibir un código de resultado final o agotar `timeout`."""
+        deadline = time.monotonic() + timeout
+        # Se antepone cualquier URC a medias para no perder su final
+        buffer = bytearray(self._urc_buffer)
+        self._urc_buffer.clear()
+        while True:
+            waiting = self.serial.in_waiting
+            if waiting:
+                buffer += self.serial.read(waiting)
+                if is_final_response(buffer):
+                    break
+            if time.monotonic() >= deadline:
+                logger.debug(f"Plazo de {timeout}s agotado en {self.port} sin código de resultado final.")
+                break
+            if not waiting:
+                time.sleep(POLL_INTERVAL)
+        return bytes(buffer)
+
+    def _collect_indications(self, text: str) -> None:
+        """Registra los índices de los +CMTI presentes en `text`."""
+        for index in parse_indications(text):
+            if index not in self._pending_indices:
+                self._pending_indices.append(index)
+                self.indication_times.setdefault(index, time.time())
+                logger.debug(f"+CMTI recibido en {self.port}: índice {index}.")
+
+    def enable_new_message_indications(self) -> bool:
         """
-        Intenta leer el número de teléfono (MSISDN) y el ICCID de la SIM.
+        Configura el módem para notificar cada SMS nuevo con un URC +CMTI
+        (AT+CNMI=2,1,0,0,0). Devuelve True si el módem aceptó la configuración.
         """
-        self._phone_number = None
+        response = self.send_command("AT+CNMI=2,1,0,0,0", wait=1.0)
+        self.push_enabled = response.endswith("OK")
+        if self.push_enabled:
+            logger.info(f"Notificaciones +CMTI activadas en {self.port}.")
+        else:
+            logger.warning(f"El módem en {self.port} rechazó AT+CNMI: '{response}'")
+        return self.push_enabled
+
+    def poll_new_message_indices(self) -> List[str]:
+        """
+        Lee sin bloquear los URC pendientes en el puerto y devuelve los índices
+        de SMS notificados por +CMTI desde la última llamada.
+        """
+        if not self.serial or not self.serial.is_open:
+            return []
+        try:
+            waiting = self.serial.in_waiting
+            if waiting:
+                self._urc_buffer += self.serial.read(waiting)
+                complete, separator, rest = self._urc_buffer.rpartition(b"\n")
+                if separator:
+                    self._collect_indications(complete.decode('utf-8', errors='ignore'))
+                    self._urc_buffer = bytearray(rest)
+        except Exception as e:
+            logger.error(f"Error al leer URCs en {self.port}: {e}")
+        indices, self._pending_indices = self._pending_indices, []
+        return indices
+
+    def is_responsive(self, wait: float = 0.5) -> bool:
+        """Comprueba que el puerto responde OK a un AT simple."""
+        return self.send_command("AT", wait=wait).endswith("OK")
+
+    @staticmethod
+    def _budget(wait: float, deadline: Optional[float]) -> float:
+        """Limita la espera de un comando al tiempo restante hasta `deadline` (time.monotonic)."""
+        if deadline is None:
+            return wait
+        return min(wait, deadline - time.monotonic())
+
+    def read_iccid(self, deadline: Optional[float] = None) -> Optional[str]:
+        """Lee el ICCID de la SIM (AT+CCID); es la consulta barata que identifica la SIM."""
         self._sim_icc_id = None
-        
         try:
-            response_ccid = self.send_command("AT+CCID", wait=1.0)
-            match_ccid = re.search(r'\d{18,22}', response_ccid)
-            if match_ccid:
-                self._sim_icc_id = match_ccid.group(0).strip()
+            response_ccid = self.send_command("AT+CCID", wait=self._budget(1.0, deadline))
+            self._sim_icc_id = parse_iccid(response_ccid)
+            if self._sim_icc_id:
                 logger.info(f"ICCID encontrado para {self.port}: {self._sim_icc_id}")
             else:
                  logger.warning(f"No se pudo parsear un ICCID de la respuesta en {self.port}: '{response_ccid}'")
         except Exception as e:
             logger.error(f"Error al obtener ICCID en {self.port}: {e}")
+        return self._sim_icc_id
+
+    def read_phone_number_from_modem(self, deadline: Optional[float] = None) -> None:
+        """
+        Intenta leer el número de teléfono (MSISDN) y el ICCID de la SIM.
+        Si se indica `deadline` (time.monotonic), los pasos que no quepan en el
+        plazo restante se omiten.
+        """
+        self._phone_number = None
+        self.read_iccid(deadline)
+
+        if self._budget(2.0, deadline) <= 0:
+            logger.warning(f"Plazo agotado en {self.port} antes de consultar el número de teléfono.")
+            return
 
         try:
-            response_cnum = self.send_command("AT+CNUM", wait=2.0)
-            match_cnum = re.search(r'\"(\+?\d{7,15})\"', response_cnum)
-            if match_cnum:
-                self._phone_number = match_cnum.group(1).strip()
+            response_cnum = self.send_command("AT+CNUM", wait=self._budget(2.0, deadline))
+            self._phone_number = parse_phone_number(response_cnum)
+            if self._phone_number:
                 logger.info(f"Número de teléfono (CNUM) encontrado para {self.port}: {self._phone_number}")
                 return
         except Exception as e:
             logger.error(f"Error al obtener número (CNUM) en {self.port}: {e}")
         
+        if self._budget(2.0, deadline) <= 0:
+            logger.warning(f"Plazo agotado en {self.port} antes de consultar la agenda de la SIM.")
+            return
+
         try:
-            response_cpbr = self.send_command("AT+CPBR=1", wait=2.0)
-            match_cpbr = re.search(r'"(\+?\d{7,15})"', response_cpbr)
-            if match_cpbr:
-                self._phone_number = match_cpbr.group(1).strip()
+            response_cpbr = self.send_command("AT+CPBR=1", wait=self._budget(2.0, deadline))
+            self._phone_number = parse_phone_number(response_cpbr)
+            if self._phone_number:
                 logger.info(f"Número de teléfono (CPBR) encontrado para {self.port}: {self._phone_number}")
                 return
         except Exception as e:
@@ -107,43 +317,95 @@ class ModemController:
         if not self._phone_number:
             logger.warning(f"No se pudo determinar el número de teléfono para el módem en {self.port}.")
 
-    def read_sms(self) -> List[Dict[str, str]]:
+    def read_sms(self, unread_only: bool = False, delete: bool = True) -> List[Dict[str, str]]:
         """
-        Lee todos los SMS almacenados y los ELIMINA después de leerlos.
+        Lee los SMS almacenados (todos, o solo los no leídos con `unread_only`).
+        Con `delete` los ELIMINA después de leerlos (uno a uno, por índice);
+        con delete=False el llamador debe invocar delete_messages() tras procesarlos.
+        En modo PDU solo se devuelven los SMS completos: las partes de un SMS
+        concatenado esperan en el buffer de reensamblado, y en la SIM, hasta
+        tenerlas todas; así un reinicio del monitor no pierde el mensaje.
         """
         if not self.serial or not self.serial.is_open:
             logger.warning(f"Puerto {self.port} no está conectado o abierto para leer SMS.")
             return []
 
         messages = []
+        command = cmgl_command(unread_only, self.pdu_mode)
+        started = time.monotonic()
         try:
-            # Aumentamos significativamente el tiempo de espera para CMGL
-            logger.debug(f"Enviando AT+CMGL=\"ALL\" a {self.port}...")
-            response = self.send_command("AT+CMGL=\"ALL\"", wait=10.0) # <-- TIEMPO DE ESPERA AUMENTADO
+            # Plazo máximo amplio para CMGL; la lectura vuelve en cuanto llega el OK final
+            logger.debug(f"Enviando {command} a {self.port}...")
+            response = self.send_command(command, wait=10.0)
             
-            # Registrar la respuesta cruda para depuración
-            if response:
+            # Registrar la respuesta cruda para depuración (solo con DEBUG activo)
+            if not response:
+                logger.debug(f"Comando {command} en {self.port} no devolvió respuesta.")
+            elif logger.isEnabledFor(logging.DEBUG):
                 logger.debug(f"Respuesta cruda completa de CMGL en {self.port}:\n---INICIO_CMGL_RAW---\n{response}\n---FIN_CMGL_RAW---")
-            else:
-                logger.debug(f"Comando AT+CMGL=\"ALL\" en {self.port} no devolvió respuesta.")
             
-            # Patrón más robusto para SMS. 
-            sms_pattern = re.compile(
-                r'\+CMGL:\s*(\d+),\"([^\"]*)\",\"([^\"]*)\",\"([^\"]*)\"\r\n(.*?)(?=\r\n\+CMGL:|\r\nOK|\r\nERROR|$)', 
-                re.DOTALL | re.IGNORECASE
-            )
-            matches = sms_pattern.finditer(response)
-            
-            for match in matches:
-                sms_index = match.group(1).strip()
-                content = match.group(5).strip() 
-                messages.append({"content": content, "index": sms_index}) 
-                
-                # Borrar el mensaje de la SIM para no procesarlo de nuevo.
-                self.send_command(f"AT+CMGD={sms_index}", wait=0.5) 
-                logger.debug(f"SMS con índice {sms_index} eliminado de {self.port}.")
+            if self.pdu_mode:
+                stored = parse_cmgl_pdu(response)
+                # Las partes de SMS abandonados (incompletos tras el ttl) se borran también de la SIM
+                expired = {part["index"] for part in self._concat.expire()}
+                if expired:
+                    self.delete_messages(expired)
+                messages = self._concat.collect([message for message in stored if message["index"] not in expired])
+            else:
+                messages = parse_cmgl(response)
+            if delete and messages:
+                # Solo los mensajes completos (con todas sus partes): lo que espera reensamblado sigue en la SIM
+                self.delete_messages(message_indices(messages))
         
         except Exception as e:
             logger.error(f"Error al leer o procesar SMS en {self.port}: {e}", exc_info=True)
         
+        CMGL_ROUND_SECONDS.observe(time.monotonic() - started, port=self.port)
         return messages
+
+    def read_sms_at(self, index: str, delete: bool = True) -> Optional[Dict[str, str]]:
+        """
+        Lee un único SMS por su índice (AT+CMGR) y, con `delete`, lo ELIMINA después de leerlo.
+        Devuelve None si la posición está vacía o la lectura falla. Una parte de
+        un SMS concatenado devuelve None y sigue en la SIM hasta completarlo;
+        entonces se borran todas sus partes.
+        """
+        if not self.serial or not self.serial.is_open:
+            logger.warning(f"Puerto {self.port} no está conectado o abierto para leer SMS.")
+            return None
+
+        try:
+            response = self.send_command(f"AT+CMGR={index}", wait=2.0)
+            message = parse_cmgr_pdu(response, index) if self.pdu_mode else parse_cmgr(response, index)
+            if not message:
+                logger.debug(f"AT+CMGR={index} en {self.port} no devolvió un SMS: '{response}'")
+                return None
+            complete = self._concat.add(message) if self.pdu_mode else message
+            if delete and complete:
+                self.delete_messages(message_indices([complete]))
+            return complete
+        except Exception as e:
+            logger.error(f"Error al leer el SMS {index} en {self.port}: {e}", exc_info=True)
+            return None
+
+    def delete_messages(self, indices: Iterable[str]) -> List[str]:
+        """
+        Elimina de la SIM exactamente los SMS de `indices`, con un AT+CMGD=<index>
+        por cada uno, y devuelve los índices cuyo borrado confirmó el módem con OK.
+        Los demás mensajes de la SIM (leídos o no) no se tocan: el llamador solo
+        pasa los que ya ha procesado.
+        """
+        indices = list(dict.fromkeys(str(index) for index in indices))
+        if not indices or not self.serial or not self.serial.is_open:
+            return []
+
+        removed = []
+        for index in indices:
+            # La lectura vuelve en cuanto llega el OK; 5s es solo el plazo máximo
+            response = self.send_command(f"AT+CMGD={index}", wait=5.0)
+            if response.endswith("OK"):
+                removed.append(index)
+            else:
+                logger.warning(f"No se pudo eliminar el SMS {index} de {self.port} ('{response}').")
+        logger.debug(f"SMS con índices {removed} eliminados de {self.port}.")
+        return removed
@@ -0,0 +1,91 @@
+"""
+Persistent cache of modem identities (hardware port -> ICCID -> MSISDN).
+
+Leer el número de una SIM (AT+CNUM, AT+CPBR=1) es lo más lento de la Fase 1
+y las SIMs casi nunca cambian entre ejecuciones. La caché guarda, por
+identidad USB del puerto (VID/PID/número de serie e interfaz, o la ruta USB
+si el módem no tiene número de serie), el ICCID y el número resuelto; al
+arrancar basta un AT+CCID: si el ICCID coincide se reutiliza el número y, si
+no, la entrada se invalida y el puerto se sondea entero.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+import serial.tools.list_ports
+
+logger = logging.getLogger(__name__)
+
+
+def hardware_id(port_info) -> str:
+    """Identidad estable de un puerto de `serial.tools.list_ports`; la ruta del dispositivo si no es USB."""
+    if port_info.vid is None:
+        return f"path:{port_info.device}"
+    location = port_info.location or ""
+    if port_info.serial_number:
+        # Un mismo módem USB expone varios puertos: la interfaz los distingue
+        slot = location.rpartition(":")[2] or port_info.device
+    else:
+        # Sin iSerial (habitual en Quectel) los módems iguales solo se distinguen por la ruta USB
+        slot = location or port_info.device
+    return f"usb:{port_info.vid:04x}:{port_info.pid:04x}:{port_info.serial_number or ''}:{slot}"
+
+
+def port_hardware_ids() -> Dict[str, str]:
+    """Puerto (p. ej. /dev/ttyUSB0) -> identidad hardware, para los puertos serie presentes."""
+    return {info.device: hardware_id(info) for info in serial.tools.list_ports.comports()}
+
+
+class IdentityCache:
+    """Entradas {hardware_id: {"iccid", "phone_number", "port", "updated_at"}} en un archivo JSON."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, str]] = {}
+        self._dirty = False
+        try:
+            with path.open(encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Caché de identidad de módems ilegible en {path}: {e}. Se empieza de cero.")
+
+    def lookup(self, hardware_id: str) -> Optional[Dict[str, str]]:
+        with self._lock:
+            entry = self._entries.get(hardware_id)
+            return dict(entry) if entry else None
+
+    def store(self, hardware_id: str, port: str, iccid: str, phone_number: str) -> None:
+        with self._lock:
+            entry = self._entries.get(hardware_id)
+            if entry and (entry["iccid"], entry["phone_number"], entry["port"]) == (iccid, phone_number, port):
+                return
+            self._entries[hardware_id] = {
+                "iccid": iccid, "phone_number": phone_number, "port": port,
+                "updated_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            self._dirty = True
+
+    def invalidate(self, hardware_id: str) -> None:
+        with self._lock:
+            if self._entries.pop(hardware_id, None) is not None:
+                self._dirty = True
+
+    def save(self) -> None:
+        """Escribe la caché de forma atómica (archivo temporal + rename) si ha cambiado."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+            tmp.write_text(json.dumps(self._entries, indent=2), encoding="utf-8")
+            os.replace(tmp, self.path)
+            self._dirty = False
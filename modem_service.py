@@ -0,0 +1,257 @@
+"""
+Long-lived modem service: one process owns every serial port of the farm.
+
+sms_monitor.py --serve abre cada puerto una sola vez: lo sondea (Fase 1), lo
+deja abierto y configurado (AT, ATE0, AT+CMGF) y lo pasa a monitorización
+cuando el orquestador se lo pide, sin que main.py y el monitor se disputen los
+puertos ni se repita la conexión. Los puertos sondeados que no se vigilan se
+cierran en cuanto llega la lista de SIMs.
+
+Protocolo: JSON por líneas sobre TCP en localhost, una respuesta por petición.
+    cliente -> servicio  {"op": "probe", "ports": ["/dev/ttyUSB0", ...]}
+                         {"op": "watch", "sims": [{"modem_port", "phone_number", "sim_number_icc_id"}, ...]}
+                         {"op": "read_sms", "port": "/dev/ttyUSB0"}
+                         {"op": "status"}
+    servicio -> cliente  {"event": "ok", "probes": {puerto: {...}}}
+                         {"event": "ok", "live": [...], "failed": [...]}
+                         {"event": "ok", "messages": [...]}
+                         {"event": "ok", "open": [...], "watched": [...]}
+                         {"event": "error", "message": ...}
+
+Las peticiones las atiende el hilo (o el bucle asyncio) dueño de los puertos
+entre dos pasadas de monitorización, así que ningún puerto se usa desde dos
+hilos a la vez.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import math
+import queue
+import re
+import socket
+import socketserver
+import subprocess
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+
+from modem_controller import ModemController
+from modem_identity import IdentityCache, port_hardware_ids
+
+logger = logging.getLogger(__name__)
+
+
+class ModemServiceError(RuntimeError):
+    """El servicio de módems no responde o rechazó una petición."""
+
+
+def is_valid_phone_number(number: str) -> bool:
+    return bool(re.fullmatch(r'^\+?\d{7,20}$', number or ""))
+
+
+def probe_modem_port(port: str, modem_cfg, cached: Optional[Dict] = None,
+                     keep: Optional[Dict[str, ModemController]] = None) -> Dict:
+    """
+    Sondea un puerto serie: descarta rápido los que no responden a AT y, si es
+    un módem, lee su identificador dentro del plazo `probe_deadline`.
+    Con una entrada `cached` de la caché de identidades solo se comprueba el
+    ICCID; si coincide se reutiliza el número sin AT+CNUM/AT+CPBR.
+    Con `keep`, los módems identificados se quedan abiertos en ese diccionario.
+    """
+    started = time.monotonic()
+    deadline = started + modem_cfg.probe_deadline
+    result = {"port": port, "phone_number": None, "iccid": None, "status": "error", "elapsed": 0.0, "cached": False}
+    modem = ModemController(port, modem_cfg.baudrate, modem_cfg.timeout, modem_cfg.pdu_mode)
+    try:
+        modem.connect()
+        if not modem.is_responsive():
+            result["status"] = "no_response"
+            return result
+        if cached and modem.read_iccid(deadline) == cached["iccid"]:
+            result.update(phone_number=cached["phone_number"], iccid=cached["iccid"], status="ok", cached=True)
+            return result
+        modem.read_phone_number_from_modem(deadline=deadline)
+        phone_number = modem._phone_number if is_valid_phone_number(modem._phone_number) else modem._sim_icc_id
+        result["phone_number"] = phone_number
+        result["iccid"] = modem._sim_icc_id
+        result["status"] = "ok" if phone_number else "no_identifier"
+    except Exception as e:
+        logger.error(f"Error durante la detección en {port}: {e}")
+    finally:
+        if keep is not None and result["status"] == "ok":
+            keep[port] = modem
+        elif modem.serial and modem.serial.is_open:
+            modem.disconnect()
+        result["elapsed"] = time.monotonic() - started
+    return result
+
+
+def probe_modem_ports(ports: List[str], modem_cfg, keep: Optional[Dict[str, ModemController]] = None) -> Dict[str, Dict]:
+    """
+    Sondea todos los puertos en paralelo (como máximo `probe_workers` a la vez),
+    apoyándose en la caché de identidades si está activa.
+    """
+    probes = {}
+    if not ports:
+        return probes
+    cache = IdentityCache(modem_cfg.identity_cache_file) if modem_cfg.identity_cache else None
+    hardware_ids = port_hardware_ids() if cache else {}
+    hardware_by_port = {port: hardware_ids.get(port, f"path:{port}") for port in ports}
+    with ThreadPoolExecutor(max_workers=min(modem_cfg.probe_workers, len(ports))) as executor:
+        futures = [
+            executor.submit(probe_modem_port, port, modem_cfg,
+                            cache.lookup(hardware_by_port[port]) if cache else None, keep)
+            for port in ports
+        ]
+        for future in as_completed(futures):
+            probe = future.result()
+            probes[probe["port"]] = probe
+    if cache:
+        for port, probe in probes.items():
+            if probe["status"] == "ok" and probe["iccid"]:
+                cache.store(hardware_by_port[port], port, probe["iccid"], probe["phone_number"])
+            elif probe["status"] != "no_response":
+                # SIM cambiada, retirada o ilegible: la entrada ya no vale
+                cache.invalidate(hardware_by_port[port])
+        cache.save()
+        reused = sum(1 for probe in probes.values() if probe["cached"])
+        logger.info(f"Caché de identidades: {reused} SIMs sin cambios, {len(probes) - reused} puertos sondeados por completo.")
+    return probes
+
+
+class ServiceRequests:
+    """
+    Peticiones IPC pendientes. Los hilos del servidor las entregan con `submit`
+    y esperan la respuesta; el dueño de los puertos las recoge con `get` (o las
+    redirige a su bucle asyncio con `redirect`) y resuelve el futuro.
+    """
+
+    def __init__(self) -> None:
+        self._queue: "queue.SimpleQueue[Tuple[Dict, Future]]" = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._deliver: Callable[[Tuple[Dict, Future]], None] = self._queue.put
+
+    def submit(self, request: Dict) -> Dict:
+        future: Future = Future()
+        with self._lock:
+            self._deliver((request, future))
+        return future.result()
+
+    def redirect(self, deliver: Callable[[Tuple[Dict, Future]], None]) -> None:
+        """Entrega a `deliver` las peticiones ya encoladas y todas las siguientes."""
+        with self._lock:
+            self._deliver = deliver
+            while (item := self.get()) is not None:
+                deliver(item)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[Tuple[Dict, Future]]:
+        """Siguiente petición, o None si no llega ninguna en `timeout` segundos."""
+        try:
+            return self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+
+def resolve(future: Future, handler: Callable[[], Dict]) -> None:
+    """Ejecuta `handler` y entrega su respuesta (o el error) a quien espera `future`."""
+    try:
+        reply = handler()
+    except Exception as e:
+        logger.error(f"Error al atender una petición del servicio de módems: {e}", exc_info=True)
+        reply = {"event": "error", "message": str(e)}
+    future.set_result(reply)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    op = request["op"]
+                except (ValueError, KeyError, TypeError):
+                    reply = {"event": "error", "message": "JSON inválido"}
+                else:
+                    if op in ("probe", "watch", "read_sms", "status"):
+                        reply = self.server.requests.submit(request)
+                    else:
+                        reply = {"event": "error", "message": f"op desconocida: {op}"}
+                self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+        except ConnectionError:
+            pass
+
+
+class ModemServiceServer(socketserver.ThreadingTCPServer):
+    """Servidor IPC del servicio de módems; cada conexión en su hilo, cada petición al dueño de los puertos."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8766) -> None:
+        super().__init__((host, port), _Handler)
+        self.requests = ServiceRequests()
+
+    def start(self) -> "ModemServiceServer":
+        threading.Thread(target=self.serve_forever, name="modem-service", daemon=True).start()
+        logger.info(f"Servicio de módems escuchando en {self.server_address[0]}:{self.server_address[1]}.")
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class ModemServiceClient:
+    """Cliente del servicio de módems; una conexión por petición."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8766, timeout: float = 120.0) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+    def request(self, op: str, timeout: Optional[float] = None, **fields) -> Dict:
+        try:
+            with socket.create_connection((self.host, self.port), timeout=timeout or self.timeout) as conn:
+                conn.sendall((json.dumps({"op": op, **fields}) + "\n").encode("utf-8"))
+                line = conn.makefile("r", encoding="utf-8").readline()
+        except OSError as e:
+            raise ModemServiceError(f"Sin respuesta del servicio de módems en {self.host}:{self.port}: {e}") from e
+        if not line:
+            raise ModemServiceError(f"El servicio de módems cerró la conexión durante '{op}'.")
+        reply = json.loads(line)
+        if reply.get("event") == "error":
+            raise ModemServiceError(f"El servicio de módems rechazó '{op}': {reply.get('message')}")
+        return reply
+
+    def wait_ready(self, process: Optional[subprocess.Popen] = None, timeout: float = 30.0) -> None:
+        """Espera a que el servicio atienda peticiones; falla si su proceso termina antes."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.request("status", timeout=2.0)
+                return
+            except ModemServiceError as e:
+                if process is not None and process.poll() is not None:
+                    raise ModemServiceError(f"El servicio de módems terminó al arrancar (código {process.returncode}).") from e
+                if time.monotonic() >= deadline:
+                    raise
+            time.sleep(0.2)
+
+    def probe(self, ports: List[str], modem_cfg) -> Dict[str, Dict]:
+        """Sondeo de la Fase 1 en el servicio; los módems identificados quedan abiertos allí."""
+        if not ports:
+            return {}
+        # Plazo por tanda de `probe_workers` puertos, con margen para conectar
+        rounds = math.ceil(len(ports) / max(1, modem_cfg.probe_workers))
+        return self.request("probe", timeout=rounds * (modem_cfg.probe_deadline + 5) + 30, ports=ports)["probes"]
+
+    def watch(self, sims: List[Dict]) -> Dict[str, List[str]]:
+        """Pasa a monitorizar los puertos de `sims`; devuelve los puertos vigilados ('live') y los que fallaron."""
+        reply = self.request("watch", sims=sims)
+        return {"live": reply["live"], "failed": reply["failed"]}
+
+    def read_sms(self, port: str) -> List[Dict[str, str]]:
+        """SMS almacenados en el módem de `port`, sin borrarlos."""
+        return self.request("read_sms", port=port)["messages"]
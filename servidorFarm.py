@@ -2,32 +2,70 @@
 """
 Script de utilidad para iniciar todos los servidores Appium necesarios para la granja.
 - Incluye una función para buscar y eliminar procesos que estén ocupando los
-  puertos necesarios antes de iniciar nuevos servidores.
+  puertos necesarios antes de iniciar nuevos servidores (Windows y Linux/macOS).
 - Esto soluciona el error 'EADDRINUSE: address already in use'.
-- Optimizado para Windows.
+- Todos los servidores se lanzan a la vez y se da por listo cada uno cuando
+  responde en /status, así que el arranque dura lo que tarde el más lento.
+- Un supervisor reinicia los servidores que se caen o dejan de responder.
 """
+import json
 import subprocess
 import time
 import platform
 import os
+import shutil
 import signal
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List, Optional
 
 # Importar solo la configuración necesaria desde el archivo config
-from config import FarmConfig, BASE_DIR
+from config import FarmConfig, BASE_DIR, declared_inventory
+from inventory import InventoryError
+
+# Appium 2 expone /status; Appium 1 lo sirve bajo /wd/hub
+STATUS_PATHS = ("/status", "/wd/hub/status")
+
+
+def _pids_on_port_posix(port: int) -> List[int]:
+    """PIDs que escuchan en el puerto TCP (lsof o, si no está, fuser)."""
+    if shutil.which("lsof"):
+        result = subprocess.run(["lsof", "-t", f"-iTCP:{port}", "-sTCP:LISTEN"],
+                                capture_output=True, text=True)
+        return [int(pid) for pid in result.stdout.split() if pid.isdigit()]
+    if shutil.which("fuser"):
+        # fuser escribe los PIDs en stdout y el nombre del puerto en stderr
+        result = subprocess.run(["fuser", f"{port}/tcp"], capture_output=True, text=True)
+        return [int(pid) for pid in result.stdout.split() if pid.isdigit()]
+    print(f"No se encontró lsof ni fuser; no se puede limpiar el puerto {port}.")
+    return []
+
 
 def kill_process_on_port(port: int):
-    """Encuentra y elimina el proceso que ocupa un puerto específico (para Windows)."""
+    """Encuentra y elimina el proceso que ocupa un puerto específico."""
     if platform.system() != "Windows":
-        # Esta implementación es específica para Windows.
-        # Se puede añadir lógica para Linux/macOS si es necesario.
+        try:
+            pids = [pid for pid in _pids_on_port_posix(port) if pid != os.getpid()]
+            for pid in pids:
+                print(f"Puerto {port} está ocupado por el proceso PID {pid}. Intentando detenerlo...")
+                os.kill(pid, signal.SIGTERM)
+            deadline = time.monotonic() + 3
+            while pids and time.monotonic() < deadline:
+                time.sleep(0.2)
+                pids = [pid for pid in pids if _is_running(pid)]
+            for pid in pids:
+                os.kill(pid, signal.SIGKILL)
+        except Exception as e:
+            print(f"No se pudo limpiar el puerto {port}. Error: {e}")
         return
 
     try:
         # Comando para encontrar el PID del proceso usando el puerto
         command = f"netstat -ano | findstr :{port}"
         result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        
+
         output = result.stdout.strip()
         if not output:
             # print(f"Puerto {port} ya está libre.")
@@ -40,7 +78,7 @@ def kill_process_on_port(port: int):
                 parts = line.split()
                 pid = parts[-1]
                 print(f"Puerto {port} está ocupado por el proceso PID {pid}. Intentando detenerlo...")
-                
+
                 # Comando para matar el proceso por su PID
                 kill_command = f"taskkill /PID {pid} /F"
                 subprocess.run(kill_command, shell=True, capture_output=True, text=True)
@@ -51,18 +89,28 @@ def kill_process_on_port(port: int):
         print(f"No se pudo limpiar el puerto {port}. Error: {e}")
 
 
-def start_appium_server(port: int, log_file: Path):
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def start_appium_server(port: int, log_file: Path, append: bool = False):
     """Lanza una única instancia del servidor Appium."""
-    
+
     kill_process_on_port(port)
 
     print(f"Iniciando servidor Appium en el puerto {port}... Log en: {log_file.name}")
-    
+
     command_name = "appium.cmd" if platform.system() == "Windows" else "appium"
     command = [command_name, '-p', str(port)]
-    
+
     try:
-        with open(log_file, 'w', encoding='utf-8') as f:
+        with open(log_file, 'a' if append else 'w', encoding='utf-8') as f:
             process = subprocess.Popen(command, stdout=f, stderr=subprocess.STDOUT)
         return process
     except FileNotFoundError:
@@ -72,50 +120,150 @@ def start_appium_server(port: int, log_file: Path):
         print(f"\nERROR INESPERADO al lanzar Appium en el puerto {port}: {e}")
         return None
 
+
+def is_server_ready(port: int, timeout: float = 2.0) -> bool:
+    """True si el servidor Appium responde en /status con value.ready (o sin ese campo)."""
+    for path in STATUS_PATHS:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=timeout) as response:
+                status = json.loads(response.read().decode("utf-8") or "{}")
+        except urllib.error.HTTPError:
+            continue
+        except (urllib.error.URLError, OSError, ValueError):
+            return False
+        value = status.get("value") if isinstance(status, dict) else None
+        return not isinstance(value, dict) or value.get("ready", True) is not False
+    return False
+
+
+class AppiumServer:
+    """Un servidor Appium de la granja: proceso, puerto y estado de salud."""
+
+    def __init__(self, serial: str, port: int, log_file: Path):
+        self.serial = serial
+        self.port = port
+        self.log_file = log_file
+        self.process: Optional[subprocess.Popen] = None
+        self.restarts = 0
+        self.failed_checks = 0
+        self.ready = False
+
+    def launch(self, append: bool = False) -> bool:
+        self.ready = False
+        self.failed_checks = 0
+        self.process = start_appium_server(self.port, self.log_file, append=append)
+        return self.process is not None
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        """Sondea /status hasta que responde, el proceso muere o vence `timeout`."""
+        started = time.monotonic()
+        while time.monotonic() - started < timeout:
+            if self.process is None or self.process.poll() is not None:
+                return False
+            if is_server_ready(self.port):
+                self.ready = True
+                print(f"Servidor Appium {self.port} ({self.serial}) listo en {time.monotonic() - started:.1f}s.")
+                return True
+            time.sleep(0.5)
+        return False
+
+    def is_healthy(self, max_failed_checks: int) -> bool:
+        """El proceso sigue vivo y no ha acumulado `max_failed_checks` sondeos fallidos seguidos."""
+        if self.process is None or self.process.poll() is not None:
+            return False
+        if is_server_ready(self.port):
+            self.failed_checks = 0
+            return True
+        self.failed_checks += 1
+        return self.failed_checks < max_failed_checks
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+        self.ready = False
+
+
+def start_servers(servers: List[AppiumServer], ready_timeout: float) -> List[AppiumServer]:
+    """Limpia puertos y lanza todos los servidores en paralelo; devuelve los que quedaron listos."""
+    def bring_up(server: AppiumServer) -> bool:
+        return server.launch() and server.wait_until_ready(ready_timeout)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(servers))) as executor:
+        results = list(executor.map(bring_up, servers))
+    for server, ready in zip(servers, results):
+        if not ready and server.process is not None:
+            print(f"El servidor Appium {server.port} ({server.serial}) no respondió en {ready_timeout:.0f}s.")
+    return [server for server, ready in zip(servers, results) if ready]
+
+
+def supervise(servers: List[AppiumServer], farm_cfg: FarmConfig):
+    """Reinicia los servidores caídos o que dejan de responder en /status."""
+    while True:
+        time.sleep(farm_cfg.appium_health_interval)
+        for server in servers:
+            if server.is_healthy(farm_cfg.appium_max_failed_checks):
+                continue
+            exit_code = server.process.poll() if server.process else None
+            reason = f"terminó con código {exit_code}" if exit_code is not None else "no responde en /status"
+            print(f"Servidor Appium {server.port} ({server.serial}) {reason}. Reiniciando...")
+            server.stop()
+            server.restarts += 1
+            if server.launch(append=True) and server.wait_until_ready(farm_cfg.appium_ready_timeout):
+                print(f"Servidor Appium {server.port} reiniciado ({server.restarts} reinicios).")
+            else:
+                print(f"No se pudo reiniciar el servidor Appium {server.port}; se reintentará.")
+
+
 def main():
     """Función principal para iniciar todos los servidores de la granja."""
     print("=====================================================")
     print("=   Iniciando Servidores Appium (con auto-limpieza)   =")
     print("=====================================================")
-    
-    farm_cfg = FarmConfig()
+
+    try:
+        farm_cfg = FarmConfig()
+    except (InventoryError, OSError) as e:
+        print(f"\nERROR CRÍTICO: Inventario de la granja no válido: {e}")
+        return
+    inventory = declared_inventory()
+    source = inventory.source if inventory is not None else "FarmConfig.devices"
+    print(f"{len(farm_cfg.devices)} dispositivos según {source}.")
     log_dir = BASE_DIR / "logs"
     log_dir.mkdir(parents=True, exist_ok=True)
-    
-    processes = []
-    
-    for device in farm_cfg.devices:
-        port = device['appium_port']
-        log_file = log_dir / f"appium_{device['serial']}_{port}.log"
-        
-        proc = start_appium_server(port, log_file)
-        
-        if proc is None:
-            print("\nDeteniendo el arranque de la granja debido a un error crítico.")
-            for p in processes:
-                p.terminate()
-            time.sleep(2)
-            print("Todos los servidores iniciados han sido detenidos.")
-            return
-            
-        processes.append(proc)
-        time.sleep(1)
-        
-    print(f"\nSe han lanzado {len(processes)} servidores Appium en segundo plano.")
+
+    servers = [
+        AppiumServer(device['serial'], device['appium_port'],
+                     log_dir / f"appium_{device['serial']}_{device['appium_port']}.log")
+        for device in farm_cfg.devices
+    ]
+
+    started = time.monotonic()
+    ready = start_servers(servers, farm_cfg.appium_ready_timeout)
+
+    if any(server.process is None for server in servers):
+        print("\nDeteniendo el arranque de la granja debido a un error crítico.")
+        for server in servers:
+            server.stop()
+        print("Todos los servidores iniciados han sido detenidos.")
+        return
+
+    print(f"\n{len(ready)}/{len(servers)} servidores Appium listos en {time.monotonic() - started:.1f}s.")
     print("Ahora puedes ejecutar 'python main.py' en otra terminal.")
     print("\nIMPORTANTE: Para detener todos los servidores, cierra esta ventana (o presiona Ctrl+C).")
 
     try:
-        while True:
-            time.sleep(60)
+        supervise(servers, farm_cfg)
     except KeyboardInterrupt:
         print("\nDeteniendo todos los servidores Appium...")
-        for p in processes:
-            p.terminate()
-            try:
-                p.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                p.kill()
+        for server in servers:
+            server.stop()
         print("Todos los servidores han sido detenidos.")
 
 if __name__ == "__main__":
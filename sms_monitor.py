@@ -1,16 +1,99 @@
+import argparse
+import asyncio
+from collections import OrderedDict
+import hashlib
 import logging
 from pathlib import Path
+import queue
+import signal
+import sys
 import time
-from typing import Dict, List, Set
+from typing import Dict, List, Optional, Tuple
 import re
 
 # Imports necesarios para que el script sea autoejecutable
-from config import DBConfig, LoggingConfig, BASE_DIR
+from config import (BrokerConfig, DBConfig, HotplugConfig, LoggingConfig, MetricsConfig, ModemConfig, BASE_DIR,
+                    declared_inventory)
+from code_broker import CodeBroker
+from db_manager import DBManager
+from device_tracker import DeviceEvent, DeviceTracker
+from inventory import InventoryError
+import metrics
 from utils import init_logging
-from modem_controller import ModemController
+from modem_controller import ModemController, message_indices
+from modem_service import ModemServiceServer, ServiceRequests, probe_modem_ports, resolve
 
 logger = logging.getLogger(__name__)
 
+SMS_TO_CODE_SECONDS = metrics.histogram(
+    "sms_arrival_to_code_written_seconds",
+    "Desde que el módem notifica (+CMTI) o el barrido encuentra el SMS hasta que el código se publica y escribe.",
+    ("path",))
+SMS_MESSAGES = metrics.counter(
+    "sms_messages_total", "SMS procesados por el monitor según su resultado.", ("port", "result"))
+DEDUP_HITS = metrics.counter("sms_dedup_hits_total", "SMS ya procesados que se vuelven a leer y se omiten.")
+DEDUP_EVICTIONS = metrics.counter(
+    "sms_dedup_evictions_total", "Entradas expulsadas de la caché de duplicados (ttl o tamaño).", ("reason",))
+
+# Códigos de Telegram: 5 o 6 dígitos
+CODE_PATTERN = re.compile(r'(\d{5,6})')
+
+def extract_code(content: str) -> Optional[str]:
+    """Primer código de 5 o 6 dígitos del SMS, o None."""
+    match = CODE_PATTERN.search(content)
+    return match.group(1) if match else None
+
+class DedupCache:
+    """
+    SMS ya procesados, con caducidad (`ttl` segundos) y tamaño máximo.
+    La clave es (puerto, ICCID, marca de tiempo o índice, hash del contenido):
+    el mismo texto recibido en dos SIMs no se considera duplicado.
+    """
+
+    def __init__(self, ttl: float = 3600.0, max_entries: int = 10000) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.evictions = 0
+        # Clave -> instante de caducidad; todas comparten el ttl, así que el orden de inserción es el de caducidad
+        self._entries: "OrderedDict[Tuple[str, str, str, str], float]" = OrderedDict()
+
+    @staticmethod
+    def key(port: str, iccid: str, message: Dict[str, str]) -> Tuple[str, str, str, str]:
+        digest = hashlib.sha1(message.get("content", "").encode("utf-8")).hexdigest()
+        return (port, iccid, message.get("timestamp") or message.get("index", ""), digest)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def seen(self, key: Tuple[str, str, str, str]) -> bool:
+        self._expire()
+        if key not in self._entries:
+            return False
+        self.hits += 1
+        DEDUP_HITS.inc()
+        return True
+
+    def add(self, key: Tuple[str, str, str, str]) -> None:
+        self._entries[key] = time.monotonic() + self.ttl
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._evict("size")
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            key, expires_at = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[key]
+            self._evict("ttl")
+
+    def _evict(self, reason: str) -> None:
+        self.evictions += 1
+        DEDUP_EVICTIONS.inc(reason=reason)
+
 def load_results_from_file(results_path: Path) -> List[Dict[str, str]]:
     """Lee el archivo results.txt y devuelve la información de los módems."""
     results = []
@@ -33,78 +116,277 @@ def load_results_from_file(results_path: Path) -> List[Dict[str, str]]:
         logger.error(f"Error al leer el archivo results.txt: {e}")
     return results
 
-def monitor_sms(modems: Dict[str, ModemController], results: List[Dict[str, str]]) -> None:
+def load_inventory_results() -> List[Dict[str, str]]:
+    """SIMs del inventario con número conocido, para monitorizar sin una ejecución de main.py."""
+    return [
+        {"phone_number": sim.phone_number, "device_serial": sim.device_serial or "",
+         "sim_number_icc_id": sim.iccid, "modem_port": sim.modem_port, "timestamp": ""}
+        for sim in inventory.sims if sim.phone_number
+    ] if (inventory := declared_inventory()) is not None else []
+
+def load_results(run_id: Optional[str] = None) -> List[Dict[str, str]]:
+    """
+    SIMs a monitorizar: de la base SQLite (filtradas por ejecución) o, si no, de
+    results.txt; sin ninguna de las dos, las del inventario con número conocido.
+    """
+    if DBConfig.use_sqlite and DBConfig.database.exists():
+        db = DBManager(DBConfig.results_file, DBConfig.database)
+        try:
+            results = list(db.read_results(run_id))
+        finally:
+            db.close()
+    elif DBConfig.results_file.exists():
+        results = load_results_from_file(DBConfig.results_file)
+    else:
+        results = []
+    return results or load_inventory_results()
+
+def start_code_broker() -> Optional[CodeBroker]:
+    """Arranca el broker de códigos; si no puede escuchar, se sigue solo con archivos."""
+    if not BrokerConfig.enabled:
+        return None
+    broker = CodeBroker(BrokerConfig.host, BrokerConfig.port, BrokerConfig.code_ttl)
+    try:
+        broker.start()
+        return broker
+    except OSError as e:
+        logger.warning(f"No se pudo iniciar el broker de códigos en {BrokerConfig.host}:{BrokerConfig.port}: {e}. Se usarán solo archivos.")
+        return None
+
+def handle_message(message: Dict[str, str], modem_port: str, phone_number: str, node_output_dir: Path, processed: DedupCache,
+                   broker: Optional[CodeBroker] = None, received_at: Optional[float] = None, path: str = "sweep",
+                   iccid: str = "") -> None:
+    """
+    Extrae el código de Telegram de un SMS, lo entrega al worker suscrito vía
+    broker y lo escribe en numerosNode/<número>.txt como respaldo.
+    `received_at` (time.time) es cuándo se supo del SMS; `path` indica si llegó
+    por push (+CMTI) o por barrido, para la métrica de latencia.
+    """
+    content = message.get("content", "")
+    key = DedupCache.key(modem_port, iccid, message)
+    # Evitar procesar el mismo mensaje si ya se ha visto.
+    if processed.seen(key):
+        logger.debug(f"Mensaje duplicado detectado y omitido en {modem_port}.")
+        SMS_MESSAGES.inc(port=modem_port, result="duplicate")
+        return
+
+    if "Telegram" in content or "Code" in content or "Código" in content: # Más genérico para Telegram
+        telegram_code = extract_code(content)
+        
+        if telegram_code and phone_number != "N/A_No_Number_Found":
+            logger.info(f"¡CÓDIGO ENCONTRADO ({telegram_code}) para {phone_number} en {modem_port}! Actualizando archivo...")
+            if broker:
+                broker.publish(phone_number, telegram_code)
+            
+            output_path = node_output_dir / f"{phone_number}.txt"
+            
+            # Asegurarse de que el directorio existe antes de escribir
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            
+            # Escribe el código en el archivo (sobrescribiendo el archivo vacío/antiguo)
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write(telegram_code)
+            
+            logger.info(f"Código actualizado en: {output_path}")
+            processed.add(key) # Marcar el SMS como ya procesado
+            SMS_MESSAGES.inc(port=modem_port, result="code")
+            if received_at is not None:
+                SMS_TO_CODE_SECONDS.observe(max(0.0, time.time() - received_at), path=path)
+        else:
+            logger.warning(f"Mensaje de Telegram en {modem_port} sin código numérico válido o número de teléfono asociado para escribir. Contenido: '{content[:100]}...'")
+            SMS_MESSAGES.inc(port=modem_port, result="no_code")
+    else:
+        logger.info(f"Mensaje en {modem_port} descartado (no parece ser de Telegram). Contenido: '{content[:100]}...'")
+        SMS_MESSAGES.inc(port=modem_port, result="discarded")
+
+def apply_hotplug_events(events: "queue.SimpleQueue[DeviceEvent]", modems: Dict[str, ModemController],
+                         results: List[Dict[str, str]], modem_cfg: ModemConfig) -> None:
+    """Suelta los módems desconectados y vuelve a conectar los monitorizados que reaparecen."""
+    while True:
+        try:
+            event = events.get_nowait()
+        except queue.Empty:
+            return
+        if event.kind != "serial":
+            continue
+        if event.action == "detach":
+            modem = modems.pop(event.device, None)
+            if modem:
+                logger.warning(f"Módem {event.device} desconectado; se deja de consultar hasta que vuelva.")
+                try:
+                    modem.disconnect()
+                except Exception as e:
+                    logger.debug(f"Error al cerrar {event.device}: {e}")
+        elif event.device not in modems:
+            entries = [entry for entry in results if entry.get("modem_port") == event.device]
+            if entries:
+                logger.info(f"Módem {event.device} reconectado; se vuelve a monitorizar.")
+                modems.update(connect_modems(entries, modem_cfg))
+
+def prepare_code_files(results: List[Dict[str, str]]) -> None:
+    """Crea numerosNode/<número>.txt vacío para cada SIM, que es lo que espera el worker de Node.js."""
+    node_output_dir = BASE_DIR / "numerosNode"
+    node_output_dir.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Preparando archivos en '{node_output_dir.name}' para Node.js...")
+    for entry in results:
+        phone_number = entry.get("phone_number")
+        if phone_number and phone_number != "N/A_No_Number_Found":
+            # Si ya existe, `touch()` simplemente actualiza su timestamp.
+            (node_output_dir / f"{phone_number}.txt").touch()
+            logger.debug(f"Archivo 'touch' para {phone_number}")
+    logger.info("Archivos preparados.")
+
+def serve_request(request: Dict, modems: Dict[str, ModemController], idle: Dict[str, ModemController],
+                  results: List[Dict[str, str]], modem_cfg: ModemConfig) -> Dict:
+    """
+    Atiende una petición del servicio de módems (ver modem_service.py). `idle`
+    guarda los módems sondeados que siguen abiertos a la espera de 'watch'.
+    """
+    op = request["op"]
+    if op == "probe":
+        ports = [port for port in request["ports"] if port not in modems]
+        for port in ports:
+            stale = idle.pop(port, None)
+            if stale:
+                stale.disconnect()
+        return {"event": "ok", "probes": probe_modem_ports(ports, modem_cfg, keep=idle)}
+    if op == "watch":
+        sims = [sim for sim in request["sims"] if sim.get("modem_port")]
+        for sim in sims:
+            port = sim["modem_port"]
+            if port in modems:
+                continue
+            modem = idle.pop(port, None)
+            if modem is None:
+                modems.update(connect_modems([sim], modem_cfg))
+                continue
+            if modem_cfg.push_sms:
+                modem.enable_new_message_indications()
+            modems[port] = modem
+        ports = {sim["modem_port"] for sim in sims}
+        results[:] = [entry for entry in results if entry.get("modem_port") not in ports] + sims
+        # Los puertos sondeados que nadie va a vigilar se liberan
+        for port, modem in idle.items():
+            logger.debug(f"Cerrando {port}: no tiene SIM que vigilar.")
+            modem.disconnect()
+        idle.clear()
+        prepare_code_files(sims)
+        live = sorted(port for port in ports if port in modems)
+        failed = sorted(ports - set(live))
+        logger.info(f"Vigilando {len(live)} módems por petición del orquestador; sin conexión: {failed or 'ninguno'}.")
+        return {"event": "ok", "live": live, "failed": failed}
+    if op == "read_sms":
+        modem = modems.get(request["port"]) or idle.get(request["port"])
+        if modem is None:
+            raise ValueError(f"el puerto {request['port']} no está abierto en el servicio")
+        return {"event": "ok", "messages": modem.read_sms(delete=False)}
+    return {"event": "ok", "open": sorted(set(modems) | set(idle)), "watched": sorted(modems)}
+
+def apply_service_requests(requests: ServiceRequests, timeout: float, modems: Dict[str, ModemController],
+                           idle: Dict[str, ModemController], results: List[Dict[str, str]], modem_cfg: ModemConfig) -> None:
+    """Espera hasta `timeout` segundos a la primera petición pendiente y atiende todas las que haya."""
+    item = requests.get(timeout)
+    while item is not None:
+        request, future = item
+        resolve(future, lambda: serve_request(request, modems, idle, results, modem_cfg))
+        item = requests.get()
+
+def monitor_sms(modems: Dict[str, ModemController], results: List[Dict[str, str]], modem_cfg: Optional[ModemConfig] = None,
+                broker: Optional[CodeBroker] = None, tracker: Optional[DeviceTracker] = None,
+                requests: Optional[ServiceRequests] = None) -> None:
     """
     Monitorea SMS, extrae el código de Telegram y lo escribe en el archivo .txt
     preexistente en la carpeta 'numerosNode'.
+
+    Los módems con notificaciones +CMTI activas se atienden por push: en cada
+    pasada solo se lee el índice notificado. El barrido completo AT+CMGL queda
+    como reconciliación periódica para ellos y como modo normal para el resto.
+    Con `tracker`, los módems que se desconectan o vuelven se sueltan y
+    reconectan sin reiniciar el monitor. Con `requests` (servicio de módems)
+    se atienden las peticiones IPC entre pasadas y los módems a vigilar llegan
+    con ellas.
     """
+    modem_cfg = modem_cfg or ModemConfig()
     logger.info("Iniciando bucle de monitoreo de SMS...")
     
     node_output_dir = BASE_DIR / "numerosNode"
-    # Conjunto para mantener un registro de los contenidos de mensajes ya procesados
-    # para evitar reprocesar el mismo SMS si el borrado de la SIM falla o si el mensaje es re-leído.
-    logged_messages: Set[str] = set() 
+    # SMS ya procesados, para no reprocesar el mismo SMS si el borrado de la SIM
+    # falla o si el mensaje es re-leído. Acotada en tiempo y tamaño.
+    processed = DedupCache(modem_cfg.dedup_ttl, modem_cfg.dedup_max_entries) 
+
+    push_ports = {port for port, modem in modems.items() if modem.push_enabled}
+    if push_ports:
+        logger.info(f"Recepción push (+CMTI) activa en: {sorted(push_ports)}")
+    sweep_interval = modem_cfg.reconcile_interval if modems and len(push_ports) == len(modems) else modem_cfg.poll_interval
+    next_sweep = time.monotonic()
+    hotplug: "queue.SimpleQueue[DeviceEvent]" = queue.SimpleQueue()
+    if tracker:
+        tracker.subscribe(hotplug.put)
+    # Módems sondeados por el servicio que aún no se vigilan
+    idle: Dict[str, ModemController] = {}
 
     try:
         while True:
-            logger.info("--- Nueva Ronda de Consultas ---")
+            if tracker:
+                apply_hotplug_events(hotplug, modems, results, modem_cfg)
+            if tracker or requests:
+                push_ports = {port for port, modem in modems.items() if modem.push_enabled}
+                sweep_interval = modem_cfg.reconcile_interval if modems and len(push_ports) == len(modems) else modem_cfg.poll_interval
+            sweep = time.monotonic() >= next_sweep
+            if sweep:
+                logger.info("--- Nueva Ronda de Consultas ---")
+                next_sweep = time.monotonic() + sweep_interval
             for entry in results:
                 modem_port = entry.get("modem_port")
                 phone_number = entry.get("phone_number", "N/A")
 
                 if not modem_port or modem_port not in modems:
-                    logger.debug(f"Saltando {modem_port}: no está en la lista de módems activos o es nulo.")
+                    if sweep:
+                        logger.debug(f"Saltando {modem_port}: no está en la lista de módems activos o es nulo.")
                     continue
 
                 modem = modems[modem_port]
                 try:
-                    logger.info(f"Consultando buzón en {modem_port} (Asociado a {phone_number})...")
-                    
-                    # El modem_controller.read_sms() ahora borra los SMS de la SIM
-                    # después de leerlos, por lo que solo deberíamos ver mensajes nuevos.
-                    new_messages = modem.read_sms()
-                    
-                    if not new_messages:
-                        logger.info(f"El buzón del módem {modem_port} está vacío o no hay nuevos SMS.")
+                    round_started = time.time()
+                    if sweep:
+                        logger.info(f"Consultando buzón en {modem_port} (Asociado a {phone_number})...")
+                        # Los SMS se borran de la SIM por índice, solo después de procesarlos.
+                        new_messages = modem.read_sms(delete=False)
+                        if not new_messages:
+                            logger.info(f"El buzón del módem {modem_port} está vacío o no hay nuevos SMS.")
+                            continue
+                    elif modem_port in push_ports:
+                        new_messages = []
+                        for index in modem.poll_new_message_indices():
+                            logger.info(f"Nuevo SMS notificado en {modem_port} (índice {index}).")
+                            message = modem.read_sms_at(index)
+                            if message:
+                                new_messages.append(message)
+                    else:
                         continue
 
+                    path = "sweep" if sweep else "push"
                     for msg in new_messages:
-                        content = msg.get("content", "")
-                        
-                        # Evitar procesar el mismo mensaje si ya se ha visto.
-                        if content in logged_messages:
-                            logger.debug(f"Mensaje duplicado detectado y omitido en {modem_port}.")
-                            continue
-
-                        if "Telegram" in content or "Code" in content or "Código" in content: # Más genérico para Telegram
-                            # Buscar códigos de 5 o 6 dígitos
-                            code_match = re.search(r'(\d{5,6})', content) 
-                            
-                            if code_match and phone_number != "N/A_No_Number_Found":
-                                telegram_code = code_match.group(1)
-                                logger.info(f"¡CÓDIGO ENCONTRADO ({telegram_code}) para {phone_number} en {modem_port}! Actualizando archivo...")
-                                
-                                output_path = node_output_dir / f"{phone_number}.txt"
-                                
-                                # Asegurarse de que el directorio existe antes de escribir
-                                output_path.parent.mkdir(parents=True, exist_ok=True)
-                                
-                                # Escribe el código en el archivo (sobrescribiendo el archivo vacío/antiguo)
-                                with open(output_path, "w", encoding="utf-8") as f:
-                                    f.write(telegram_code)
-                                
-                                logger.info(f"Código actualizado en: {output_path}")
-                                logged_messages.add(content) # Añadir el contenido a los mensajes ya procesados
-                            else:
-                                logger.warning(f"Mensaje de Telegram en {modem_port} sin código numérico válido o número de teléfono asociado para escribir. Contenido: '{content[:100]}...'")
-                        else:
-                            logger.info(f"Mensaje en {modem_port} descartado (no parece ser de Telegram). Contenido: '{content[:100]}...'")
+                        received_at = modem.indication_times.pop(msg.get("index"), round_started)
+                        handle_message(msg, modem_port, phone_number, node_output_dir, processed, broker,
+                                       received_at, path, entry.get("sim_number_icc_id", ""))
+                    if sweep:
+                        modem.delete_messages(message_indices(new_messages))
 
                 except Exception as e:
                     logger.error(f"Error al procesar el módem {modem_port}: {e}", exc_info=True) # Incluir stack trace
 
-            logger.info("Ronda finalizada. Esperando 10 segundos para la siguiente ronda...")
-            time.sleep(10) # Reducido a 10 segundos
+            if sweep:
+                logger.info(f"Ronda finalizada. Próximo barrido completo en {sweep_interval:.0f} segundos.")
+            pause = modem_cfg.push_poll_interval if push_ports else sweep_interval
+            if requests:
+                watched_ports = set(modems)
+                apply_service_requests(requests, pause, modems, idle, results, modem_cfg)
+                if set(modems) != watched_ports:
+                    # Los puertos que llegan con 'watch' se barren ya, sin esperar al intervalo anterior
+                    next_sweep = time.monotonic()
+            else:
+                time.sleep(pause)
 
     except KeyboardInterrupt:
         logger.info("Monitoreo detenido por el usuario.")
@@ -112,52 +394,255 @@ def monitor_sms(modems: Dict[str, ModemController], results: List[Dict[str, str]
         logger.critical(f"Error fatal en el bucle principal de monitoreo: {e}", exc_info=True)
     finally:
         logger.info("Desconectando todos los módems activos...")
-        for modem in modems.values():
+        for modem in list(modems.values()) + list(idle.values()):
             modem.disconnect()
         logger.info("Monitoreo de SMS finalizado.")
 
+def connect_modems(results: List[Dict[str, str]], modem_cfg: ModemConfig) -> Dict[str, ModemController]:
+    """Conecta (una sola vez por puerto) los módems listados en results.txt."""
+    active_modems = {}
+    for entry in results:
+        port = entry.get("modem_port")
+        if port and port not in active_modems:
+            try:
+                logger.info(f"Intentando conectar a {port}...")
+                modem = ModemController(port, modem_cfg.baudrate, modem_cfg.timeout, modem_cfg.pdu_mode)
+                modem.connect()
+                if modem_cfg.push_sms:
+                    modem.enable_new_message_indications()
+                active_modems[port] = modem
+                logger.info(f"Conexión exitosa en {port}.")
+            except Exception as e:
+                logger.warning(f"Fallo al conectar con {port}: {e}")
+    return active_modems
+
+async def watch_modem_async(modem, phone_number: str, modem_cfg: ModemConfig, node_output_dir: Path, processed: DedupCache,
+                            broker: Optional[CodeBroker] = None, iccid: str = "") -> None:
+    """
+    Tarea independiente por módem: barrido AT+CMGL de reconciliación y, entre
+    barridos, atención inmediata de cada +CMTI si el módem lo admite.
+    """
+    loop = asyncio.get_running_loop()
+    sweep_interval = modem_cfg.reconcile_interval if modem.push_enabled else modem_cfg.poll_interval
+    while modem.is_connected:
+        try:
+            round_started = time.time()
+            messages = await modem.read_sms(delete=False)
+            for msg in messages:
+                received_at = modem.indication_times.pop(msg.get("index"), round_started)
+                handle_message(msg, modem.port, phone_number, node_output_dir, processed, broker,
+                               received_at, "sweep", iccid)
+            await modem.delete_messages(message_indices(messages))
+
+            next_sweep = loop.time() + sweep_interval
+            if not modem.push_enabled:
+                await asyncio.sleep(sweep_interval)
+                continue
+            while (remaining := next_sweep - loop.time()) > 0:
+                index = await modem.next_indication(remaining)
+                if index is None:
+                    break
+                logger.info(f"Nuevo SMS notificado en {modem.port} (índice {index}).")
+                msg = await modem.read_sms_at(index)
+                received_at = modem.indication_times.pop(index, None)
+                if msg:
+                    handle_message(msg, modem.port, phone_number, node_output_dir, processed, broker,
+                                   received_at, "push", iccid)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error al procesar el módem {modem.port}: {e}", exc_info=True)
+            await asyncio.sleep(1)
+    logger.warning(f"El módem {modem.port} se ha desconectado; su tarea de monitoreo termina.")
+
+async def monitor_sms_async(results: List[Dict[str, str]], modem_cfg: ModemConfig, broker: Optional[CodeBroker] = None,
+                            tracker: Optional[DeviceTracker] = None, requests: Optional[ServiceRequests] = None) -> None:
+    """
+    Monitorea todos los módems desde un único bucle asyncio, una tarea por puerto.
+    Con `tracker`, un módem que se desconecta pierde su tarea y la recupera al volver.
+    Con `requests` (servicio de módems), las peticiones IPC se atienden en el mismo bucle.
+    """
+    from async_modem import ModemService
+
+    loop = asyncio.get_running_loop()
+    node_output_dir = BASE_DIR / "numerosNode"
+    processed = DedupCache(modem_cfg.dedup_ttl, modem_cfg.dedup_max_entries)
+    phone_by_port = {
+        entry["modem_port"]: entry.get("phone_number", "N/A")
+        for entry in results if entry.get("modem_port")
+    }
+    iccid_by_port = {
+        entry["modem_port"]: entry.get("sim_number_icc_id", "")
+        for entry in results if entry.get("modem_port")
+    }
+
+    service = ModemService(modem_cfg.baudrate, modem_cfg.pdu_mode)
+    modems = await service.start(phone_by_port, push_sms=modem_cfg.push_sms) if phone_by_port else {}
+    if not modems and requests is None:
+        logger.error("No se pudo establecer conexión con ninguno de los módems listados. Finalizando.")
+        return
+    logger.info(f"Monitoreo asíncrono activo en {len(modems)} módems.")
+
+    def watch(port: str, modem) -> asyncio.Task:
+        return asyncio.create_task(
+            watch_modem_async(modem, phone_by_port[port], modem_cfg, node_output_dir, processed, broker, iccid_by_port[port])
+        )
+
+    tasks = {port: watch(port, modem) for port, modem in modems.items()}
+
+    async def on_hotplug(event: DeviceEvent) -> None:
+        if event.kind != "serial" or event.device not in phone_by_port:
+            return
+        if event.action == "detach":
+            logger.warning(f"Módem {event.device} desconectado; se deja de consultar hasta que vuelva.")
+            task = tasks.pop(event.device, None)
+            if task:
+                task.cancel()
+            await service.close(event.device)
+        elif event.device not in tasks or tasks[event.device].done():
+            try:
+                modem = await service.open(event.device, modem_cfg.push_sms)
+            except Exception as e:
+                logger.warning(f"Fallo al reconectar con {event.device}: {e}")
+                return
+            logger.info(f"Módem {event.device} reconectado; se vuelve a monitorizar.")
+            tasks[event.device] = watch(event.device, modem)
+
+    async def serve(request: Dict) -> Dict:
+        """Versión asyncio de serve_request: los puertos sondeados pasan al bucle sin reabrirse."""
+        op = request["op"]
+        if op == "probe":
+            ports = [port for port in request["ports"] if port not in tasks]
+            for port in ports:
+                await service.close(port)
+            kept: Dict[str, ModemController] = {}
+            probes = await loop.run_in_executor(None, probe_modem_ports, ports, modem_cfg, kept)
+            for port, modem in kept.items():
+                serial_instance, modem.serial = modem.serial, None
+                await service.adopt(port, serial_instance)
+            return {"event": "ok", "probes": probes}
+        if op == "watch":
+            sims = [sim for sim in request["sims"] if sim.get("modem_port")]
+            for sim in sims:
+                port = sim["modem_port"]
+                phone_by_port[port] = sim.get("phone_number", "N/A")
+                iccid_by_port[port] = sim.get("sim_number_icc_id", "")
+                if port in tasks and not tasks[port].done():
+                    continue
+                try:
+                    modem = service.modems.get(port) or await service.open(port, modem_cfg.push_sms)
+                    if modem_cfg.push_sms and not modem.push_enabled:
+                        await modem.enable_new_message_indications()
+                except Exception as e:
+                    logger.warning(f"Fallo al conectar con {port}: {e}")
+                    continue
+                tasks[port] = watch(port, modem)
+            # Los puertos sondeados que nadie va a vigilar se liberan
+            for port in [port for port in service.modems if port not in tasks]:
+                await service.close(port)
+            prepare_code_files(sims)
+            ports = {sim["modem_port"] for sim in sims}
+            live = sorted(port for port in ports if port in tasks)
+            failed = sorted(ports - set(live))
+            logger.info(f"Vigilando {len(live)} módems por petición del orquestador; sin conexión: {failed or 'ninguno'}.")
+            return {"event": "ok", "live": live, "failed": failed}
+        if op == "read_sms":
+            modem = service.modems.get(request["port"])
+            if modem is None:
+                raise ValueError(f"el puerto {request['port']} no está abierto en el servicio")
+            return {"event": "ok", "messages": await modem.read_sms(delete=False)}
+        return {"event": "ok", "open": sorted(service.modems), "watched": sorted(tasks)}
+
+    try:
+        if not tracker and requests is None:
+            await asyncio.gather(*tasks.values())
+            return
+        # Eventos hot-plug y peticiones del servicio llegan desde otros hilos a la misma cola
+        inbox: asyncio.Queue = asyncio.Queue()
+        if tracker:
+            tracker.subscribe(lambda event: loop.call_soon_threadsafe(inbox.put_nowait, event))
+        if requests is not None:
+            requests.redirect(lambda item: loop.call_soon_threadsafe(inbox.put_nowait, item))
+        while True:
+            item = await inbox.get()
+            if isinstance(item, DeviceEvent):
+                await on_hotplug(item)
+                continue
+            request, future = item
+            try:
+                reply = await serve(request)
+            except Exception as e:
+                logger.error(f"Error al atender una petición del servicio de módems: {e}", exc_info=True)
+                reply = {"event": "error", "message": str(e)}
+            future.set_result(reply)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        logger.info("Desconectando todos los módems activos...")
+        await service.stop()
+        logger.info("Monitoreo de SMS finalizado.")
+
 if __name__ == "__main__":
     init_logging(LoggingConfig.log_file, LoggingConfig.log_level)
     
     logger.info("--- Iniciando Proceso de Monitoreo de SMS ---")
     
-    results_file_path = DBConfig.results_file
-    results_to_monitor = load_results_from_file(results_file_path)
+    parser = argparse.ArgumentParser(description="Monitor de SMS de la granja.")
+    parser.add_argument("--run-id", help="Ejecución de main.py cuyas SIMs se monitorizan (base SQLite).")
+    parser.add_argument("--serve", action="store_true",
+                        help="Servicio de módems: sondea y vigila los puertos que pida main.py (ver modem_service.py).")
+    args = parser.parse_args()
+    try:
+        modem_cfg = ModemConfig()
+    except (InventoryError, OSError) as e:
+        logger.critical(f"Inventario de la granja no válido: {e}")
+        sys.exit(1)
+    server = None
+    if args.serve:
+        # Las SIMs a vigilar llegan por IPC (op 'watch') tras el sondeo
+        results_to_monitor = []
+        try:
+            server = ModemServiceServer(modem_cfg.service_host, modem_cfg.service_port)
+        except OSError as e:
+            logger.critical(f"No se pudo abrir el servicio de módems en {modem_cfg.service_host}:{modem_cfg.service_port}: {e}")
+            sys.exit(1)
+    else:
+        results_to_monitor = load_results(args.run_id)
 
-    if not results_to_monitor:
+    if not results_to_monitor and server is None:
         logger.error("El archivo results.txt está vacío o no se pudo leer. No se puede continuar.")
     else:
-        # Asegura que el directorio numerosNode existe y crea archivos vacíos
-        # para cada número, lo que el script de Node.js espera.
-        node_output_dir = BASE_DIR / "numerosNode"
-        node_output_dir.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Preparando archivos en '{node_output_dir.name}' para Node.js...")
-        for entry in results_to_monitor:
-            phone_number = entry.get("phone_number")
-            if phone_number and phone_number != "N/A_No_Number_Found":
-                output_path = node_output_dir / f"{phone_number}.txt"
-                # Crea un archivo vacío si no existe, para que Node sepa qué procesar.
-                # Si ya existe, `touch()` simplemente actualiza su timestamp.
-                output_path.touch() 
-                logger.debug(f"Archivo 'touch' para {phone_number}")
-        logger.info("Archivos preparados.")
-
-        logger.info(f"Se encontraron {len(results_to_monitor)} módems para monitorear.")
+        if results_to_monitor:
+            prepare_code_files(results_to_monitor)
+            logger.info(f"Se encontraron {len(results_to_monitor)} módems para monitorear.")
         
-        active_modems = {}
-        for entry in results_to_monitor:
-            port = entry.get("modem_port")
-            if port and port not in active_modems:
+        broker = start_code_broker()
+        exporter = metrics.start_exporter("sms_monitor", MetricsConfig.monitor_http_port)
+        tracker = None
+        if HotplugConfig.enabled:
+            watched_ports = modem_cfg.ports if server else [entry["modem_port"] for entry in results_to_monitor if entry.get("modem_port")]
+            tracker = DeviceTracker(serial_ports=watched_ports, poll_interval=HotplugConfig.poll_interval).start()
+        # main.py detiene el monitor con SIGTERM: se sale por los finally para volcar las métricas
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        requests = server.start().requests if server else None
+        try:
+            if modem_cfg.async_monitor:
                 try:
-                    logger.info(f"Intentando conectar a {port}...")
-                    modem = ModemController(port)
-                    modem.connect()
-                    active_modems[port] = modem
-                    logger.info(f"Conexión exitosa en {port}.")
-                except Exception as e:
-                    logger.warning(f"Fallo al conectar con {port}: {e}")
-
-        if active_modems:
-            monitor_sms(active_modems, results_to_monitor)
-        else:
-            logger.error("No se pudo establecer conexión con ninguno de los módems listados. Finalizando.")
+                    asyncio.run(monitor_sms_async(results_to_monitor, modem_cfg, broker, tracker, requests))
+                except KeyboardInterrupt:
+                    logger.info("Monitoreo detenido por el usuario.")
+            else:
+                active_modems = connect_modems(results_to_monitor, modem_cfg)
+                if active_modems or requests:
+                    monitor_sms(active_modems, results_to_monitor, modem_cfg, broker, tracker, requests)
+                else:
+                    logger.error("No se pudo establecer conexión con ninguno de los módems listados. Finalizando.")
+        finally:
+            if server:
+                server.stop()
+            if tracker:
+                tracker.stop()
+            if broker:
+                broker.stop()
+            if exporter:
+                exporter.stop()
@@ -0,0 +1,255 @@
+"""
+PDU-mode SMS decoding (AT+CMGF=0) with multipart reassembly.
+
+Decodifica SMS-DELIVER directamente sobre los bytes del PDU en una sola
+pasada: alfabeto GSM 7 bits (con tabla de extensión), UCS2 y datos de 8 bits,
+más la cabecera UDH de concatenación (referencia de 8 y 16 bits).
+ConcatBuffer reúne las partes de un SMS largo por (remitente, referencia).
+"""
+from __future__ import annotations
+
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Alfabeto GSM 03.38 por defecto (posición = valor del septeto)
+GSM7_BASIC = (
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+# Tabla de extensión, precedida por el escape 0x1B
+GSM7_EXTENSION = {
+    0x0A: "\f", 0x14: "^", 0x28: "{", 0x29: "}", 0x2F: "\\",
+    0x3C: "[", 0x3D: "~", 0x3E: "]", 0x40: "|", 0x65: "€",
+}
+ESCAPE = 0x1B
+
+ALPHABET_GSM7 = "gsm7"
+ALPHABET_8BIT = "8bit"
+ALPHABET_UCS2 = "ucs2"
+
+# <stat> numérico de CMGL/CMGR en modo PDU -> nombre equivalente del modo texto
+PDU_STATUS = {"0": "REC UNREAD", "1": "REC READ", "2": "STO UNSENT", "3": "STO SENT"}
+SEMI_OCTET_DIGITS = "0123456789*#abc"
+
+
+def unpack_septets(data: bytes, count: int) -> List[int]:
+    """Desempaqueta `count` septetos GSM de `data` en una única pasada."""
+    septets: List[int] = []
+    carry = 0
+    carry_bits = 0
+    for byte in data:
+        if len(septets) >= count:
+            break
+        septets.append(((byte << carry_bits) | carry) & 0x7F)
+        carry = byte >> (7 - carry_bits)
+        carry_bits += 1
+        if carry_bits == 7:
+            septets.append(carry & 0x7F)
+            carry = 0
+            carry_bits = 0
+    return septets[:count]
+
+
+def decode_gsm7(septets: List[int]) -> str:
+    chars = []
+    escaped = False
+    for septet in septets:
+        if escaped:
+            chars.append(GSM7_EXTENSION.get(septet, " "))
+            escaped = False
+        elif septet == ESCAPE:
+            escaped = True
+        else:
+            chars.append(GSM7_BASIC[septet])
+    return "".join(chars)
+
+
+def decode_semi_octets(data: bytes) -> str:
+    """Dígitos BCD con nibbles invertidos (direcciones y marcas de tiempo)."""
+    digits = []
+    for byte in data:
+        for nibble in (byte & 0x0F, byte >> 4):
+            if nibble != 0x0F:
+                digits.append(SEMI_OCTET_DIGITS[nibble])
+    return "".join(digits)
+
+
+def _alphabet(dcs: int) -> str:
+    if dcs & 0x80 == 0x00:
+        return (ALPHABET_GSM7, ALPHABET_8BIT, ALPHABET_UCS2, ALPHABET_GSM7)[(dcs >> 2) & 0x03]
+    if dcs & 0xF0 == 0xE0:
+        return ALPHABET_UCS2
+    if dcs & 0xF0 == 0xF0:
+        return ALPHABET_8BIT if dcs & 0x04 else ALPHABET_GSM7
+    return ALPHABET_GSM7
+
+
+def _decode_timestamp(data: bytes) -> str:
+    """SCTS de 7 octetos -> 'YY/MM/DD,HH:MM:SS±ZZ', el mismo formato que el modo texto."""
+    digits = decode_semi_octets(data[:6])
+    tz = data[6]
+    quarters = (tz & 0x07) * 10 + (tz >> 4)
+    sign = "-" if tz & 0x08 else "+"
+    return f"{digits[0:2]}/{digits[2:4]}/{digits[4:6]},{digits[6:8]}:{digits[8:10]}:{digits[10:12]}{sign}{quarters:02d}"
+
+
+def _parse_concat(header: bytes) -> Optional[Tuple[int, int, int]]:
+    """Busca en la UDH el IE de concatenación; devuelve (referencia, total, secuencia)."""
+    pos = 0
+    while pos + 1 < len(header):
+        iei, length = header[pos], header[pos + 1]
+        value = header[pos + 2:pos + 2 + length]
+        if iei == 0x00 and length == 3:
+            return value[0], value[1], value[2]
+        if iei == 0x08 and length == 4:
+            return (value[0] << 8) | value[1], value[2], value[3]
+        pos += 2 + length
+    return None
+
+
+def decode_pdu(pdu_hex: str) -> Dict:
+    """
+    Decodifica un PDU SMS-DELIVER (tal como lo entrega CMGL/CMGR, con SMSC).
+    Lanza ValueError si el PDU está truncado o no es un SMS-DELIVER.
+    """
+    try:
+        data = bytes.fromhex(pdu_hex.strip())
+        pos = data[0] + 1
+        first_octet = data[pos]
+        if first_octet & 0x03 != 0x00:
+            raise ValueError(f"tipo de PDU no soportado (MTI={first_octet & 0x03})")
+        udhi = bool(first_octet & 0x40)
+
+        address_digits, type_of_address = data[pos + 1], data[pos + 2]
+        pos += 3
+        address = data[pos:pos + (address_digits + 1) // 2]
+        pos += len(address)
+        if (type_of_address >> 4) & 0x07 == 0x05:
+            sender = decode_gsm7(unpack_septets(address, address_digits * 4 // 7))
+        else:
+            sender = decode_semi_octets(address)
+            if (type_of_address >> 4) & 0x07 == 0x01:
+                sender = f"+{sender}"
+
+        dcs = data[pos + 1]
+        timestamp = _decode_timestamp(data[pos + 2:pos + 9])
+        user_data_length = data[pos + 9]
+        user_data = data[pos + 10:]
+    except IndexError:
+        raise ValueError("PDU truncado") from None
+
+    header = b""
+    if udhi:
+        header = user_data[1:1 + user_data[0]]
+
+    alphabet = _alphabet(dcs)
+    if alphabet == ALPHABET_GSM7:
+        septets = unpack_septets(user_data, user_data_length)
+        if len(septets) < user_data_length:
+            raise ValueError("PDU truncado")
+        if udhi:
+            # La UDH ocupa (UDHL + 1) octetos más el relleno hasta frontera de septeto
+            septets = septets[((len(header) + 1) * 8 + 6) // 7:]
+        content = decode_gsm7(septets)
+    else:
+        body = user_data[:user_data_length]
+        if udhi:
+            body = body[1 + len(header):]
+        content = body.decode("utf-16-be", errors="replace") if alphabet == ALPHABET_UCS2 else body.decode("latin-1")
+
+    return {
+        "content": content,
+        "sender": sender,
+        "timestamp": timestamp,
+        "alphabet": alphabet,
+        "concat": _parse_concat(header),
+    }
+
+
+def _parse_pdu_listing(response: str, prefix: str, index: Optional[str] = None) -> List[Dict]:
+    """Recorre la respuesta línea a línea: cabecera +CMGL/+CMGR seguida de su PDU."""
+    messages = []
+    header = None
+    for line in response.splitlines():
+        line = line.strip()
+        if line.startswith(prefix):
+            header = [field.strip() for field in line[len(prefix):].split(",")]
+            continue
+        if header is None or not line:
+            continue
+        msg_index, status = (index, header[0]) if index is not None else (header[0], header[1])
+        header = None
+        try:
+            message = decode_pdu(line)
+        except ValueError as e:
+            logger.warning(f"PDU del SMS {msg_index} descartado: {e}")
+            continue
+        message["index"] = str(msg_index)
+        message["status"] = PDU_STATUS.get(status, status)
+        messages.append(message)
+    return messages
+
+
+def parse_cmgl_pdu(response: str) -> List[Dict]:
+    """Parsea AT+CMGL=<stat> en modo PDU: '+CMGL: <index>,<stat>,[<alpha>],<length>' + PDU."""
+    return _parse_pdu_listing(response, "+CMGL:")
+
+
+def parse_cmgr_pdu(response: str, index: str) -> Optional[Dict]:
+    """Parsea AT+CMGR=<index> en modo PDU: '+CMGR: <stat>,[<alpha>],<length>' + PDU."""
+    messages = _parse_pdu_listing(response, "+CMGR:", index)
+    return messages[0] if messages else None
+
+
+class ConcatBuffer:
+    """Buffer de reensamblado de SMS concatenados, con clave (remitente, referencia, total)."""
+
+    def __init__(self, ttl: float = 3600.0) -> None:
+        self.ttl = ttl
+        self._parts: Dict[Tuple[str, int, int], Dict[int, Dict]] = {}
+        self._first_seen: Dict[Tuple[str, int, int], float] = {}
+
+    def add(self, message: Dict) -> Optional[Dict]:
+        """Añade un SMS; devuelve el mensaje completo cuando están todas sus partes."""
+        concat = message.pop("concat", None)
+        if not concat or concat[1] <= 1:
+            return message
+        reference, total, sequence = concat
+        key = (message.get("sender", ""), reference, total)
+        parts = self._parts.setdefault(key, {})
+        self._first_seen.setdefault(key, time.monotonic())
+        parts[sequence] = message
+        if len(parts) < total:
+            logger.debug(f"Parte {sequence}/{total} del SMS ref {reference} de {key[0]} en espera.")
+            return None
+
+        del self._parts[key]
+        del self._first_seen[key]
+        ordered = [parts[seq] for seq in sorted(parts)]
+        complete = dict(ordered[0])
+        complete["content"] = "".join(part["content"] for part in ordered)
+        complete["parts"] = ",".join(part["index"] for part in ordered)
+        return complete
+
+    def collect(self, messages: List[Dict]) -> List[Dict]:
+        """Pasa una lectura completa por el buffer y devuelve solo los mensajes terminados."""
+        self.expire()
+        completed = []
+        for message in messages:
+            complete = self.add(message)
+            if complete:
+                completed.append(complete)
+        return completed
+
+    def expire(self) -> List[Dict]:
+        """Descarta los SMS que siguen incompletos tras `ttl`; devuelve sus partes."""
+        limit = time.monotonic() - self.ttl
+        discarded = []
+        for key in [k for k, seen in self._first_seen.items() if seen < limit]:
+            logger.warning(f"SMS concatenado ref {key[1]} de {key[0]} incompleto tras {self.ttl:.0f}s; se descarta.")
+            discarded.extend(self._parts.pop(key).values())
+            del self._first_seen[key]
+        return discarded
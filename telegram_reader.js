@@ -8,17 +8,22 @@
  * - **CORRECCIÓN: 'Malformed type for keycode'**: El `sendKeyEvent` ahora recibe un string ('67').
  * - **Solución al error de 'Unable to resolve launchable activity'**: Se elimina `appium:appActivity` para auto-detección.
  * - **Limpieza de datos de la app vía ADB**: Función `clearAppData` para asegurar un estado limpio (crucial con `noReset: true`).
- * - **Espera indefinida para el código SMS**: `waitForTelegramCode` sin timeout.
+ * - **Entrega del código SMS por broker**: `waitForTelegramCode` se suscribe al broker local (push)
+ *   con plazo máximo y cancelación; si el broker no está disponible, sondea el archivo de `numerosNode`.
  * - **Robustez de la conexión y navegación**: Reintentos de conexión Appium, navegación robusta en Telegram.
  * - **Formato de resultados finales**: Incluye `deviceSerial`, `port`, `iccid` y maneja `UNKNOWN` status.
  * - **Limpieza de archivos temporales**: Elimina el archivo .txt del número en `numerosNode`.
  * - **Modo de prueba directo**: Permite ejecutar el script para un solo número/dispositivo.
+ * - **Modo persistente (`--serve`)**: Un proceso y una sesión Appium por dispositivo; recibe números
+ *   por stdin y emite cada resultado como evento JSON. El reseteo de datos se hace dentro de la sesión.
  * - **Flujo de apertura/cierre de app optimizado**: Se intenta minimizar aperturas/cierres redundantes.
  */
 
 const { remote } = require('webdriverio');
 const fs = require('fs').promises;
 const path = require('path');
+const net = require('net');
+const readline = require('readline');
 const { exec } = require('child_process'); // Para ejecutar comandos ADB desde Node.js
 
 // --- CONFIGURACIÓN ---
@@ -38,16 +43,25 @@ const APPIUM_OPTIONS = {
         'appium:newCommandTimeout': 3600, // <-- AUMENTADO: Para permitir esperas indefinidas de códigos.
     }
 };
+// Directorio de datos de la granja (FARM_HOME en config.py); por defecto, el del script
+const FARM_HOME = process.env.FARM_HOME || __dirname;
 const RESULTS_FILE = 'results.txt';
 const CODE_FOLDER = 'numerosNode';
-const POLLING_INTERVAL_MS = 2000; // Frecuencia de sondeo para el archivo de código
+const POLLING_INTERVAL_MS = 2000; // Frecuencia de sondeo para el archivo de código (modo respaldo)
+// Broker local de códigos (ver code_broker.py / BrokerConfig)
+const CODE_BROKER_HOST = process.env.CODE_BROKER_HOST || '127.0.0.1';
+const CODE_BROKER_PORT = parseInt(process.env.CODE_BROKER_PORT || '8765', 10);
+const CODE_WAIT_TIMEOUT_MS = parseInt(process.env.CODE_WAIT_TIMEOUT_MS || '180000', 10); // Plazo máximo de espera del código
+const ADB_SERVER_HOST = process.env.ADB_SERVER_HOST || '127.0.0.1';
+const ADB_SERVER_PORT = parseInt(process.env.ANDROID_ADB_SERVER_PORT || '5037', 10);
+const ADB_SHELL_TIMEOUT_MS = 30000; // Plazo de un comando shell contra el servidor adb (pm clear tarda unos segundos)
 const TELEGRAM_PACKAGE_NAME = 'org.telegram.messenger'; // Nombre del paquete de Telegram
 
 // --- FUNCIONES AUXILIARES ---
 
 async function readSimData() {
     try {
-        const filePath = path.join(__dirname, RESULTS_FILE);
+        const filePath = path.join(FARM_HOME, RESULTS_FILE);
         const data = await fs.readFile(filePath, 'utf-8');
         const lines = data.trim().split('\n');
         return lines.slice(1).map(line => {
@@ -67,7 +81,11 @@ async function readSimData() {
     }
 }
 
+// Con FARM_RESULTS_SINK=orchestrator, main.py guarda los resultados en SQLite a partir de los eventos
+const RESULTS_SINK = process.env.FARM_RESULTS_SINK || 'files';
+
 async function saveResult(simData, status) {
+    if (RESULTS_SINK === 'orchestrator') return;
     const statusToFileMap = {
         '2FA': 'num_2fa.txt',
         'NO_2FA': 'num_no_2fa.txt',
@@ -77,7 +95,7 @@ async function saveResult(simData, status) {
     };
     const fileName = statusToFileMap[status];
     if (fileName) {
-        const filePath = path.join(__dirname, fileName);
+        const filePath = path.join(FARM_HOME, fileName);
         // Guardado con formato completo: phoneNumber,port,iccid,deviceSerial
         const lineToWrite = `${simData.phoneNumber},${simData.port},${simData.iccid},${simData.deviceSerial}\n`; // <-- AÑADIDO: deviceSerial
         try {
@@ -89,30 +107,111 @@ async function saveResult(simData, status) {
     }
 }
 
-async function waitForTelegramCode(phoneNumber) {
-    const codeFilePath = path.join(__dirname, CODE_FOLDER, `${phoneNumber}.txt`);
-    console.log(`[INFO][${phoneNumber}] Esperando código en: ${codeFilePath} (espera indefinida)...`);
-    
-    while (true) { // <-- MODIFICADO: Bucle infinito sin timeout
-        try {
-            const code = await fs.readFile(codeFilePath, 'utf-8');
-            if(code.trim()){
-                console.log(`\n[INFO][${phoneNumber}] ¡ÉXITO! Código encontrado: ${code.trim()}`);
-                return code.trim(); // Se borra el archivo en cleanupPhoneNumberFile
-            }
-        } catch (error) {
-            if (error.code !== 'ENOENT') {
-                 console.error(`\n[ERROR][${phoneNumber}] Error leyendo archivo de código:`, error);
+/**
+ * Se suscribe al broker local y resuelve en cuanto el monitor publica el código.
+ * Resuelve { reachable, code, writtenAt }: reachable=false si no hay broker
+ * escuchando; writtenAt es el instante (ms epoch) en que el monitor lo publicó.
+ * Si `signal` se aborta, envía 'cancel' al broker y resuelve con code=null.
+ * `since` (ms epoch, cuando se envió el número) descarta códigos de intentos anteriores.
+ */
+function waitForCodeFromBroker(phoneNumber, timeoutMs, signal, since = null) {
+    return new Promise(resolve => {
+        let settled = false;
+        let buffer = '';
+        const socket = net.createConnection({ host: CODE_BROKER_HOST, port: CODE_BROKER_PORT });
+        const finish = (result) => {
+            if (settled) return;
+            settled = true;
+            if (signal) signal.removeEventListener('abort', onAbort);
+            socket.destroy();
+            resolve(result);
+        };
+        const onAbort = () => {
+            if (!socket.destroyed) socket.write(JSON.stringify({ op: 'cancel', phone: phoneNumber }) + '\n');
+            finish({ reachable: true, code: null });
+        };
+        if (signal) {
+            if (signal.aborted) return onAbort();
+            signal.addEventListener('abort', onAbort);
+        }
+        socket.setEncoding('utf-8');
+        socket.on('connect', () => {
+            const request = { op: 'subscribe', phone: phoneNumber, timeout: timeoutMs / 1000 };
+            if (since) request.since = since / 1000;
+            socket.write(JSON.stringify(request) + '\n');
+        });
+        socket.on('data', chunk => {
+            buffer += chunk;
+            const newline = buffer.indexOf('\n');
+            if (newline === -1) return;
+            try {
+                const message = JSON.parse(buffer.slice(0, newline));
+                const code = message.event === 'code' ? String(message.code) : null;
+                finish({ reachable: true, code, writtenAt: code && message.published_at ? message.published_at * 1000 : null });
+            } catch (error) {
+                console.error(`\n[ERROR][${phoneNumber}] Respuesta inválida del broker:`, error);
+                finish({ reachable: true, code: null });
             }
+        });
+        socket.on('error', () => finish({ reachable: false, code: null }));
+        socket.on('close', () => finish({ reachable: !!buffer, code: null }));
+    });
+}
+
+// Devuelve { code, writtenAt } (writtenAt = mtime del archivo en ms epoch) o null si aún no hay código
+// (o si el archivo es anterior a `since`)
+async function readCodeFile(codeFilePath, phoneNumber, since = null) {
+    try {
+        const code = (await fs.readFile(codeFilePath, 'utf-8')).trim();
+        if (!code) return null;
+        const { mtimeMs } = await fs.stat(codeFilePath);
+        if (since && mtimeMs < since) return null;
+        return { code, writtenAt: mtimeMs };
+    } catch (error) {
+        if (error.code !== 'ENOENT') {
+             console.error(`\n[ERROR][${phoneNumber}] Error leyendo archivo de código:`, error);
+        }
+        return null;
+    }
+}
+
+/**
+ * Espera el código del número: primero por el broker y, si no está, sondeando
+ * numerosNode/<número>.txt. Resuelve { code, writtenAt } o null. Con `since`
+ * (ms epoch del envío del número) se ignoran los códigos anteriores.
+ */
+async function waitForTelegramCode(phoneNumber, timeoutMs = CODE_WAIT_TIMEOUT_MS, signal, since = null) {
+    const codeFilePath = path.join(FARM_HOME, CODE_FOLDER, `${phoneNumber}.txt`);
+    const deadline = Date.now() + timeoutMs;
+    console.log(`[INFO][${phoneNumber}] Esperando código vía broker ${CODE_BROKER_HOST}:${CODE_BROKER_PORT} (máx. ${timeoutMs / 1000}s)...`);
+
+    const { reachable, code, writtenAt } = await waitForCodeFromBroker(phoneNumber, timeoutMs, signal, since);
+    if (code) {
+        console.log(`\n[INFO][${phoneNumber}] ¡ÉXITO! Código recibido del broker: ${code}`);
+        return { code, writtenAt };
+    }
+    if (reachable) {
+        // El monitor escribe también el archivo: última comprobación por compatibilidad
+        return await readCodeFile(codeFilePath, phoneNumber, since);
+    }
+
+    console.log(`[INFO][${phoneNumber}] Broker no disponible. Sondeando ${codeFilePath}...`);
+    while (Date.now() < deadline && !(signal && signal.aborted)) {
+        const fileCode = await readCodeFile(codeFilePath, phoneNumber, since);
+        if (fileCode) {
+            console.log(`\n[INFO][${phoneNumber}] ¡ÉXITO! Código encontrado: ${fileCode.code}`);
+            return fileCode; // Se borra el archivo en cleanupPhoneNumberFile
         }
         process.stdout.write(".");
         await new Promise(resolve => setTimeout(resolve, POLLING_INTERVAL_MS));
     }
+    console.error(`\n[ERROR][${phoneNumber}] No llegó ningún código en ${timeoutMs / 1000} segundos.`);
+    return null;
 }
 
 // <-- NUEVA FUNCIÓN: Para limpiar el archivo de código después de usarlo
 async function cleanupPhoneNumberFile(phoneNumber) {
-    const codeFilePath = path.join(__dirname, CODE_FOLDER, `${phoneNumber}.txt`);
+    const codeFilePath = path.join(FARM_HOME, CODE_FOLDER, `${phoneNumber}.txt`);
     try {
         await fs.access(codeFilePath); // Verifica si el archivo existe
         await fs.unlink(codeFilePath); // Elimina el archivo
@@ -126,9 +225,86 @@ async function cleanupPhoneNumberFile(phoneNumber) {
     }
 }
 
+/**
+ * Ejecuta un comando shell hablando directamente con el servidor adb
+ * (host:transport:<serial> + shell:<cmd>), sin lanzar el ejecutable adb.
+ */
+function adbShell(deviceSerial, command) {
+    return new Promise((resolve, reject) => {
+        const socket = net.createConnection({ host: ADB_SERVER_HOST, port: ADB_SERVER_PORT });
+        const services = [`host:transport:${deviceSerial}`, `shell:${command}`];
+        let buffer = Buffer.alloc(0);
+        let okays = 0;
+        let output = '';
+        let settled = false;
+        const finish = (error) => {
+            if (settled) return;
+            settled = true;
+            socket.destroy();
+            if (error) reject(error);
+            else resolve(output);
+        };
+        const send = (service) => {
+            const payload = Buffer.from(service, 'utf-8');
+            socket.write(payload.length.toString(16).padStart(4, '0'));
+            socket.write(payload);
+        };
+        socket.setTimeout(ADB_SHELL_TIMEOUT_MS, () => {
+            finish(new Error(`adb no respondió a '${services[Math.min(okays, services.length - 1)]}' en ${ADB_SHELL_TIMEOUT_MS} ms`));
+        });
+        socket.on('connect', () => send(services[0]));
+        socket.on('data', chunk => {
+            if (okays === services.length) {
+                output += chunk.toString('utf-8');
+                return;
+            }
+            buffer = Buffer.concat([buffer, chunk]);
+            while (okays < services.length && buffer.length >= 4) {
+                const status = buffer.subarray(0, 4).toString('ascii');
+                if (status === 'FAIL') {
+                    // FAIL + longitud en 4 dígitos hex + mensaje: se espera a tenerlo completo
+                    if (buffer.length < 8) return;
+                    const length = parseInt(buffer.subarray(4, 8).toString('ascii'), 16);
+                    if (Number.isNaN(length)) {
+                        finish(new Error(`adb rechazó '${services[okays]}' con una respuesta ilegible`));
+                        return;
+                    }
+                    if (buffer.length < 8 + length) return;
+                    finish(new Error(`adb rechazó '${services[okays]}': ${buffer.subarray(8, 8 + length).toString('utf-8')}`));
+                    return;
+                }
+                if (status !== 'OKAY') {
+                    finish(new Error(`Respuesta inesperada de adb a '${services[okays]}': ${status}`));
+                    return;
+                }
+                buffer = buffer.subarray(4);
+                okays += 1;
+                if (okays < services.length) send(services[okays]);
+            }
+            if (okays === services.length && buffer.length) {
+                output += buffer.toString('utf-8');
+                buffer = Buffer.alloc(0);
+            }
+        });
+        socket.on('error', finish);
+        socket.on('close', () => {
+            if (okays === services.length) finish();
+            else finish(new Error(`adb cerró la conexión durante '${services[okays]}'`));
+        });
+    });
+}
+
 // <-- NUEVA FUNCIÓN: Para limpiar los datos de la app usando ADB
 async function clearAppData(deviceSerial, packageName) {
     console.log(`[INFO][${deviceSerial}] Limpiando datos de la app '${packageName}' via ADB...`);
+    try {
+        const output = await adbShell(deviceSerial, `pm clear ${packageName}`);
+        console.log(`[INFO][${deviceSerial}] Datos de la app '${packageName}' limpiados exitosamente (${output.trim()}).`);
+        return output;
+    } catch (error) {
+        if (error.code !== 'ECONNREFUSED') throw error;
+        console.warn(`[ADVERTENCIA][${deviceSerial}] Servidor adb no disponible en ${ADB_SERVER_HOST}:${ADB_SERVER_PORT}. Usando el ejecutable adb...`);
+    }
     return new Promise((resolve, reject) => {
         exec(`adb -s ${deviceSerial} shell pm clear ${packageName}`, (error, stdout, stderr) => {
             if (error) {
@@ -145,12 +321,302 @@ async function clearAppData(deviceSerial, packageName) {
     });
 }
 
+// <-- NUEVA FUNCIÓN: Limpia los datos de la app dentro de la sesión Appium (sin lanzar adb)
+async function resetAppData(driver, deviceSerial) {
+    try {
+        await driver.execute('mobile: clearApp', { appId: TELEGRAM_PACKAGE_NAME });
+        console.log(`[INFO][${deviceSerial}] Datos de la app '${TELEGRAM_PACKAGE_NAME}' limpiados dentro de la sesión Appium.`);
+    } catch (error) {
+        console.warn(`[ADVERTENCIA][${deviceSerial}] 'mobile: clearApp' no disponible (${error.message}). Usando ADB...`);
+        await clearAppData(deviceSerial, TELEGRAM_PACKAGE_NAME);
+    }
+}
+
+async function connectAppium(deviceSerial, appiumPort = APPIUM_OPTIONS.port, systemPort = null) {
+    console.log(`[INFO] Conectando al servidor de Appium (puerto ${appiumPort})...`);
+    for (let i = 0; i < 5; i++) { // 5 intentos de conexión inicial a Appium
+        try {
+            // Para entornos multi-nodo donde cada worker de Node.js maneja un dispositivo específico
+            // ES CRUCIAL que Appium sepa a qué dispositivo conectarse.
+            // Aunque tu código original no lo incluía, para múltiples nodos funcionando *independientemente*,
+            // Appium necesita el UDID del dispositivo en sus capacidades.
+            const sessionCapabilities = { ...APPIUM_OPTIONS.capabilities };
+            if (deviceSerial && deviceSerial !== 'N/A') {
+                sessionCapabilities['appium:udid'] = deviceSerial;
+                console.log(`[INFO] Intentando conectar a Appium con UDID: ${deviceSerial}`);
+            }
+            // Con varios dispositivos en el mismo servidor/host cada uno necesita su propio systemPort
+            if (systemPort) {
+                sessionCapabilities['appium:systemPort'] = systemPort;
+            }
+            
+            const driver = await remote({ ...APPIUM_OPTIONS, port: appiumPort, capabilities: sessionCapabilities });
+            console.log("[INFO] Conexión exitosa a Appium.");
+            return driver;
+        } catch (err) {
+            console.error(`[ERROR] Intento ${i + 1} de conexión a Appium fallido: ${err.message}`);
+            await new Promise(resolve => setTimeout(resolve, 5000));
+        }
+    }
+    return null;
+}
+
+/**
+ * Deja el dispositivo listo para un número nuevo: limpia los datos de la app
+ * con `resetApp`, la activa y navega hasta "Tu número de teléfono".
+ * Devuelve true si se alcanzó esa pantalla. En `timings.pmClear` anota lo
+ * que tardó la limpieza de datos (ms).
+ */
+async function prepareDevice(driver, deviceSerial, resetApp, timings = {}) {
+    // Limpiar datos de la app para cada número procesado. 
+    // Esto es vital para asegurar que cada nuevo número tenga una sesión limpia en Telegram.
+    const clearStart = Date.now();
+    await resetApp();
+    timings.pmClear = Date.now() - clearStart;
+
+    // Lógica de reseteo robusta y activación de la app
+    const phoneScreenIdentifier = '//android.widget.TextView[@text="Tu número de teléfono"]';
+    const startScreenIdentifier = '//android.widget.TextView[@text="Empezar a chatear"]';
+    
+    let onCorrectScreen = false;
+    for(let retries = 0; retries < 5 && !onCorrectScreen; retries++) { // 5 reintentos para la pantalla inicial
+        try {
+            const currentPackage = await driver.getCurrentPackage();
+            if (currentPackage !== TELEGRAM_PACKAGE_NAME) {
+                console.log("[INFO] Telegram no está en primer plano, activando app...");
+                await driver.activateApp(TELEGRAM_PACKAGE_NAME);
+                await driver.pause(5000);
+            }
+
+            if (await driver.$(phoneScreenIdentifier).isExisting({ timeout: 3000 })) {
+                onCorrectScreen = true;
+                console.log("[INFO] En pantalla 'Tu número de teléfono'.");
+            } 
+            else if (await driver.$(startScreenIdentifier).isExisting({ timeout: 3000 })) {
+                console.log("[INFO] En pantalla 'Empezar a chatear', haciendo clic...");
+                await driver.$(startScreenIdentifier).click();
+                await driver.pause(3000);
+                if (await driver.$(phoneScreenIdentifier).isExisting({ timeout: 3000 })) {
+                    onCorrectScreen = true;
+                    console.log("[INFO] Transición exitosa a pantalla de número.");
+                }
+            } 
+            else {
+                console.log(`[INFO] No en pantalla esperada. Intentando 'back' (${retries + 1}/5)...`);
+                await driver.back();
+                await driver.pause(2000);
+            }
+        } catch (navError) {
+            console.warn(`[ADVERTENCIA][${deviceSerial}] Error durante la navegación inicial (${retries + 1}/5): ${navError.message}`);
+            await driver.pause(2000);
+        }
+    }
+    if (!onCorrectScreen) {
+        console.error(`[ERROR][${deviceSerial}] No se pudo volver a la pantalla de introducir número después de varios intentos.`);
+    }
+    return onCorrectScreen;
+}
+
+/**
+ * Procesa un número completo sobre una sesión ya abierta y devuelve su estado
+ * (2FA, NO_2FA, SUSPENDED, TOO_MANY_ATTEMPTS o UNKNOWN).
+ * `resetApp` limpia los datos de la app antes de empezar, salvo que el
+ * dispositivo ya se haya preparado (`currentSim.prepared`).
+ * En `timings` se anota la duración de cada etapa en ms (prep, submit, codeWait,
+ * verify), la de la limpieza de datos (pmClear) y el tiempo desde que el
+ * monitor escribió el código hasta teclearlo (codeTyped).
+ * `onCodeScreen` se llama al llegar a "Pon el código", antes de esperar el SMS.
+ */
+async function processNumber(driver, currentSim, resetApp, timings = {}, onCodeScreen = () => {}) {
+    const phoneNumber = currentSim.phoneNumber;
+    let stageStart = Date.now();
+    const endStage = (stage) => {
+        const now = Date.now();
+        timings[stage] = (timings[stage] || 0) + now - stageStart;
+        stageStart = now;
+    };
+    try {
+        if (!currentSim.prepared) {
+            const ready = await prepareDevice(driver, currentSim.deviceSerial, resetApp, timings);
+            endStage('prep');
+            if (!ready) {
+                console.error(`[ERROR][${phoneNumber}] Dispositivo no preparado. Saltando este número.`);
+                return 'UNKNOWN';
+            }
+        }
+
+        // Limpieza de campos segura
+        const countryCodeInput = await driver.$('//android.widget.EditText[1]');
+        const phoneInput = await driver.$('//android.widget.EditText[2]');
+        await countryCodeInput.waitForExist({ timeout: 10000 });
+        await phoneInput.click();
+        for (let k = 0; k < 15; k++) { await driver.sendKeyEvent('67'); } // <-- CORREGIDO: keycode como string
+        
+        // Introducción de número
+        const countryCode = phoneNumber.substring(0, 2);
+        const nationalNumber = phoneNumber.substring(2);
+        await countryCodeInput.setValue(countryCode);
+        await phoneInput.setValue(nationalNumber);
+
+        // Clic en el botón de continuar; los códigos anteriores a este envío son de otro intento
+        const submittedAt = Date.now();
+        await driver.$('//android.widget.FrameLayout[@content-desc="Listo"]/android.view.View').click();
+        await driver.$('//android.widget.TextView[@text="Sí"]').waitForExist({ timeout: 10000 });
+        await driver.$('//android.widget.TextView[@text="Sí"]').click();
+        
+        // Espera de resultados...
+        const codeScreen = await driver.$('//android.widget.TextView[@text="Pon el código"]');
+        const suspendedPopup = await driver.$('//android.widget.TextView[contains(@text, "suspendido")]');
+        const passwordScreen = await driver.$('//android.widget.TextView[@text="Tu contraseña"]');
+        const emailScreen = await driver.$('//android.widget.TextView[@text="Elige un correo de acceso"]');
+        const tooManyTriesScreen = await driver.$('//android.widget.TextView[contains(@text, "demasiados intentos")]');
+
+        const firstElementTimeout = 30000; // 30 segundos
+        const firstElement = await Promise.race([
+            codeScreen.waitForExist({ timeout: firstElementTimeout }).then(() => 'code'),
+            suspendedPopup.waitForExist({ timeout: firstElementTimeout }).then(() => 'suspended'),
+            passwordScreen.waitForExist({ timeout: firstElementTimeout }).then(() => 'password_direct'),
+            emailScreen.waitForExist({ timeout: firstElementTimeout }).then(() => 'email'),
+            tooManyTriesScreen.waitForExist({ timeout: firstElementTimeout }).then(() => 'too_many_attempts')
+        ]).catch(err => {
+            console.error(`[ERROR][${phoneNumber}] Ninguna pantalla esperada apareció en ${firstElementTimeout / 1000} segundos: ${err.message}`);
+            return 'timeout_error';
+        });
+        endStage('submit');
+
+        let status = 'UNKNOWN';
+        if (firstElement === 'suspended') {
+            await driver.$('//android.widget.Button[@text="OK"]').click();
+            status = 'SUSPENDED';
+        } else if (firstElement === 'too_many_attempts') {
+            await driver.$('//android.widget.Button[@text="OK"]').click();
+            status = 'TOO_MANY_ATTEMPTS';
+        } else if (firstElement === 'password_direct' || firstElement === 'email') {
+            status = '2FA';
+        } else if (firstElement === 'code') {
+            onCodeScreen();
+            const received = await waitForTelegramCode(phoneNumber, CODE_WAIT_TIMEOUT_MS, undefined, submittedAt);
+            endStage('codeWait');
+            if (received) {
+                await driver.keys(received.code.split(''));
+                if (received.writtenAt) timings.codeTyped = Math.max(0, Date.now() - received.writtenAt);
+                await driver.pause(5000);
+                const finalPasswordField = await driver.$('//android.widget.TextView[@text="Tu contraseña"]');
+                status = (await finalPasswordField.isExisting({ timeout: 10000 })) ? '2FA' : 'NO_2FA';
+            } else {
+                console.error(`[ERROR][${phoneNumber}] waitForTelegramCode devolvió nulo. Considerado UNKNOWN.`);
+                status = 'UNKNOWN';
+            }
+        } else if (firstElement === 'timeout_error') {
+            status = 'UNKNOWN';
+        }
+        endStage('verify');
+        return status;
+
+    } catch (error) {
+        console.error(`[ERROR][${phoneNumber}] Error general durante el procesamiento del número: ${error.message}`);
+        console.log(`[INFO][${phoneNumber}] Intentando reiniciar la app para el siguiente número para asegurar un estado limpio...`);
+        try {
+            await driver.terminateApp(TELEGRAM_PACKAGE_NAME);
+            await driver.pause(3000);
+            await driver.activateApp(TELEGRAM_PACKAGE_NAME);
+            await driver.pause(5000);
+        } catch (restartError) {
+            console.error(`[ERROR][${phoneNumber}] Fallo crítico al intentar reiniciar la app: ${restartError.message}`);
+        }
+        return 'UNKNOWN';
+    }
+}
+
+// --- MODO PERSISTENTE (un proceso y una sesión Appium por dispositivo) ---
+
+// Prefijo de las líneas de stdout que el orquestador interpreta como eventos JSON
+const EVENT_PREFIX = '@@EVENT ';
+
+function emitEvent(event) {
+    process.stdout.write(`${EVENT_PREFIX}${JSON.stringify(event)}\n`);
+}
+
+/**
+ * node telegram_reader.js --serve <deviceSerial> <appiumPort> [systemPort]
+ *
+ * Abre una única sesión Appium y procesa números recibidos por stdin, uno por
+ * línea: {"cmd": "process", "phoneNumber": ..., "port": ..., "iccid": ...}
+ * o {"cmd": "shutdown"}. Cada número termina con un evento 'result' en stdout.
+ * {"cmd": "prepare"} deja el dispositivo en "Tu número de teléfono" antes de
+ * recibir el número (evento 'prepared'); el siguiente 'process' se salta esa etapa.
+ */
+async function serve(deviceSerial, appiumPort, systemPort = null) {
+    const driver = await connectAppium(deviceSerial, appiumPort, systemPort);
+    if (!driver) {
+        console.error("[CRÍTICO] No se pudo conectar a Appium después de varios intentos. Abortando.");
+        emitEvent({ event: 'fatal', deviceSerial, message: 'No se pudo conectar a Appium' });
+        process.exitCode = 1;
+        return;
+    }
+    emitEvent({ event: 'ready', deviceSerial });
+
+    const input = readline.createInterface({ input: process.stdin });
+    const resetApp = () => resetAppData(driver, deviceSerial);
+    let prepared = false;
+    try {
+        for await (const line of input) {
+            if (!line.trim()) continue;
+            let request;
+            try {
+                request = JSON.parse(line);
+            } catch (error) {
+                emitEvent({ event: 'error', deviceSerial, message: `JSON inválido: ${error.message}` });
+                continue;
+            }
+            if (request.cmd === 'shutdown') break;
+            if (request.cmd === 'prepare') {
+                const startedAt = Date.now();
+                const timings = {};
+                try {
+                    prepared = await prepareDevice(driver, deviceSerial, resetApp, timings);
+                } catch (error) {
+                    console.error(`[ERROR][${deviceSerial}] Error preparando el dispositivo: ${error.message}`);
+                    prepared = false;
+                }
+                emitEvent({ event: 'prepared', deviceSerial, ok: prepared, durationMs: Date.now() - startedAt, timings });
+                continue;
+            }
+            if (request.cmd !== 'process' || !request.phoneNumber) {
+                emitEvent({ event: 'error', deviceSerial, message: `Petición no soportada: ${line}` });
+                continue;
+            }
+
+            const sim = { phoneNumber: request.phoneNumber, deviceSerial, port: request.port || '', iccid: request.iccid || '', prepared };
+            prepared = false;
+            const startedAt = Date.now();
+            const timings = {};
+            console.log(`\n--- Iniciando procesamiento para: ${sim.phoneNumber} ---`);
+            const status = await processNumber(driver, sim, resetApp, timings,
+                () => emitEvent({ event: 'awaiting_code', phoneNumber: sim.phoneNumber, deviceSerial }));
+            await saveResult(sim, status);
+            await cleanupPhoneNumberFile(sim.phoneNumber);
+            console.log(`--- [INFO] Finalizado procesamiento para: ${sim.phoneNumber} ---`);
+            emitEvent({ event: 'result', phoneNumber: sim.phoneNumber, deviceSerial, status, durationMs: Date.now() - startedAt, timings });
+        }
+    } finally {
+        input.close();
+        console.log("[INFO] Cerrando la sesión de Appium.");
+        await driver.deleteSession();
+    }
+}
+
 // --- FUNCIÓN PRINCIPAL ---
 
 async function main() {
     let simsToProcess = [];
     const args = process.argv.slice(2); 
 
+    if (args[0] === '--serve') {
+        await serve(args[1], parseInt(args[2] || String(APPIUM_OPTIONS.port), 10), args[3] ? parseInt(args[3], 10) : null);
+        return;
+    }
+
     if (args.length >= 2) {
         // Modo de prueba directo: node telegram_reader.js <phoneNumber> <deviceSerial> [port] [iccid]
         const phoneNumber = args[0];
@@ -167,7 +633,7 @@ async function main() {
         console.log(`[INFO] Modo de prueba directo activado para número: ${phoneNumber}, Dispositivo: ${deviceSerial}`);
 
         // Aseguramos que el directorio y el archivo del número existan para el modo de prueba
-        const codeFolderPath = path.join(__dirname, CODE_FOLDER);
+        const codeFolderPath = path.join(FARM_HOME, CODE_FOLDER);
         try {
             await fs.mkdir(codeFolderPath, { recursive: true });
             const codeFilePath = path.join(codeFolderPath, `${phoneNumber}.txt`);
@@ -190,9 +656,6 @@ async function main() {
 
     let driver;
     try {
-        console.log("[INFO] Conectando al servidor de Appium...");
-        let connected = false;
-        
         // Limpiamos los datos de la app para el *primer dispositivo* ANTES de intentar conectar Appium.
         // Esto es crucial para un entorno multi-node donde cada worker de Node.js
         // procesará un número a la vez en su dispositivo asignado.
@@ -203,30 +666,9 @@ async function main() {
             return;
         }
 
-
-        for (let i = 0; i < 5; i++) { // 5 intentos de conexión inicial a Appium
-            try {
-                // Para entornos multi-nodo donde cada worker de Node.js maneja un dispositivo específico
-                // ES CRUCIAL que Appium sepa a qué dispositivo conectarse.
-                // Aunque tu código original no lo incluía, para múltiples nodos funcionando *independientemente*,
-                // Appium necesita el UDID del dispositivo en sus capacidades.
-                const currentDeviceSerial = simsToProcess[0].deviceSerial; // Asume que el worker procesará este dispositivo
-                const sessionCapabilities = { ...APPIUM_OPTIONS.capabilities };
-                if (currentDeviceSerial && currentDeviceSerial !== 'N/A') {
-                    sessionCapabilities['appium:udid'] = currentDeviceSerial;
-                    console.log(`[INFO] Intentando conectar a Appium con UDID: ${currentDeviceSerial}`);
-                }
-                
-                driver = await remote({ ...APPIUM_OPTIONS, capabilities: sessionCapabilities });
-                connected = true;
-                console.log("[INFO] Conexión exitosa a Appium.");
-                break;
-            } catch (err) {
-                console.error(`[ERROR] Intento ${i + 1} de conexión a Appium fallido: ${err.message}`);
-                await new Promise(resolve => setTimeout(resolve, 5000));
-            }
-        }
-        if (!connected) {
+        // Asume que el worker procesará el dispositivo del primer número
+        driver = await connectAppium(simsToProcess[0].deviceSerial);
+        if (!driver) {
             console.error("[CRÍTICO] No se pudo conectar a Appium después de varios intentos. Abortando.");
             // Si Appium no se conecta, marcamos los números como UNKNOWN
             for (const sim of simsToProcess) {
@@ -241,136 +683,12 @@ async function main() {
             const phoneNumber = currentSim.phoneNumber;
             const deviceSerial = currentSim.deviceSerial; 
             console.log(`\n--- [${i + 1}/${simsToProcess.length}] Iniciando procesamiento para: ${phoneNumber} ---`);
-            
-            try {
-                // Limpiar datos de la app para cada número procesado. 
-                // Esto es vital para asegurar que cada nuevo número tenga una sesión limpia en Telegram.
-                // Se hace *después* de la conexión Appium, pero *antes* de interactuar con Telegram para este número.
-                await clearAppData(deviceSerial, TELEGRAM_PACKAGE_NAME);
-
-                // Lógica de reseteo robusta y activación de la app
-                const phoneScreenIdentifier = '//android.widget.TextView[@text="Tu número de teléfono"]';
-                const startScreenIdentifier = '//android.widget.TextView[@text="Empezar a chatear"]';
-                
-                let onCorrectScreen = false;
-                for(let retries = 0; retries < 5 && !onCorrectScreen; retries++) { // 5 reintentos para la pantalla inicial
-                    try {
-                        const currentPackage = await driver.getCurrentPackage();
-                        if (currentPackage !== TELEGRAM_PACKAGE_NAME) {
-                            console.log("[INFO] Telegram no está en primer plano, activando app...");
-                            await driver.activateApp(TELEGRAM_PACKAGE_NAME);
-                            await driver.pause(5000);
-                        }
-
-                        if (await driver.$(phoneScreenIdentifier).isExisting({ timeout: 3000 })) {
-                            onCorrectScreen = true;
-                            console.log("[INFO] En pantalla 'Tu número de teléfono'.");
-                        } 
-                        else if (await driver.$(startScreenIdentifier).isExisting({ timeout: 3000 })) {
-                            console.log("[INFO] En pantalla 'Empezar a chatear', haciendo clic...");
-                            await driver.$(startScreenIdentifier).click();
-                            await driver.pause(3000);
-                            if (await driver.$(phoneScreenIdentifier).isExisting({ timeout: 3000 })) {
-                                onCorrectScreen = true;
-                                console.log("[INFO] Transición exitosa a pantalla de número.");
-                            }
-                        } 
-                        else {
-                            console.log(`[INFO] No en pantalla esperada. Intentando 'back' (${retries + 1}/5)...`);
-                            await driver.back();
-                            await driver.pause(2000);
-                        }
-                    } catch (navError) {
-                        console.warn(`[ADVERTENCIA][${phoneNumber}] Error durante la navegación inicial (${retries + 1}/5): ${navError.message}`);
-                        await driver.pause(2000);
-                    }
-                }
-                if (!onCorrectScreen) {
-                    console.error(`[ERROR][${phoneNumber}] No se pudo volver a la pantalla de introducir número después de varios intentos. Saltando este número.`);
-                    await saveResult(currentSim, 'UNKNOWN');
-                    await cleanupPhoneNumberFile(phoneNumber);
-                    continue;
-                }
 
-                // Limpieza de campos segura
-                const countryCodeInput = await driver.$('//android.widget.EditText[1]');
-                const phoneInput = await driver.$('//android.widget.EditText[2]');
-                await countryCodeInput.waitForExist({ timeout: 10000 });
-                await phoneInput.click();
-                for (let k = 0; k < 15; k++) { await driver.sendKeyEvent('67'); } // <-- CORREGIDO: keycode como string
-                
-                // Introducción de número
-                const countryCode = phoneNumber.substring(0, 2);
-                const nationalNumber = phoneNumber.substring(2);
-                await countryCodeInput.setValue(countryCode);
-                await phoneInput.setValue(nationalNumber);
-
-                // Clic en el botón de continuar
-                await driver.$('//android.widget.FrameLayout[@content-desc="Listo"]/android.view.View').click();
-                await driver.$('//android.widget.TextView[@text="Sí"]').waitForExist({ timeout: 10000 });
-                await driver.$('//android.widget.TextView[@text="Sí"]').click();
-                
-                // Espera de resultados...
-                const codeScreen = await driver.$('//android.widget.TextView[@text="Pon el código"]');
-                const suspendedPopup = await driver.$('//android.widget.TextView[contains(@text, "suspendido")]');
-                const passwordScreen = await driver.$('//android.widget.TextView[@text="Tu contraseña"]');
-                const emailScreen = await driver.$('//android.widget.TextView[@text="Elige un correo de acceso"]');
-                const tooManyTriesScreen = await driver.$('//android.widget.TextView[contains(@text, "demasiados intentos")]');
-
-                const firstElementTimeout = 30000; // 30 segundos
-                const firstElement = await Promise.race([
-                    codeScreen.waitForExist({ timeout: firstElementTimeout }).then(() => 'code'),
-                    suspendedPopup.waitForExist({ timeout: firstElementTimeout }).then(() => 'suspended'),
-                    passwordScreen.waitForExist({ timeout: firstElementTimeout }).then(() => 'password_direct'),
-                    emailScreen.waitForExist({ timeout: firstElementTimeout }).then(() => 'email'),
-                    tooManyTriesScreen.waitForExist({ timeout: firstElementTimeout }).then(() => 'too_many_attempts')
-                ]).catch(err => {
-                    console.error(`[ERROR][${phoneNumber}] Ninguna pantalla esperada apareció en ${firstElementTimeout / 1000} segundos: ${err.message}`);
-                    return 'timeout_error';
-                });
-                
-                let status = 'UNKNOWN';
-                if (firstElement === 'suspended') {
-                    await driver.$('//android.widget.Button[@text="OK"]').click();
-                    status = 'SUSPENDED';
-                } else if (firstElement === 'too_many_attempts') {
-                    await driver.$('//android.widget.Button[@text="OK"]').click();
-                    status = 'TOO_MANY_ATTEMPTS';
-                } else if (firstElement === 'password_direct' || firstElement === 'email') {
-                    status = '2FA';
-                } else if (firstElement === 'code') {
-                    const code = await waitForTelegramCode(phoneNumber);
-                    if (code) {
-                        await driver.keys(code.split(''));
-                        await driver.pause(5000);
-                        const finalPasswordField = await driver.$('//android.widget.TextView[@text="Tu contraseña"]');
-                        status = (await finalPasswordField.isExisting({ timeout: 10000 })) ? '2FA' : 'NO_2FA';
-                    } else {
-                        console.error(`[ERROR][${phoneNumber}] waitForTelegramCode devolvió nulo. Considerado UNKNOWN.`);
-                        status = 'UNKNOWN';
-                    }
-                } else if (firstElement === 'timeout_error') {
-                    status = 'UNKNOWN';
-                }
-
-                await saveResult(currentSim, status);
-                await cleanupPhoneNumberFile(phoneNumber);
-
-            } catch (error) {
-                console.error(`[ERROR][${phoneNumber}] Error general durante el procesamiento del número: ${error.message}`);
-                await saveResult(currentSim, 'UNKNOWN');
-                await cleanupPhoneNumberFile(phoneNumber);
-                console.log(`[INFO][${phoneNumber}] Intentando reiniciar la app para el siguiente número para asegurar un estado limpio...`);
-                try {
-                    await driver.terminateApp(TELEGRAM_PACKAGE_NAME);
-                    await driver.pause(3000);
-                    await driver.activateApp(TELEGRAM_PACKAGE_NAME);
-                    await driver.pause(5000);
-                } catch (restartError) {
-                    console.error(`[ERROR][${phoneNumber}] Fallo crítico al intentar reiniciar la app: ${restartError.message}`);
-                }
-            }
-             console.log(`--- [INFO] Finalizado procesamiento para: ${phoneNumber} ---`);
+            // Se limpia *después* de la conexión Appium, pero *antes* de interactuar con Telegram para este número.
+            const status = await processNumber(driver, currentSim, () => clearAppData(deviceSerial, TELEGRAM_PACKAGE_NAME));
+            await saveResult(currentSim, status);
+            await cleanupPhoneNumberFile(phoneNumber);
+            console.log(`--- [INFO] Finalizado procesamiento para: ${phoneNumber} ---`);
         }
     } catch (error) {
         console.error(`[ERROR] Ha ocurrido un error fatal en la sesión de Appium o en el bucle principal de procesamiento: ${error.message}`);
@@ -1,16 +1,102 @@
 # utils.py
 """Utility functions used across the project.
-Actualmente solo contiene la configuración básica de logging, pero se
-pueden añadir más utilidades según crezca el proyecto.
+Actualmente solo contiene la configuración de logging, pero se pueden
+añadir más utilidades según crezca el proyecto.
+
+El logging no bloquea a quien registra: el root solo tiene un QueueHandler
+y un hilo QueueListener hace la E/S. Un único proceso (main.py) es dueño del
+archivo de log y de su rotación; los procesos hijos (sms_monitor.py) le
+envían sus registros por un socket local (FARM_LOG_SOCKET) en vez de abrir
+el mismo archivo.
 """
 
+import atexit
+import json
 import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
 from logging import handlers
 from pathlib import Path
+from typing import Optional
+
+# host:puerto del servidor de logs del proceso dueño del archivo; lo heredan los hijos
+LOG_SOCKET_ENV = "FARM_LOG_SOCKET"
+
+_listener: Optional[handlers.QueueListener] = None
+_server: Optional["LogRecordServer"] = None
+
+
+class JsonSocketHandler(handlers.SocketHandler):
+    """SocketHandler que envía los registros como JSON (no pickle) con prefijo de longitud."""
+
+    def makePickle(self, record: logging.LogRecord) -> bytes:
+        fields = {
+            "name": record.name, "levelno": record.levelno, "levelname": record.levelname,
+            "msg": record.getMessage(), "created": record.created, "msecs": record.msecs,
+            "process": record.process, "processName": record.processName,
+            "thread": record.thread, "threadName": record.threadName,
+            "pathname": record.pathname, "lineno": record.lineno, "funcName": record.funcName,
+            "exc_text": record.exc_text,
+        }
+        data = json.dumps(fields).encode("utf-8")
+        return struct.pack(">L", len(data)) + data
+
+
+class _LogRecordHandler(socketserver.StreamRequestHandler):
+    server: "LogRecordServer"
+
+    def handle(self) -> None:
+        while True:
+            header = self.rfile.read(4)
+            if len(header) < 4:
+                return
+            data = self.rfile.read(struct.unpack(">L", header)[0])
+            try:
+                record = logging.makeLogRecord(json.loads(data))
+            except ValueError:
+                continue
+            self.server.target.handle(record)
+
 
+class LogRecordServer(socketserver.ThreadingTCPServer):
+    """Recibe los registros de los procesos hijos y los pasa al handler del archivo."""
 
-def init_logging(log_file: Path, level: str = "INFO") -> None:
-    """Configure basic logging to file and console."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, target: logging.Handler, host: str = "127.0.0.1", port: int = 0) -> None:
+        super().__init__((host, port), _LogRecordHandler)
+        self.target = target
+
+    @property
+    def address(self) -> str:
+        return f"{self.server_address[0]}:{self.server_address[1]}"
+
+
+def _parent_socket() -> Optional[JsonSocketHandler]:
+    """Handler hacia el servidor de logs del proceso padre, si está definido y accesible."""
+    address = os.environ.get(LOG_SOCKET_ENV)
+    if not address:
+        return None
+    host, _, port = address.rpartition(":")
+    try:
+        socket.create_connection((host, int(port)), timeout=1).close()
+    except (OSError, ValueError):
+        return None
+    return JsonSocketHandler(host, int(port))
+
+
+def init_logging(log_file: Path, level: str = "INFO", serve: bool = False) -> None:
+    """
+    Configure non-blocking logging to file and console.
+    Con `serve` este proceso es el dueño del archivo y atiende a sus hijos;
+    sin él, si hay un padre con servidor de logs, el archivo lo escribe el padre.
+    """
+    global _listener, _server
     # Nos aseguramos de que exista el directorio de logs
     Path(log_file).parent.mkdir(parents=True, exist_ok=True)
 
@@ -21,16 +107,37 @@ def init_logging(log_file: Path, level: str = "INFO") -> None:
         "%(asctime)s - %(levelname)s - %(name)s - %(message)s"
     )
 
-    # Maneja la rotación de archivos para evitar logs gigantes
-    file_handler = handlers.RotatingFileHandler(log_file, maxBytes=1_000_000, backupCount=3, encoding="utf-8")
-    file_handler.setFormatter(formatter)
-
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
     console_handler.setLevel(root.level)
-    # AÑADIR: encoding="utf-8"
     console_handler.set_name('console') # Añade un nombre si no lo tiene
     console_handler.stream.reconfigure(encoding='utf-8') # Asegura la reconfiguración del stream
 
-    root.addHandler(file_handler)
-    root.addHandler(console_handler)
\ No newline at end of file
+    file_handler = None if serve else _parent_socket()
+    if file_handler is None:
+        # Maneja la rotación de archivos para evitar logs gigantes (solo en el proceso dueño)
+        file_handler = handlers.RotatingFileHandler(log_file, maxBytes=1_000_000, backupCount=3, encoding="utf-8")
+        file_handler.setFormatter(formatter)
+        if serve:
+            _server = LogRecordServer(file_handler)
+            threading.Thread(target=_server.serve_forever, name="log-server", daemon=True).start()
+            os.environ[LOG_SOCKET_ENV] = _server.address
+
+    # Quien registra solo encola; el hilo del listener formatea y escribe
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    root.addHandler(handlers.QueueHandler(records))
+    _listener = handlers.QueueListener(records, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """Vacía la cola de registros y cierra el servidor de logs."""
+    global _listener, _server
+    if _listener:
+        _listener.stop()
+        _listener = None
+    if _server:
+        _server.shutdown()
+        _server.server_close()
+        _server = None